@@ -1,7 +1,8 @@
-__all__ = ["VATModuleInterface", "MixUp"]
+__all__ = ["VATModuleInterface", "VATDirectionCache", "BNStatsFreezer", "bn_stats_freezer", "freeze_bn_stats", "MixUp"]
 import contextlib
-from typing import Union, Dict, Tuple, List
+from typing import Union, Dict, Tuple, List, Optional
 
+import numpy as np
 import torch
 import torch.nn as nn
 from deepclustering.decorator import threaded
@@ -13,20 +14,55 @@ from deepclustering.writer import SummaryWriter
 from termcolor import colored
 from torch import Tensor
 from torch.distributions import Beta
+from torch.nn.modules.batchnorm import _BatchNorm
 
 
-@contextlib.contextmanager
-def _disable_tracking_bn_stats(model):
-    def switch_attr(m):
-        if hasattr(m, "track_running_stats"):
-            m.track_running_stats ^= True
+class BNStatsFreezer:
+    """
+    forward without updating the running statistics of the batch-norm layers. The layers are listed once, entering
+    and leaving the context only save and restore their `track_running_stats` flag, in O(#BN) instead of walking the
+    whole model. Layers in training mode normalize with the batch statistics without recording them; layers in eval
+    mode are left untouched and keep using their running statistics. Nested contexts restore the flags they found.
+    >>> with BNStatsFreezer(net).frozen():
+    >>>     pred = net(perturbed_images)
+    """
+
+    def __init__(self, model: nn.Module) -> None:
+        self.bn_modules: List[_BatchNorm] = []
+        self.refresh(model)
+
+    def refresh(self, model: nn.Module) -> None:
+        """
+        list the batch-norm layers again, after modules of `model` have been replaced.
+        """
+        self.bn_modules = [m for m in model.modules() if isinstance(m, _BatchNorm)]
+
+    @contextlib.contextmanager
+    def frozen(self):
+        saved = [m.track_running_stats for m in self.bn_modules]
+        for m in self.bn_modules:
+            if m.training:
+                m.track_running_stats = False
+        try:
+            yield
+        finally:
+            for m, track_running_stats in zip(self.bn_modules, saved):
+                m.track_running_stats = track_running_stats
+
+
+def bn_stats_freezer(model: Union[Model, nn.Module]) -> BNStatsFreezer:
+    """
+    :return: the `BNStatsFreezer` of `model`, built at the first call and kept on the network.
+    """
+    torchnet = model if isinstance(model, nn.Module) else model.torchnet
+    freezer = torchnet.__dict__.get("_bn_stats_freezer")
+    if freezer is None:
+        freezer = torchnet.__dict__["_bn_stats_freezer"] = BNStatsFreezer(torchnet)
+    return freezer
+
 
-    # let the track_running_stats to be inverse
-    model.apply(switch_attr)
-    # return the model
-    yield
-    # let the track_running_stats to be inverse
-    model.apply(switch_attr)
+def freeze_bn_stats(model: Union[Model, nn.Module]):
+    return bn_stats_freezer(model).frozen()
 
 
 def _l2_normalize(d: torch.Tensor) -> torch.Tensor:
@@ -68,7 +104,7 @@ class VATLoss(nn.Module):
         d = torch.randn_like(x, device=x.device)
         d = _l2_normalize(d)
 
-        with _disable_tracking_bn_stats(model):
+        with freeze_bn_stats(model):
             # calc adversarial direction
             for _ in range(self.ip):
                 d.requires_grad_()
@@ -117,51 +153,155 @@ class VATLoss_Multihead(nn.Module):
         self.distance_func = distance_func
         print(colored(f"VAT with eps: {self.eps}, xi: {self.xi}, distance: {self.distance_func}", "green"))
 
-    def forward(self, model: Model, x: torch.Tensor, **kwargs):
-        with torch.no_grad():
-            pred = model(x, **kwargs)
-        assert assert_list(simplex, pred), f"pred should be a list of simplex."
+    def forward(self, model: Model, x: torch.Tensor, pred: List[Tensor] = None, direction: Tensor = None,
+                refine_index: Tensor = None, **kwargs):
+        """
+        :param model: model to generate the adversarial noise
+        :param x: input images
+        :param pred: optional prediction on `x` to avoid an extra forward, computed without grad.
+        :param direction: optional initial direction of the power iteration, random by default
+        :param refine_index: optional indices of the samples refined by the power iteration, all by default
+        """
+        if pred is None:
+            with torch.no_grad():
+                pred = model(x, **kwargs)
+        pred = [p.detach() for p in pred]
+        r_adv = self.adversarial_noise(model, x, pred, direction=direction, refine_index=refine_index, **kwargs)
 
-        # prepare random unit tensor
-        d = torch.randn_like(x, device=x.device)
-        d = _l2_normalize(d)
+        with freeze_bn_stats(model):
+            pred_hat = model(x + r_adv, **kwargs)
+            assert assert_list(simplex, pred_hat)
+            lds = list(map(lambda p_, p: self.distance_func(p_, p), pred_hat, pred))  # type: ignore
+            _lds: torch.Tensor = sum(lds) / float(len(lds))  # type: ignore
+
+        return _lds, (x + r_adv).detach(), r_adv
 
-        with _disable_tracking_bn_stats(model):
+    def adversarial_noise(self, model: Model, x: torch.Tensor, pred: List[Tensor], direction: Tensor = None,
+                          refine_index: Tensor = None, **kwargs) -> Tensor:
+        """
+        Power iteration for the adversarial direction. The gradient is taken with `torch.autograd.grad` so that the
+        `.grad` of the model parameters is left untouched.
+        :param model: model to generate the adversarial noise
+        :param x: input images
+        :param pred: detached list of simplexes on `x`
+        :param direction: initial direction with the same shape as `x`, such as the one of the previous epoch, so
+        that fewer iterations are needed. Random by default.
+        :param refine_index: the power iteration only runs on these samples (with their own batch statistics),
+        the others keep their initial direction.
+        :return: detached adversarial noise `r_adv` with the same shape as `x`
+        """
+        assert assert_list(simplex, pred), f"pred should be a list of simplex."
+        # prepare random unit tensor
+        if direction is None:
+            d = _l2_normalize(torch.randn_like(x, device=x.device))
+        else:
+            assert direction.shape == x.shape, f"direction should have the shape of x, given {direction.shape}."
+            d = _l2_normalize(direction.detach().to(x).clone())
+        if refine_index is not None:
+            x_, pred_, d_ = x[refine_index], [p[refine_index] for p in pred], d[refine_index]
+        else:
+            x_, pred_, d_ = x, pred, d
+
+        with freeze_bn_stats(model):
             # calc adversarial direction
             for _ in range(self.ip):
-                d.requires_grad_()
-                pred_hat = model(x + self.xi * d, **kwargs)
+                d_.requires_grad_()
+                pred_hat = model(x_ + self.xi * d_, **kwargs)
                 assert assert_list(simplex, pred_hat)
                 # here the pred_hat is the list of simplex
-                adv_distance: List[Tensor] = list(map(lambda p_, p: self.distance_func(p_, p), pred_hat, pred))
+                adv_distance: List[Tensor] = list(map(lambda p_, p: self.distance_func(p_, p), pred_hat, pred_))
                 _adv_distance: torch.Tensor = sum(adv_distance) / float(len(adv_distance))  # type: ignore
-                _adv_distance.backward()  # type: ignore
-                assert d.grad is not None  # make sure d have a grad instead of None.
-                d = _l2_normalize(d.grad)
+                d_grad, = torch.autograd.grad(_adv_distance, d_)
+                d_ = _l2_normalize(d_grad)
+        if refine_index is not None:
+            d[refine_index] = d_
+        else:
+            d = d_
+
+        # calc LDS
+        if isinstance(self.eps, torch.Tensor):
+            # a dictionary is given
+            bn, *shape = x.shape
+            basic_view_shape: Tuple[int, ...] = (bn, *([1] * len(shape)))
+            r_adv = d * self.eps.view(basic_view_shape).expand_as(d) * self.prop_eps
+        elif isinstance(self.eps, (float, int)):
+            r_adv = d * self.eps * self.prop_eps
+        else:
+            raise NotImplementedError(f"eps should be tensor or float, given {self.eps}.")
+        return r_adv.detach()
+
+
+class VATDirectionCache:
+    """
+    adversarial directions of the former steps, keyed by the dataset index of the samples, to warm-start the power
+    iteration of VAT from the direction found at the previous epoch. The directions are stored on cpu in float16 and
+    the storage grows with the largest index seen. They are not saved in the checkpoints.
+    """
 
-            # calc LDS
-            if isinstance(self.eps, torch.Tensor):
-                # a dictionary is given
-                bn, *shape = x.shape
-                basic_view_shape: Tuple[int, ...] = (bn, *([1] * len(shape)))
-                r_adv = d * self.eps.view(basic_view_shape).expand_as(d) * self.prop_eps
-            elif isinstance(self.eps, (float, int)):
-                r_adv = d * self.eps * self.prop_eps
-            else:
-                raise NotImplementedError(f"eps should be tensor or float, given {self.eps}.")
+    def __init__(self, dtype: torch.dtype = torch.float16, device: Union[str, torch.device] = "cpu") -> None:
+        self.dtype = dtype
+        self.device = torch.device(device)
+        self._directions: Optional[Tensor] = None
+        self._stored: Optional[Tensor] = None
+
+    def _reserve(self, size: int, sample_shape: torch.Size) -> None:
+        if self._directions is not None and self._directions.shape[1:] != sample_shape:
+            # the image format changed, former directions are useless
+            self._directions, self._stored = None, None
+        current_size = 0 if self._directions is None else self._directions.shape[0]
+        if size <= current_size:
+            return
+        size = max(size, 2 * current_size)
+        directions = torch.zeros(size, *sample_shape, dtype=self.dtype, device=self.device)
+        stored = torch.zeros(size, dtype=torch.bool, device=self.device)
+        if current_size:
+            directions[:current_size] = self._directions
+            stored[:current_size] = self._stored
+        self._directions, self._stored = directions, stored
+
+    def get(self, indices: Tensor, images: Tensor) -> Tensor:
+        """
+        :param indices: dataset indices of the images
+        :param images: images to be perturbed
+        :return: unit directions with the shape of `images`, random ones for the samples never seen
+        """
+        assert indices.shape[0] == images.shape[0], \
+            f"indices and images should have the same length, given {indices.shape[0]} and {images.shape[0]}."
+        d = torch.randn_like(images)
+        if self._directions is None or self._directions.shape[1:] != images.shape[1:]:
+            return _l2_normalize(d)
+        indices = indices.to(self.device)
+        found = indices < self._stored.shape[0]
+        found[found.clone()] = self._stored[indices[found]]
+        if found.any():
+            d[found.to(d.device)] = self._directions[indices[found]].to(d)
+        return _l2_normalize(d)
+
+    def put(self, indices: Tensor, directions: Tensor) -> None:
+        """
+        :param indices: dataset indices of the samples, the last one is kept for repeated indices
+        :param directions: directions with shape (N, *image_shape)
+        """
+        if indices.shape[0] == 0:
+            return
+        self._reserve(int(indices.max()) + 1, directions.shape[1:])
+        indices = indices.to(self.device)
+        self._directions[indices] = directions.detach().to(self.device, self.dtype)
+        self._stored[indices] = True
+
+    def __len__(self) -> int:
+        return 0 if self._stored is None else int(self._stored.sum())
 
-            pred_hat = model(x + r_adv, **kwargs)
-            assert assert_list(simplex, pred_hat)
-            lds = list(map(lambda p_, p: self.distance_func(p_, p), pred_hat, pred))  # type: ignore
-            _lds: torch.Tensor = sum(lds) / float(len(lds))  # type: ignore
 
-        return _lds, (x + r_adv).detach(), r_adv.detach()
+# `VAT_params` handled by the trainers (see `VATReg`) rather than by the VAT module
+VAT_TRAINER_PARAMS = ("direction_cache", "fraction")
 
 
 def VATModuleInterface(params: Dict[str, Union[str, int, float]], verbose: bool = True):
     """
     VAT module interface to choose distance function based on the params.name
     >>> assert params.name in ("kl","mi")
+    The keys of `VAT_TRAINER_PARAMS` are ignored.
     """
     loss_name = params.get("name", "kl")
     assert loss_name in ("kl", "mi")
@@ -170,34 +310,48 @@ def VATModuleInterface(params: Dict[str, Union[str, int, float]], verbose: bool
     loss_func = KL_div(reduce=True) if loss_name == "kl" else iid_loss
 
     return VATLoss_Multihead(
-        distance_func=loss_func, **{k: v for k, v in params.items() if k != "name"}
+        distance_func=loss_func, **{k: v for k, v in params.items() if k != "name" and k not in VAT_TRAINER_PARAMS}
     )
 
 
 class MixUp:
     def __init__(self, device: torch.device, num_classes: int) -> None:
         self.device = device
-        self.beta_distr = Beta(torch.tensor([1.0]), torch.tensor([1.0]))
+        # sample alpha directly on the device
+        self.beta_distr = Beta(torch.tensor([1.0], device=device), torch.tensor([1.0], device=device))
         self.num_class = num_classes
         print(colored("Mixup initialized.", "green"))
 
     def __call__(self, img1: Tensor, pred1: Tensor, img2: Tensor, pred2: Tensor):
-        assert simplex(pred1) and simplex(pred2)
+        mixup_img, (mixup_label,), mixup_index = self.mixup_multihead(img1, [pred1], img2, [pred2])
+        return mixup_img, mixup_label, mixup_index
+
+    def mixup_multihead(self, img1: Tensor, preds1: List[Tensor], img2: Tensor, preds2: List[Tensor]):
+        """
+        Mixup with one alpha per sample shared by all the subheads, so that the mixup image is forwarded only once.
+        :param preds1: list of simplexes on img1, one per subhead
+        :param preds2: list of simplexes on img2, one per subhead
+        :return: mixup image, list of detached mixup labels and mixup index
+        """
+        assert assert_list(simplex, preds1) and assert_list(simplex, preds2)
+        assert len(preds1) == len(preds2), f"Prediction lists should have the same length, " \
+            f"given {len(preds1)} and {len(preds2)}."
         bn, *shape = img1.shape
-        alpha = self.beta_distr.sample((bn,)).squeeze(1).to(self.device)
-        _alpha = alpha.view(bn, 1, 1, 1).repeat(1, *shape)
-        assert _alpha.shape == img1.shape
+        alpha = self.beta_distr.sample((bn,)).squeeze(1)
+        # broadcast alpha over the image dimensions instead of repeating it
+        _alpha = alpha.view(bn, *([1] * len(shape)))
         mixup_img = img1 * _alpha + img2 * (1 - _alpha)
-        mixup_label = pred1 * alpha.view(bn, 1) + pred2 * (1 - alpha).view(bn, 1)
-        mixup_index = torch.stack([alpha, 1 - alpha], dim=1).to(self.device)
+        mixup_labels = [pred1 * alpha.view(bn, 1) + pred2 * (1 - alpha).view(bn, 1)
+                        for pred1, pred2 in zip(preds1, preds2)]
+        mixup_index = torch.stack([alpha, 1 - alpha], dim=1)
 
         assert mixup_img.shape == img1.shape
-        assert mixup_label.shape == pred2.shape
+        assert all(mixup_label.shape == pred2.shape for mixup_label, pred2 in zip(mixup_labels, preds2))
         assert mixup_index.shape[0] == bn
         assert simplex(mixup_index)
-        assert simplex(mixup_label)
+        assert assert_list(simplex, mixup_labels)
 
-        return mixup_img, mixup_label.detach(), mixup_index
+        return mixup_img, [mixup_label.detach() for mixup_label in mixup_labels], mixup_index
 
 
 @threaded(name="plot", daemon=False)
@@ -219,3 +373,27 @@ def pred_histgram(tf_writter: SummaryWriter, preds: Tensor, epoch: int):
         #     },
         #     global_step=epoch
         # )
+
+
+@threaded(name="plot", daemon=False)
+def cluster_size_histgram(tf_writter: SummaryWriter, cluster_counts, epoch: int):
+    """
+    same histogram as `pred_histgram`, built from the number of samples assigned to each cluster.
+    :param cluster_counts: array with shape (num_subheads, num_clusters)
+    """
+    num_subheads, num_clusters = cluster_counts.shape
+    values = np.arange(1, num_clusters + 1, dtype=np.float64)
+    for subhead in range(num_subheads):
+        counts = np.asarray(cluster_counts[subhead], dtype=np.float64)
+        occupied = values[counts > 0]
+        tf_writter.add_histogram_raw(
+            tag=f"subhead_{subhead}_pred",
+            min=occupied.min(),
+            max=occupied.max(),
+            num=counts.sum(),
+            sum=(values * counts).sum(),
+            sum_squares=(values ** 2 * counts).sum(),
+            bucket_limits=(values + 0.5).tolist(),
+            bucket_counts=counts.tolist(),
+            global_step=epoch,
+        )
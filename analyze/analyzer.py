@@ -310,7 +310,7 @@ class AnalyzeInference(ClusteringGeneralTrainer):
             self.model.train()
             train_loader_ = tqdm_(train_loader)
             for batch_num, (image_gt) in enumerate(train_loader_):
-                image, gt = zip(*image_gt)
+                image, gt, *_ = zip(*image_gt)
                 image = image[0].to(self.device)
                 gt = gt[0].to(self.device)
 
@@ -336,7 +336,7 @@ class AnalyzeInference(ClusteringGeneralTrainer):
             self.model.eval()
             val_loader_ = tqdm_(val_loader)
             for batch_num, (image_gt) in enumerate(val_loader_):
-                image, gt = zip(*image_gt)
+                image, gt, *_ = zip(*image_gt)
                 image = image[0].to(self.device)
                 gt = gt[0].to(self.device)
 
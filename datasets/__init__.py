@@ -5,7 +5,9 @@ from .cifar_helper import (
     Cifar20ClusteringDatasetInterface,
     Cifar100ClusteringDatasetInterface,
     cifar10_naive_transform,
-    cifar10_strong_transform
+    cifar10_strong_transform,
+    cifar10_naive_transform_config,
+    cifar10_strong_transform_config
 )
 from .mnist_helper import (
     MNISTClusteringDatasetInterface,
@@ -18,3 +20,5 @@ from .svhn_helper import (
     svhn_naive_transform,
     svhn_strong_transform
 )
+from .eval_cache import EvalTensorCache
+from .rgb_transforms import rgb_transform_config, rgb_transforms
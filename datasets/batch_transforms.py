@@ -0,0 +1,404 @@
+"""
+Batch-aware transforms working on whole uint8 batches with shape (N, H, W, C) or (N, H, W), as returned by the
+batch fetch path of the datasets (`get_batch`). Transforms flagged with `batched = True` are called once per batch,
+the others are applied sample by sample on PIL images.
+"""
+__all__ = ["BatchCompose", "BatchToTensor", "BatchImg2Tensor", "BatchCenterCrop", "BatchRandomCrop",
+           "BatchRandomHorizontalFlip", "BatchStrongAugment", "apply_batch_transform", "batch_collate",
+           "naive_batch_transforms", "strong_batch_transforms"]
+from typing import *
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torch import Tensor
+
+
+def _as_nhwc(images: Tensor) -> Tensor:
+    return images.unsqueeze(3) if images.dim() == 3 else images
+
+
+def _crop_size(size: Union[int, Tuple[int, int]]) -> Tuple[int, int]:
+    return (size, size) if isinstance(size, int) else tuple(size)
+
+
+class BatchCompose:
+    batched = True
+
+    def __init__(self, transforms: List[Callable]) -> None:
+        assert all(getattr(t, "batched", False) for t in transforms), \
+            f"Only batched transforms can be composed, given {transforms}."
+        self.transforms = transforms
+
+    def __call__(self, images: Tensor) -> Tensor:
+        for transform in self.transforms:
+            images = transform(images)
+        return images
+
+    def __repr__(self):
+        return f"BatchCompose({', '.join(repr(t) for t in self.transforms)})"
+
+
+class BatchToTensor:
+    """
+    uint8 (N, H, W[, C]) to float (N, C, H, W) in [0, 1], as `transforms.ToTensor`.
+    """
+    batched = True
+
+    def __call__(self, images: Tensor) -> Tensor:
+        return _as_nhwc(images).permute(0, 3, 1, 2).float().div_(255.0)
+
+    def __repr__(self):
+        return "BatchToTensor()"
+
+
+class BatchImg2Tensor:
+    """
+    batched `pil_augment.Img2Tensor`, the grey channel uses the same fixed-point ITU-R 601-2 luma as PIL.
+    """
+    batched = True
+
+    def __init__(self, include_rgb: bool = False, include_grey: bool = True) -> None:
+        assert include_rgb or include_grey, \
+            f"Options must be True for at least one option, given {include_rgb}, {include_grey}"
+        self.include_rgb = include_rgb
+        self.include_grey = include_grey
+
+    @staticmethod
+    def greyscale(images: Tensor) -> Tensor:
+        """
+        :param images: uint8 (N, H, W, 3)
+        :return: uint8 (N, H, W, 1)
+        """
+        rgb = images.int()
+        grey = (rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16
+        return grey.to(torch.uint8).unsqueeze(3)
+
+    def __call__(self, images: Tensor) -> Tensor:
+        if images.dim() == 3:
+            assert self.include_grey, f"Input grey image, you must set include_grey to be True"
+            return BatchToTensor()(images)
+        assert images.shape[3] == 3, images.shape
+        channels = []
+        if self.include_grey:
+            channels.append(self.greyscale(images))
+        if self.include_rgb:
+            channels.append(images)
+        return BatchToTensor()(torch.cat(channels, dim=3))
+
+    def __repr__(self):
+        return f"BatchImg2Tensor(include_rgb={self.include_rgb}, include_grey={self.include_grey})"
+
+
+class BatchCenterCrop:
+    batched = True
+
+    def __init__(self, size: Union[int, Tuple[int, int]]) -> None:
+        self.size = _crop_size(size)
+
+    def __call__(self, images: Tensor) -> Tensor:
+        h, w = images.shape[1:3]
+        th, tw = self.size
+        top, left = int(round((h - th) / 2.0)), int(round((w - tw) / 2.0))
+        return images[:, top:top + th, left:left + tw]
+
+    def __repr__(self):
+        return f"BatchCenterCrop(size={self.size})"
+
+
+class BatchRandomCrop:
+    """
+    independent random crop of each image, after a zero padding as `transforms.RandomCrop`.
+    """
+    batched = True
+
+    def __init__(self, size: Union[int, Tuple[int, int]], padding: int = 0) -> None:
+        self.size = _crop_size(size)
+        self.padding = padding or 0
+
+    def __call__(self, images: Tensor) -> Tensor:
+        if self.padding > 0:
+            p = self.padding
+            padded = images.new_zeros((images.shape[0], images.shape[1] + 2 * p, images.shape[2] + 2 * p,
+                                       *images.shape[3:]))
+            padded[:, p:-p, p:-p] = images
+            images = padded
+        n, h, w = images.shape[:3]
+        th, tw = self.size
+        assert h >= th and w >= tw, f"Crop size {self.size} larger than the images {(h, w)}."
+        tops = torch.randint(0, h - th + 1, (n, 1))
+        lefts = torch.randint(0, w - tw + 1, (n, 1))
+        rows = (tops + torch.arange(th)).view(n, th, 1)
+        cols = (lefts + torch.arange(tw)).view(n, 1, tw)
+        return images[torch.arange(n).view(n, 1, 1), rows, cols]
+
+    def __repr__(self):
+        return f"BatchRandomCrop(size={self.size}, padding={self.padding})"
+
+
+class BatchRandomHorizontalFlip:
+    batched = True
+
+    def __init__(self, p: float = 0.5) -> None:
+        self.p = p
+
+    def __call__(self, images: Tensor) -> Tensor:
+        flip = (torch.rand(images.shape[0]) < self.p).view(-1, *[1] * (images.dim() - 1))
+        return torch.where(flip, images.flip(2), images)
+
+    def __repr__(self):
+        return f"BatchRandomHorizontalFlip(p={self.p})"
+
+
+def apply_batch_transform(transform: Optional[Callable], images: Tensor) -> Union[Tensor, List[Any]]:
+    """
+    :param transform: batched transform, per-sample PIL transform or None
+    :param images: uint8 batch
+    :return: transformed batch, stacked if the per-sample transform returns tensors
+    """
+    if transform is None:
+        return images
+    if getattr(transform, "batched", False):
+        return transform(images)
+    samples = [transform(Image.fromarray(img)) for img in np.asarray(images)]
+    return torch.stack(samples) if isinstance(samples[0], Tensor) else samples
+
+
+def batch_collate(batch):
+    """
+    the batch fetch path already returns collated batches, they are only returned as lists as `default_collate`.
+    """
+    return [list(view) for view in batch]
+
+
+_cifar_naive = {
+    "tf1": BatchImg2Tensor(include_rgb=False, include_grey=True),
+    "tf2": BatchCompose([
+        BatchRandomHorizontalFlip(p=0.5),
+        BatchRandomCrop(size=(32, 32), padding=2),
+        BatchImg2Tensor(include_rgb=False, include_grey=True),
+    ]),
+    "tf3": BatchImg2Tensor(include_rgb=False, include_grey=True),
+}
+# batched equivalents of the naive transforms, by the dataset names of `main.get_dataloader`
+naive_batch_transforms = {
+    "cifar": _cifar_naive,
+    "cifar20": _cifar_naive,
+    "cifar100": _cifar_naive,
+    "mnist": {
+        "tf1": BatchCompose([BatchCenterCrop((24, 24)), BatchToTensor()]),
+        "tf2": BatchCompose([BatchRandomCrop((24, 24), padding=0), BatchToTensor()]),
+        "tf3": BatchCompose([BatchCenterCrop((24, 24)), BatchToTensor()]),
+    },
+    "svhn": {
+        "tf1": BatchImg2Tensor(),
+        "tf2": BatchCompose([BatchRandomCrop(size=32, padding=2), BatchImg2Tensor()]),
+        "tf3": BatchImg2Tensor(),
+    },
+}
+
+
+# ===================batched strong augmentation===================
+def _quantize(images: Tensor) -> Tensor:
+    # PIL works on uint8, rounding after each operation
+    return images.mul(255.0).round_().div_(255.0)
+
+
+def _grey(images: Tensor) -> Tensor:
+    """
+    :param images: float (N, 3, H, W)
+    :return: float (N, 1, H, W) with the ITU-R 601-2 luma
+    """
+    weights = images.new_tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)
+    return (images * weights).sum(1, keepdim=True)
+
+
+def _rgb_to_hsv(images: Tensor) -> Tensor:
+    r, g, b = images.unbind(1)
+    maxc, _ = images.max(1)
+    minc, _ = images.min(1)
+    delta = maxc - minc
+    s = torch.where(maxc > 0, delta / maxc.clamp(min=1e-12), torch.zeros_like(maxc))
+    safe_delta = torch.where(delta > 0, delta, torch.ones_like(delta))
+    rc, gc, bc = (maxc - r) / safe_delta, (maxc - g) / safe_delta, (maxc - b) / safe_delta
+    h = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = torch.where(delta > 0, (h / 6.0) % 1.0, torch.zeros_like(h))
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def _hsv_to_rgb(images: Tensor) -> Tensor:
+    h, s, v = images.unbind(1)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.long() % 6
+    p, q, t = v * (1.0 - s), v * (1.0 - s * f), v * (1.0 - s * (1.0 - f))
+    candidates = torch.stack((
+        torch.stack((v, q, p, p, t, v), dim=1),
+        torch.stack((t, v, v, q, p, p), dim=1),
+        torch.stack((p, p, t, v, v, q), dim=1),
+    ), dim=1)  # (N, 3, 6, H, W)
+    index = i.unsqueeze(1).unsqueeze(2).expand(-1, 3, 1, -1, -1)
+    return candidates.gather(2, index).squeeze(2)
+
+
+class BatchStrongAugment:
+    """
+    Batched equivalent of the strong PIL pipelines (rotation, random crop, resize, flip, colour jitter and
+    greyscale). Rotation, crop, resize and flip are fused into one `affine_grid`/`grid_sample` per batch, the
+    colour jitter draws its factors per sample and is applied with tensor ops. The jitter operations are applied
+    in a random order drawn per batch, so the distribution of each sample is the one of `ColorJitter`.
+    Input: uint8 (N, H, W[, C]) square images. Output: float (N, C', output_size, output_size) in [0, 1].
+    """
+    batched = True
+
+    def __init__(
+            self,
+            crop_sizes: Union[int, List[int]],
+            output_size: int,
+            center_crop_p: float = 0.0,
+            flip_p: float = 0.0,
+            rotation: float = 0.0,
+            rotation_p: float = 0.0,
+            brightness: Tuple[float, float] = None,
+            contrast: Tuple[float, float] = None,
+            saturation: Tuple[float, float] = None,
+            hue: Tuple[float, float] = None,
+            include_rgb: bool = False,
+            include_grey: bool = True,
+            interpolation: str = "bilinear",
+    ) -> None:
+        """
+        :param crop_sizes: side of the crop, or sides among which one is drawn per sample (`RandomChoice`)
+        :param output_size: side of the resized output
+        :param center_crop_p: probability to take a center crop instead of a random one, 1 for `CenterCrop`
+        :param flip_p: probability of a horizontal flip
+        :param rotation: maximum absolute rotation in degrees, applied with probability `rotation_p`
+        :param brightness: range of the brightness factor, None to disable
+        :param contrast: range of the contrast factor, None to disable
+        :param saturation: range of the saturation factor, None to disable (no effect on grey images)
+        :param hue: range of the hue shift, None to disable (no effect on grey images)
+        :param include_rgb: return the rgb channels
+        :param include_grey: return the grey channel
+        :param interpolation: `bilinear` or `nearest`, the PIL resample of the resize
+        """
+        assert include_rgb or include_grey, \
+            f"Options must be True for at least one option, given {include_rgb}, {include_grey}"
+        assert interpolation in ("bilinear", "nearest"), interpolation
+        self.crop_sizes = [crop_sizes] if isinstance(crop_sizes, int) else list(crop_sizes)
+        self.output_size = output_size
+        self.center_crop_p = center_crop_p
+        self.flip_p = flip_p
+        self.rotation = rotation
+        self.rotation_p = rotation_p
+        self.jitter = {"brightness": brightness, "contrast": contrast, "saturation": saturation, "hue": hue}
+        self.include_rgb = include_rgb
+        self.include_grey = include_grey
+        self.interpolation = interpolation
+
+    def _theta(self, n: int, size: int) -> Tensor:
+        """
+        per-sample affine matrices mapping the output grid to the source image, in normalized coordinates.
+        """
+        crop = torch.tensor(self.crop_sizes, dtype=torch.float)[torch.randint(len(self.crop_sizes), (n,))]
+        assert (crop <= size).all(), f"Crop sizes {self.crop_sizes} larger than the images {size}."
+        # integer offsets as `RandomCrop` and `CenterCrop`
+        random_offset = torch.floor(torch.rand(n, 2) * (size - crop + 1).unsqueeze(1))
+        center_offset = torch.round((size - crop) / 2.0).unsqueeze(1).expand(n, 2)
+        center = (torch.rand(n) < self.center_crop_p).unsqueeze(1)
+        offset = torch.where(center, center_offset, random_offset)  # (top, left)
+        translation = (offset + crop.unsqueeze(1) / 2.0) * 2.0 / size - 1.0
+        scale = crop / size
+        flip = torch.where(torch.rand(n) < self.flip_p, -torch.ones(n), torch.ones(n))
+        crop_matrix = torch.zeros(n, 2, 3)
+        crop_matrix[:, 0, 0] = scale * flip
+        crop_matrix[:, 1, 1] = scale
+        crop_matrix[:, 0, 2] = translation[:, 1]
+        crop_matrix[:, 1, 2] = translation[:, 0]
+        # the rotation is applied on the whole image before the crop, around its center
+        angle = (torch.rand(n) * 2 - 1) * self.rotation * np.pi / 180.0
+        angle = torch.where(torch.rand(n) < self.rotation_p, angle, torch.zeros(n))
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        rotation = torch.stack((torch.stack((cos, -sin), 1), torch.stack((sin, cos), 1)), 1)
+        return torch.bmm(rotation, crop_matrix)
+
+    def _color_jitter(self, images: Tensor) -> Tensor:
+        n, c = images.shape[:2]
+
+        def factor(bounds):
+            return (torch.rand(n, 1, 1, 1) * (bounds[1] - bounds[0]) + bounds[0]).to(images.device)
+
+        operations = [name for name, bounds in self.jitter.items() if bounds is not None
+                      and (c == 3 or name in ("brightness", "contrast"))]
+        for i in torch.randperm(len(operations)).tolist():
+            name, bounds = operations[i], self.jitter[operations[i]]
+            if name == "brightness":
+                images = images * factor(bounds)
+            elif name == "contrast":
+                grey = _grey(images) if c == 3 else images
+                mean = _quantize(grey.mean((1, 2, 3), keepdim=True))
+                images = (images - mean) * factor(bounds) + mean
+            elif name == "saturation":
+                grey = _grey(images)
+                images = (images - grey) * factor(bounds) + grey
+            else:
+                hsv = _rgb_to_hsv(images)
+                hsv[:, 0] = (hsv[:, 0] + factor(bounds).view(n, 1, 1)) % 1.0
+                images = _hsv_to_rgb(hsv)
+            images = _quantize(images.clamp_(0, 1))
+        return images
+
+    def __call__(self, images: Tensor) -> Tensor:
+        images = _as_nhwc(images).permute(0, 3, 1, 2).float().div_(255.0)
+        n, c, h, w = images.shape
+        assert h == w, f"Only square images are supported, given {(h, w)}."
+        theta = self._theta(n, h).to(images.device)
+        grid = F.affine_grid(theta, [n, c, self.output_size, self.output_size], align_corners=False)
+        images = _quantize(F.grid_sample(images, grid, mode=self.interpolation, padding_mode="zeros",
+                                         align_corners=False))
+        if any(bounds is not None for bounds in self.jitter.values()):
+            images = self._color_jitter(images)
+        if c == 1:
+            assert self.include_grey, f"Input grey image, you must set include_grey to be True"
+            return images
+        channels = []
+        if self.include_grey:
+            channels.append(_quantize(_grey(images)))
+        if self.include_rgb:
+            channels.append(images)
+        return torch.cat(channels, dim=1)
+
+    def __repr__(self):
+        return (f"BatchStrongAugment(crop_sizes={self.crop_sizes}, output_size={self.output_size}, "
+                f"center_crop_p={self.center_crop_p}, flip_p={self.flip_p}, rotation={self.rotation}, "
+                f"rotation_p={self.rotation_p}, jitter={self.jitter}, include_rgb={self.include_rgb}, "
+                f"include_grey={self.include_grey}, interpolation={self.interpolation})")
+
+
+_jitter = {"brightness": (0.6, 1.4), "contrast": (0.6, 1.4), "saturation": (0.6, 1.4), "hue": (-0.125, 0.125)}
+_cifar_strong = {
+    "tf1": BatchStrongAugment(20, 32, interpolation="nearest"),
+    "tf2": BatchStrongAugment(20, 32, flip_p=0.5, interpolation="nearest", **_jitter),
+    "tf3": BatchStrongAugment(20, 32, center_crop_p=1.0, interpolation="nearest"),
+}
+# batched equivalents of the strong transforms, selected with `DataLoader.transforms: strong_batched`
+strong_batch_transforms = {
+    "cifar": _cifar_strong,
+    "cifar20": _cifar_strong,
+    "cifar100": _cifar_strong,
+    "mnist": {
+        "tf1": BatchStrongAugment(20, 24, center_crop_p=0.5),
+        "tf2": BatchStrongAugment([16, 20, 24], 24, rotation=25.0, rotation_p=0.5, **_jitter),
+        "tf3": BatchStrongAugment(20, 24, center_crop_p=1.0),
+    },
+    "svhn": {
+        "tf1": BatchStrongAugment(28, 32, center_crop_p=1.0),
+        "tf2": BatchStrongAugment([20, 24, 28], 32, rotation=25.0, rotation_p=0.5, **_jitter),
+        "tf3": BatchStrongAugment(28, 32, center_crop_p=1.0),
+    },
+    "stl10": {
+        "tf1": BatchStrongAugment(64, 64, interpolation="nearest"),
+        "tf2": BatchStrongAugment(64, 64, flip_p=0.5, interpolation="nearest", **_jitter),
+        "tf3": BatchStrongAugment(64, 64, center_crop_p=1.0, interpolation="nearest"),
+    },
+}
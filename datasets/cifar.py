@@ -13,15 +13,18 @@ else:
     import pickle
 
 import torch.utils.data as data
-from .utils import download_url, check_integrity
+from .dataset import RawBatchMixin
+from .npy_format import NPY_FOLDER, load_npy
+from .utils import download_url, check_integrity, load_raw_arrays
 
 
-class CIFAR10(data.Dataset):
+class CIFAR10(RawBatchMixin, data.Dataset):
     """`CIFAR10 <https://www.cs.toronto.edu/~kriz/cifar.html>`_ Dataset.
 
     Args:
         root (string): Root directory of dataset where directory
             ``cifar-10-batches-py`` exists or will be saved to if download is set to True.
+            If the split has been converted under ``npy/cifar10``, the memory-mapped arrays are used instead.
         train (bool, optional): If True, creates dataset from training set, otherwise
             creates from test set.
         transform (callable, optional): A function/transform that takes in an PIL image
@@ -31,10 +34,13 @@ class CIFAR10(data.Dataset):
         download (bool, optional): If true, downloads the dataset from the internet and
             puts it in root directory. If dataset is already downloaded, it is not
             downloaded again.
+        verify (string, optional): One of {'never', 'once', 'always'}, how often the MD5 checksums
+            of the files are verified. See ``utils.VERIFY_MODES``.
 
     """
 
     base_folder = "cifar-10-batches-py"
+    npy_name = "cifar10"
     url = "https://www.cs.toronto.edu/~kriz/cifar-10-python.tar.gz"
     filename = "cifar-10-python.tar.gz"
     tgz_md5 = "c58f30108f718f92721af3b95e74349a"
@@ -54,12 +60,18 @@ class CIFAR10(data.Dataset):
     }
 
     def __init__(
-            self, root, train=True, transform=None, target_transform=None, download=False
+            self, root, train=True, transform=None, target_transform=None, download=False, verify="always"
     ):
         self.root = os.path.expanduser(root)
         self.transform = transform
         self.target_transform = target_transform
         self.train = train  # training set or test set
+        self.verify = verify
+        self.debug: bool = os.environ.get("PYDEBUG", False) == "1"
+
+        # converted arrays are used when present, no original file is read then.
+        if self._load_converted():
+            return
 
         if download:
             self.download()
@@ -75,8 +87,31 @@ class CIFAR10(data.Dataset):
         else:
             downloaded_list = self.test_list
 
-        self.data = []
-        self.targets = []
+        # the arrays are shared with the other datasets reading the same files
+        self.data, self.targets = load_raw_arrays(
+            (self.base_folder, self.root, self.train), lambda: self._load_data(downloaded_list)
+        )
+
+        self._load_meta()
+
+    def _load_converted(self):
+        """
+        :return: True if the memory-mapped arrays of `npy_format` have been loaded
+        """
+        split = "train" if self.train else "test"
+        converted = load_raw_arrays(
+            (NPY_FOLDER, self.npy_name, self.root, split), lambda: load_npy(self.root, self.npy_name, split)
+        )
+        if converted is None:
+            return False
+        self.data, self.targets, meta = converted
+        self.classes = meta["classes"]
+        self.class_to_idx = {_class: i for i, _class in enumerate(self.classes)}
+        return True
+
+    def _load_data(self, downloaded_list):
+        data = []
+        targets = []
 
         # now load the picked numpy arrays
         for file_name, checksum in downloaded_list:
@@ -86,22 +121,19 @@ class CIFAR10(data.Dataset):
                     entry = pickle.load(f)
                 else:
                     entry = pickle.load(f, encoding="latin1")
-                self.data.append(entry["data"])
+                data.append(entry["data"])
                 if "labels" in entry:
-                    self.targets.extend(entry["labels"])
+                    targets.extend(entry["labels"])
                 else:
-                    self.targets.extend(entry["fine_labels"])
+                    targets.extend(entry["fine_labels"])
 
-        self.data = np.vstack(self.data).reshape(-1, 3, 32, 32)
-        self.data = self.data.transpose((0, 2, 3, 1))  # convert to HWC
-
-        self._load_meta()
-
-        self.debug: bool = os.environ.get("PYDEBUG", False) == "1"
+        data = np.vstack(data).reshape(-1, 3, 32, 32)
+        data = data.transpose((0, 2, 3, 1))  # convert to HWC
+        return data, np.asarray(targets, dtype=np.int64)
 
     def _load_meta(self):
         path = os.path.join(self.root, self.base_folder, self.meta["filename"])
-        if not check_integrity(path, self.meta["md5"]):
+        if not check_integrity(path, self.meta["md5"], verify=self.verify):
             raise RuntimeError(
                 "Dataset metadata file not found or corrupted."
                 + " You can use download=True to download it"
@@ -120,9 +152,9 @@ class CIFAR10(data.Dataset):
             index (int): Index
 
         Returns:
-            tuple: (image, target) where target is index of the target class.
+            tuple: (image, target, index) where target is index of the target class.
         """
-        img, target = self.data[index], self.targets[index]
+        img, target = self.data[index], int(self.targets[index])
 
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
@@ -134,7 +166,7 @@ class CIFAR10(data.Dataset):
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        return img, target
+        return img, target, index
 
     def __len__(self):
         if self.debug:
@@ -146,7 +178,7 @@ class CIFAR10(data.Dataset):
         for fentry in self.train_list + self.test_list:
             filename, md5 = fentry[0], fentry[1]
             fpath = os.path.join(root, self.base_folder, filename)
-            if not check_integrity(fpath, md5):
+            if not check_integrity(fpath, md5, verify=self.verify):
                 return False
         return True
 
@@ -187,6 +219,7 @@ class CIFAR100(CIFAR10):
     """
 
     base_folder = "cifar-100-python"
+    npy_name = "cifar100"
     url = "https://www.cs.toronto.edu/~kriz/cifar-100-python.tar.gz"
     filename = "cifar-100-python.tar.gz"
     tgz_md5 = "eb9058c3a382ffc7106e4002c42a8d85"
@@ -203,8 +236,8 @@ class CIFAR100(CIFAR10):
 # add cifar20 as one derive of cifar100
 class CIFAR20(CIFAR100):
 
-    def __init__(self, root, train=True, transform=None, target_transform=None, download=False):
-        super().__init__(root, train, transform, _cifar100_to_cifar20, download)
+    def __init__(self, root, train=True, transform=None, target_transform=None, download=False, verify="always"):
+        super().__init__(root, train, transform, _cifar100_to_cifar20, download, verify)
 
 
 def _cifar100_to_cifar20(target):
@@ -1,7 +1,7 @@
 __all__ = ["Cifar10ClusteringDatasetInterface", "Cifar10SemiSupervisedDatasetInterface",
            "Cifar20ClusteringDatasetInterface", "Cifar100ClusteringDatasetInterface",
            "cifar10_naive_transform",
-           "cifar10_strong_transform"]
+           "cifar10_strong_transform", "cifar10_naive_transform_config", "cifar10_strong_transform_config"]
 from functools import reduce
 from typing import *
 
@@ -28,6 +28,9 @@ class Cifar10ClusteringDatasetInterface(ClusterDatasetInterface):
             shuffle: bool = False,
             num_workers: int = 1,
             pin_memory: bool = True,
+            verify: str = "once",
+            batch_fetch: bool = False,
+            distributed: bool = False,
     ) -> None:
         super().__init__(
             CIFAR10,
@@ -37,6 +40,9 @@ class Cifar10ClusteringDatasetInterface(ClusterDatasetInterface):
             shuffle,
             num_workers,
             pin_memory,
+            verify=verify,
+            batch_fetch=batch_fetch,
+            distributed=distributed,
         )
 
     def _creat_concatDataset(
@@ -58,6 +64,7 @@ class Cifar10ClusteringDatasetInterface(ClusterDatasetInterface):
                 transform=image_transform,
                 target_transform=target_transform,
                 download=True,
+                verify=self.verify,
                 **dataset_dict,
             )
             _datasets.append(dataset)
@@ -114,8 +121,10 @@ class Cifar10SemiSupervisedDatasetInterface(SemiDatasetInterface):
 class Cifar20ClusteringDatasetInterface(Cifar10ClusteringDatasetInterface):
 
     def __init__(self, data_root=None, split_partitions: List[str] = ["train", "val"], batch_size: int = 1,
-                 shuffle: bool = False, num_workers: int = 1, pin_memory: bool = True) -> None:
-        super().__init__(data_root, split_partitions, batch_size, shuffle, num_workers, pin_memory)
+                 shuffle: bool = False, num_workers: int = 1, pin_memory: bool = True, verify: str = "once",
+                 batch_fetch: bool = False, distributed: bool = False) -> None:
+        super().__init__(data_root, split_partitions, batch_size, shuffle, num_workers, pin_memory, verify,
+                         batch_fetch, distributed)
         self.DataClass = CIFAR20  # replace that for cifar20
 
 
@@ -123,8 +132,10 @@ class Cifar20ClusteringDatasetInterface(Cifar10ClusteringDatasetInterface):
 class Cifar100ClusteringDatasetInterface(Cifar10ClusteringDatasetInterface):
 
     def __init__(self, data_root=None, split_partitions: List[str] = ["train", "val"], batch_size: int = 1,
-                 shuffle: bool = False, num_workers: int = 1, pin_memory: bool = True) -> None:
-        super().__init__(data_root, split_partitions, batch_size, shuffle, num_workers, pin_memory)
+                 shuffle: bool = False, num_workers: int = 1, pin_memory: bool = True, verify: str = "once",
+                 batch_fetch: bool = False, distributed: bool = False) -> None:
+        super().__init__(data_root, split_partitions, batch_size, shuffle, num_workers, pin_memory, verify,
+                         batch_fetch, distributed)
         self.DataClass = CIFAR100  # replace that for cifar100
 
 
@@ -197,4 +208,8 @@ cifar10_strong_transform = {}
 
 for k, v in strong_transform_dict.items():
     cifar10_strong_transform[k] = TransformInterface(v)
+
+# configurations of the interfaces above, hashed by the evaluation cache
+cifar10_naive_transform_config = basic_transform_dict
+cifar10_strong_transform_config = strong_transform_dict
 # =================================================================
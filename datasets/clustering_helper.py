@@ -2,9 +2,12 @@ from abc import abstractmethod
 from itertools import repeat
 from typing import *
 
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
 
 from . import dataset
+from .batch_transforms import batch_collate
+from .utils import VERIFY_MODES
 
 
 class ClusterDatasetInterface(object):
@@ -24,11 +27,20 @@ class ClusterDatasetInterface(object):
         num_workers: int = 1,
         pin_memory: bool = True,
         drop_last=False,
+        verify: str = "once",
+        batch_fetch: bool = False,
+        distributed: bool = False,
     ) -> None:
         """
         :param batch_size: batch_size = 1
         :param shuffle: shuffle the dataset, default = False
         :param num_workers: default 1
+        :param verify: `never`, `once` or `always`, how often the MD5 checksums of the dataset files are verified
+        :param batch_fetch: gather each batch with a single index of the raw arrays and run the batched transforms
+        on the whole batch, instead of fetching and transforming the samples one by one.
+        :param distributed: load the shard of the current rank of `torch.distributed`. Shuffled loaders use a
+        `DistributedSampler`, whose shards are padded to the same length so that all the ranks run the same number of
+        steps; sequential loaders (evaluation) use `UnpaddedDistributedSampler` so that each sample is seen once.
         """
         super().__init__()
         self.DataClass = DataClass
@@ -44,6 +56,10 @@ class ClusterDatasetInterface(object):
         self.pin_memory = pin_memory
         self.drop_last = drop_last
         self.data_root = data_root
+        assert verify in VERIFY_MODES, f"`verify` should be in {VERIFY_MODES}, given {verify}."
+        self.verify = verify
+        self.batch_fetch = batch_fetch
+        self.distributed = distributed
 
     @abstractmethod
     def _creat_concatDataset(
@@ -75,6 +91,14 @@ class ClusterDatasetInterface(object):
             target_transform = repeat(target_transform)
         else:
             assert len(image_transforms) == len(target_transform)
+        if isinstance(target_transform, repeat):
+            # the views only differ by their image transform: the raw sample is read once and transformed N times.
+            rawSet = self._creat_concatDataset(
+                image_transform=None,
+                target_transform=next(target_transform),
+                dataset_dict=dataset_dict,
+            )
+            return dataset.ParallelTransformDataset(rawSet, *image_transforms)
         concatSets = []
         for t_img, t_tar in zip(image_transforms, target_transform):
             concatSets.append(
@@ -126,13 +150,36 @@ class ClusterDatasetInterface(object):
         parallel_set = self._creat_combineDataset(
             image_transforms, target_transform, dataset_dict
         )
+        if self.batch_fetch and isinstance(parallel_set, dataset.ParallelTransformDataset) \
+                and dataset.supports_batch_fetch(parallel_set.dataset):
+            # the sampler hands the list of indices of a batch to the dataset, which returns it already collated.
+            sampler = self._sampler(parallel_set) or \
+                      (RandomSampler(parallel_set) if self.shuffle else SequentialSampler(parallel_set))
+            return DataLoader(
+                parallel_set,
+                batch_size=None,
+                sampler=BatchSampler(sampler, self.batch_size, self.drop_last),
+                num_workers=self.num_workers,
+                pin_memory=self.pin_memory,
+                collate_fn=batch_collate,
+                **dataloader_dict,
+            )
+        sampler = self._sampler(parallel_set)
         parallel_loader = DataLoader(
             parallel_set,
             batch_size=self.batch_size,
-            shuffle=self.shuffle,
+            shuffle=self.shuffle if sampler is None else False,
+            sampler=sampler,
             num_workers=self.num_workers,
             drop_last=self.drop_last,
             pin_memory=self.pin_memory,
             **dataloader_dict,
         )
         return parallel_loader
+
+    def _sampler(self, parallel_set: Dataset) -> Optional[DistributedSampler]:
+        if not self.distributed:
+            return None
+        if self.shuffle:
+            return DistributedSampler(parallel_set, shuffle=True)
+        return dataset.UnpaddedDistributedSampler(parallel_set)
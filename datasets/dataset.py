@@ -1,8 +1,14 @@
 import bisect
 import warnings
 
+import numpy as np
+import torch
 from torch import randperm
 from torch._utils import _accumulate
+from torch.utils.data import BatchSampler
+from torch.utils.data.distributed import DistributedSampler
+
+from .batch_transforms import apply_batch_transform
 
 
 class Dataset(object):
@@ -107,6 +113,122 @@ class CombineDataset(Dataset):
         return min(len(d) for d in self.datasets)
 
 
+class RawBatchMixin:
+    """
+    Batch fetch of the raw uint8 images with a single fancy-index, for the datasets holding their images in
+    `self.data` and their labels in the `_label_attr` attribute.
+    """
+    _label_attr = "targets"
+
+    def get_raw_batch(self, indices):
+        """
+        :param indices: sequence of sample indices
+        :return: uint8 images with shape (N, H, W[, C]), LongTensor targets and LongTensor indices
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        images = _take(self.data, indices)
+        targets = _take(getattr(self, self._label_attr), indices)
+        if self.target_transform is not None:
+            targets = [self.target_transform(int(t)) for t in targets]
+        targets = torch.as_tensor(np.asarray(targets, dtype=np.int64))
+        return images, targets, torch.from_numpy(indices)
+
+
+def _take(array, indices):
+    if isinstance(array, torch.Tensor):
+        return array[torch.from_numpy(indices)]
+    return torch.from_numpy(np.ascontiguousarray(np.asarray(array)[indices]))
+
+
+def fetch_raw_batch(dataset, indices):
+    """
+    gather a raw batch from a dataset supporting `get_raw_batch`, or from a concatenation of such datasets.
+    """
+    if hasattr(dataset, "get_raw_batch"):
+        return dataset.get_raw_batch(indices)
+    assert hasattr(dataset, "cumulative_sizes"), f"{dataset.__class__.__name__} does not support batch fetch."
+    indices = np.asarray(indices, dtype=np.int64)
+    # vectorized bisect, as in `ConcatDataset.__getitem__`
+    dataset_indices = np.searchsorted(dataset.cumulative_sizes, indices, side="right")
+    offsets = np.concatenate([[0], dataset.cumulative_sizes[:-1]])
+    parts, positions = [], []
+    for d in np.unique(dataset_indices):
+        position = np.nonzero(dataset_indices == d)[0]
+        parts.append(fetch_raw_batch(dataset.datasets[d], indices[position] - offsets[d]))
+        positions.append(position)
+    order = torch.from_numpy(np.argsort(np.concatenate(positions), kind="stable"))
+    return tuple(torch.cat(fields, dim=0)[order] for fields in zip(*parts))
+
+
+def supports_batch_fetch(dataset) -> bool:
+    if hasattr(dataset, "get_raw_batch"):
+        return True
+    return hasattr(dataset, "cumulative_sizes") and all(supports_batch_fetch(d) for d in dataset.datasets)
+
+
+class ParallelTransformDataset(Dataset):
+    """
+    Read each raw sample once from a dataset built without image transform and return one view per image
+    transform, in the same format as a `CombineDataset` of datasets differing only by their image transform.
+    Indexed by a list of indices, a whole batch is gathered at once, see `get_batch`.
+    The index returned with each sample is its position in this dataset, so that it stays unique when several splits
+    are concatenated.
+    """
+
+    def __init__(self, dataset, *image_transforms):
+        self.dataset = dataset
+        self.transforms = image_transforms
+
+    def get_batch(self, indices):
+        """
+        :param indices: list of indices given by a `BatchSampler`
+        :return: one (images, targets, ...) tuple of batches per view
+        """
+        images, target, *_ = fetch_raw_batch(self.dataset, indices)
+        others = (target, torch.as_tensor(np.asarray(indices, dtype=np.int64)))
+        return [(apply_batch_transform(transform, images), *others) for transform in self.transforms]
+
+    def __getitem__(self, i):
+        if isinstance(i, (list, tuple, np.ndarray, torch.Tensor)):
+            return self.get_batch(i)
+        img, target, *_ = self.dataset[i]
+        others = (target, i)
+        return tuple(
+            (img if transform is None else transform(img), *others)
+            for transform in self.transforms
+        )
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class UnpaddedDistributedSampler(DistributedSampler):
+    """
+    Sequential `DistributedSampler` without the padding of the shards, so that each sample is seen exactly once over
+    all the ranks, as needed by the evaluation. The shards may differ by one sample.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=False)
+        self.num_samples = len(range(self.rank, len(self.dataset), self.num_replicas))
+        self.total_size = len(self.dataset)
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.num_replicas))
+
+
+def loader_num_samples(loader) -> int:
+    """
+    :return: number of samples iterated by `loader`, the size of its shard for a `DistributedSampler`.
+    """
+    sampler = loader.sampler
+    if isinstance(sampler, BatchSampler):
+        sampler = sampler.sampler
+    if isinstance(sampler, DistributedSampler):
+        return len(sampler)
+    return len(loader.dataset)
+
+
 class Subset(Dataset):
     """
     Subset of a dataset at specified indices.
@@ -0,0 +1,213 @@
+__all__ = ["EvalTensorCache"]
+import hashlib
+import json
+import warnings
+from pathlib import Path
+from typing import *
+
+import numpy as np
+import torch
+from deepclustering.utils import tqdm_
+from torch import Tensor
+from torch.utils.data import DataLoader, Dataset
+
+from .dataset import loader_num_samples
+
+
+def _describe(obj: Any, _seen: Set[int] = None) -> Any:
+    """
+    JSON-able description of a transform from its parameters rather than its `repr`, which for many transforms is
+    only the class name. Functions are described by their name and the values captured by their closure.
+    """
+    _seen = set() if _seen is None else _seen
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return [_describe(o, _seen) for o in obj]
+    if isinstance(obj, dict):
+        return {str(k): _describe(v, _seen) for k, v in sorted(obj.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(obj, (Tensor, np.ndarray)):
+        array = obj.cpu().numpy() if isinstance(obj, Tensor) else obj
+        return {"array": hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest(), "shape": list(array.shape)}
+    if id(obj) in _seen:
+        return "<cycle>"
+    _seen.add(id(obj))
+    name = f"{getattr(obj, '__module__', '')}.{getattr(obj, '__qualname__', type(obj).__qualname__)}"
+    if callable(obj) and hasattr(obj, "__code__"):
+        cells = [c.cell_contents for c in (getattr(obj, "__closure__", None) or ())]
+        return {"function": name, "closure": _describe(cells, _seen)}
+    if isinstance(obj, type) or not hasattr(obj, "__dict__"):
+        return name if isinstance(obj, type) else f"{type(obj).__module__}.{type(obj).__qualname__}:{obj}"
+    return {"class": f"{type(obj).__module__}.{type(obj).__qualname__}",
+            "params": _describe({k: v for k, v in vars(obj).items() if not k.startswith("_")}, _seen)}
+
+
+def _collect_transforms(dataset: Dataset) -> List[Any]:
+    """
+    walk through the Combine/Concat datasets to find the image and target transforms of the underlying datasets.
+    """
+    found = []
+    for attr in ("transform", "target_transform", "transforms"):
+        if hasattr(dataset, attr):
+            found.append({attr: _describe(getattr(dataset, attr))})
+    for attr in ("datasets", "dataset"):
+        children = getattr(dataset, attr, None)
+        if children is None:
+            continue
+        if not isinstance(children, (list, tuple)):
+            children = [children]
+        for child in children:
+            found.extend(_collect_transforms(child))
+    return found
+
+
+class _CachedTensorDataset(Dataset):
+    """
+    dataset indexed by slices over the cached images and targets, returning the tf3 view in the
+    `[(images, targets)]` format of the `ParallelDataLoader`.
+    """
+
+    def __init__(self, images: Union[Tensor, np.ndarray], targets: Union[Tensor, np.ndarray], scale: float) -> None:
+        self.images = images
+        self.targets = targets
+        self.scale = scale
+
+    def __getitem__(self, index: slice):
+        images, targets = self.images[index], self.targets[index]
+        if isinstance(images, np.ndarray):
+            # copy the memory-mapped slice into a writable array
+            images, targets = torch.from_numpy(np.array(images)), torch.from_numpy(np.array(targets))
+        images = images.float()
+        if self.scale != 1.0:
+            images = images.div_(self.scale)
+        return [(images, targets.long())]
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def _identity_collate(batch):
+    return batch
+
+
+class EvalTensorCache:
+    """
+    Materialize the deterministic validation transform (tf3) of a `val_loader` once, together with the targets,
+    so that later evaluations read the transformed tensors directly in large batches instead of decoding and
+    transforming the images again.
+    Images are stored as uint8 when the transform output is an exact multiple of 1/255 and as float16 otherwise.
+    With `cache_dir`, the arrays are saved as `.npy` files named after a hash of the dataset and the transform
+    configuration and are memory-mapped; they are rebuilt as soon as the transform configuration changes.
+    """
+
+    def __init__(
+            self,
+            val_loader: DataLoader,
+            cache_dir: Union[str, Path] = None,
+            dtype: str = "uint8",
+            batch_size: int = 1000,
+            name: str = None,
+            transform_config: Any = None,
+    ) -> None:
+        """
+        :param val_loader: validation loader with a deterministic transform
+        :param cache_dir: directory to save memory-mapped arrays, None to keep the cache in memory
+        :param dtype: `uint8` or `float16`
+        :param batch_size: batch size of the cached loader
+        :param name: prefix of the cache files, by default `val_loader.dataset_name`
+        :param transform_config: configuration the tf3 transform is built from, such as the dictionary given to
+        `TransformInterface`. By default, the parameters of the transforms found in the dataset are hashed.
+        """
+        assert dtype in ("uint8", "float16"), f"`dtype` should be `uint8` or `float16`, given {dtype}."
+        assert batch_size >= 1, batch_size
+        self.val_loader = val_loader
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.dtype = dtype
+        self.batch_size = batch_size
+        self.name = name or getattr(val_loader, "dataset_name", "dataset")
+        self.transform_config = transform_config
+        self.images: Union[Tensor, np.ndarray, None] = None
+        self.targets: Union[Tensor, np.ndarray, None] = None
+        self.scale = 1.0
+
+    @property
+    def signature(self) -> str:
+        """
+        hash of the dataset size, the transform configuration and the storage dtype, used to invalidate the cache.
+        """
+        dataset = self.val_loader.dataset
+        transforms = _describe(self.transform_config) if self.transform_config is not None \
+            else _collect_transforms(dataset)
+        content = json.dumps([self.name, len(dataset), self.dtype, transforms], sort_keys=True)
+        return hashlib.sha1(content.encode()).hexdigest()[:16]
+
+    def _paths(self) -> Tuple[Path, Path, Path]:
+        prefix = f"{self.name}_{self.signature}"
+        return (self.cache_dir / f"{prefix}_images.npy", self.cache_dir / f"{prefix}_targets.npy",
+                self.cache_dir / f"{prefix}_scale.npy")
+
+    def _load(self) -> bool:
+        if self.cache_dir is None:
+            return False
+        image_path, target_path, scale_path = self._paths()
+        if not (image_path.exists() and target_path.exists() and scale_path.exists()):
+            return False
+        self.images = np.load(str(image_path), mmap_mode="r")
+        self.targets = np.load(str(target_path), mmap_mode="r")
+        self.scale = float(np.load(str(scale_path)))
+        return True
+
+    def _materialize(self) -> None:
+        images, targets = [], []
+        loader = tqdm_(self.val_loader)
+        loader.set_description(f"Caching {self.name} evaluation tensors")
+        for image_labels in loader:
+            img, gt, *_ = list(zip(*image_labels))
+            images.append(img[0])
+            targets.append(gt[0])
+        images, targets = torch.cat(images, dim=0), torch.cat(targets, dim=0).long()
+        assert len(targets) == loader_num_samples(self.val_loader), \
+            "The evaluation cache must cover the whole dataset, or the whole shard of a distributed loader."
+        self.scale = 1.0
+        if self.dtype == "uint8":
+            quantized = (images * 255.0).round_()
+            if images.min() >= 0 and images.max() <= 1 and torch.equal(quantized / 255.0, images):
+                images, self.scale = quantized.to(torch.uint8), 255.0
+            else:
+                warnings.warn(f"The transform output of {self.name} is not representable in uint8, "
+                              f"using float16 for the evaluation cache.", RuntimeWarning)
+                images = images.half()
+        else:
+            images = images.half()
+        self.images, self.targets = images, targets
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            image_path, target_path, scale_path = self._paths()
+            np.save(str(image_path), images.numpy())
+            np.save(str(target_path), targets.numpy())
+            np.save(str(scale_path), np.asarray(self.scale))
+            self._load()
+
+    def build(self) -> "EvalTensorCache":
+        if self.images is None and not self._load():
+            self._materialize()
+        return self
+
+    def CachedDataLoader(self, pin_memory: bool = None) -> DataLoader:
+        """
+        :param pin_memory: defaults to the setting of the original `val_loader`
+        :return: DataLoader reading sequential slices of the cache, compatible with `_eval_loop`
+        """
+        self.build()
+        num_samples = len(self.targets)
+        slices = [slice(i, min(i + self.batch_size, num_samples)) for i in range(0, num_samples, self.batch_size)]
+        cached_loader = DataLoader(
+            _CachedTensorDataset(self.images, self.targets, self.scale),
+            batch_size=None,
+            sampler=slices,
+            num_workers=0,
+            collate_fn=_identity_collate,
+            pin_memory=self.val_loader.pin_memory if pin_memory is None else pin_memory,
+        )
+        setattr(cached_loader, "dataset_name", getattr(self.val_loader, "dataset_name", self.name))
+        return cached_loader
@@ -11,15 +11,18 @@ import torch
 import torch.utils.data as data
 from PIL import Image
 
-from .utils import download_url, makedir_exist_ok
+from .dataset import RawBatchMixin
+from .npy_format import NPY_FOLDER, load_npy
+from .utils import download_url, makedir_exist_ok, load_raw_arrays
 
 
-class MNIST(data.Dataset):
+class MNIST(RawBatchMixin, data.Dataset):
     """`MNIST <http://yann.lecun.com/exdb/mnist/>`_ Dataset.
 
     Args:
         root (string): Root directory of dataset where ``processed/training.pt``
-            and  ``processed/test.pt`` exist.
+            and  ``processed/test.pt`` exist. If the split has been converted under ``npy/mnist``,
+            the memory-mapped arrays are used instead.
         train (bool, optional): If True, creates dataset from ``training.pt``,
             otherwise from ``test.pt``.
         download (bool, optional): If true, downloads the dataset from the internet and
@@ -29,6 +32,8 @@ class MNIST(data.Dataset):
             and returns a transformed version. E.g, ``transforms.RandomCrop``
         target_transform (callable, optional): A function/transform that takes in the
             target and transforms it.
+        verify (string, optional): Kept for the same interface as the other datasets, MNIST files
+            are not checksummed.
     """
 
     urls = [
@@ -37,6 +42,7 @@ class MNIST(data.Dataset):
         "http://yann.lecun.com/exdb/mnist/t10k-images-idx3-ubyte.gz",
         "http://yann.lecun.com/exdb/mnist/t10k-labels-idx1-ubyte.gz",
     ]
+    npy_name = "mnist"
     training_file = "training.pt"
     test_file = "test.pt"
     classes = [
@@ -73,12 +79,22 @@ class MNIST(data.Dataset):
         return self.data
 
     def __init__(
-            self, root, train=True, transform=None, target_transform=None, download=False
+            self, root, train=True, transform=None, target_transform=None, download=False, verify="always"
     ):
         self.root = os.path.expanduser(root)
         self.transform = transform
         self.target_transform = target_transform
         self.train = train  # training set or test set
+        self.debug: bool = os.environ.get("PYDEBUG", False) == "1"
+
+        # converted arrays are used when present, no original file is read then.
+        split = "train" if self.train else "test"
+        converted = load_raw_arrays(
+            (NPY_FOLDER, self.npy_name, self.root, split), lambda: load_npy(self.root, self.npy_name, split)
+        )
+        if converted is not None:
+            self.data, self.targets, _ = converted
+            return
 
         if download:
             self.download()
@@ -92,10 +108,9 @@ class MNIST(data.Dataset):
             data_file = self.training_file
         else:
             data_file = self.test_file
-        self.data, self.targets = torch.load(
-            os.path.join(self.processed_folder, data_file)
-        )
-        self.debug: bool = os.environ.get("PYDEBUG", False) == "1"
+        # the tensors are shared with the other datasets reading the same file
+        data_path = os.path.join(self.processed_folder, data_file)
+        self.data, self.targets = load_raw_arrays(data_path, lambda: torch.load(data_path))
 
     def __getitem__(self, index):
         """
@@ -103,13 +118,13 @@ class MNIST(data.Dataset):
             index (int): Index
 
         Returns:
-            tuple: (image, target) where target is index of the target class.
+            tuple: (image, target, index) where target is index of the target class.
         """
         img, target = self.data[index], int(self.targets[index])
 
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
-        img = Image.fromarray(img.numpy(), mode="L")
+        img = Image.fromarray(np.asarray(img), mode="L")
 
         if self.transform is not None:
             img = self.transform(img)
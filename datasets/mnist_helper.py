@@ -29,6 +29,9 @@ class MNISTClusteringDatasetInterface(ClusterDatasetInterface):
             num_workers: int = 1,
             pin_memory: bool = True,
             drop_last=False,
+            verify: str = "once",
+            batch_fetch: bool = False,
+            distributed: bool = False,
     ) -> None:
         super().__init__(
             MNIST,
@@ -39,6 +42,9 @@ class MNISTClusteringDatasetInterface(ClusterDatasetInterface):
             num_workers,
             pin_memory,
             drop_last,
+            verify=verify,
+            batch_fetch=batch_fetch,
+            distributed=distributed,
         )
 
     def _creat_concatDataset(
@@ -60,6 +66,7 @@ class MNISTClusteringDatasetInterface(ClusterDatasetInterface):
                 transform=image_transform,
                 target_transform=target_transform,
                 download=True,
+                verify=self.verify,
                 **dataset_dict,
             )
             _datasets.append(dataset)
@@ -0,0 +1,54 @@
+"""
+Flat on-disk format of the datasets: contiguous HWC uint8 images saved as `.npy` and opened memory-mapped, so that
+the dataloader workers share the OS page cache and no container has to be parsed at startup.
+Layout: `<root>/npy/<name>/<split>_images.npy`, `<split>_labels.npy` and `<split>_meta.json`.
+"""
+import json
+import os
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+NPY_FOLDER = "npy"
+
+
+def npy_paths(root: str, name: str, split: str) -> Tuple[str, str, str]:
+    folder = os.path.join(os.path.expanduser(root), NPY_FOLDER, name)
+    return (
+        os.path.join(folder, f"{split}_images.npy"),
+        os.path.join(folder, f"{split}_labels.npy"),
+        os.path.join(folder, f"{split}_meta.json"),
+    )
+
+
+def load_npy(root: str, name: str, split: str) -> Optional[Tuple[np.ndarray, np.ndarray, Dict[str, Any]]]:
+    """
+    :return: memory-mapped images, labels and metadata, or None if the split has not been converted.
+    """
+    image_path, label_path, meta_path = npy_paths(root, name, split)
+    if not (os.path.isfile(image_path) and os.path.isfile(label_path) and os.path.isfile(meta_path)):
+        return None
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    images = np.load(image_path, mmap_mode="r")
+    labels = np.load(label_path)
+    assert images.shape[0] == labels.shape[0] == meta["num_samples"], \
+        f"Corrupted {name}/{split} conversion, given {images.shape[0]} images and {labels.shape[0]} labels."
+    return images, labels, meta
+
+
+def save_npy(root: str, name: str, split: str, images: np.ndarray, labels: np.ndarray, **meta) -> None:
+    """
+    :param images: uint8 images with shape (N, H, W, C) or (N, H, W)
+    :param labels: integer labels with shape (N,)
+    :param meta: json serializable metadata such as the class names
+    """
+    assert images.dtype == np.uint8 and images.ndim in (3, 4), (images.dtype, images.shape)
+    assert images.shape[0] == labels.shape[0], (images.shape, labels.shape)
+    image_path, label_path, meta_path = npy_paths(root, name, split)
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    # the metadata is written last, a split is only used once it is present
+    np.save(image_path, np.ascontiguousarray(images))
+    np.save(label_path, np.asarray(labels, dtype=np.int64))
+    with open(meta_path, "w") as f:
+        json.dump({"num_samples": int(images.shape[0]), "shape": list(images.shape[1:]), **meta}, f)
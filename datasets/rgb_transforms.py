@@ -0,0 +1,47 @@
+"""
+RGB variants of the tf1, tf2 and tf3 transforms, for the networks converting the images to grey themselves
+(`Trainer.fold_sobel`, see `trainer/prefilter.py`): the `Img2Tensor` outputs keep the three colour channels instead
+of the grey one, other transforms are unchanged.
+"""
+__all__ = ["rgb_transform_config", "rgb_transforms"]
+import copy
+from typing import *
+
+from deepclustering.augment import TransformInterface
+
+_RGB_OUTPUT = {"include_rgb": True, "include_grey": False}
+
+
+def rgb_transform_config(transform_config: Dict[str, dict]) -> Dict[str, dict]:
+    """
+    :param transform_config: configuration of a `TransformInterface`, such as `basic_transform_dict["tf1"]`
+    :return: the same configuration with RGB `Img2Tensor` outputs
+    """
+    return {name: {**params, **_RGB_OUTPUT} if name.lower() == "img2tensor" else params
+            for name, params in transform_config.items()}
+
+
+def _switch_to_rgb(transform: Callable) -> None:
+    # `Img2Tensor`, `BatchImg2Tensor` and `BatchStrongAugment` share the `include_rgb` and `include_grey` options
+    if hasattr(transform, "include_rgb") and hasattr(transform, "include_grey"):
+        transform.include_rgb, transform.include_grey = True, False
+    # Compose, BatchCompose, RandomApply and RandomChoice
+    for t in getattr(transform, "transforms", None) or []:
+        _switch_to_rgb(t)
+
+
+def rgb_transforms(img_transforms: Dict[str, Callable],
+                   transform_configs: Dict[str, dict] = None) -> Dict[str, Callable]:
+    """
+    :param img_transforms: tf1, tf2 and tf3 transforms
+    :param transform_configs: configurations the transforms are built from with `TransformInterface`, whose
+    `Img2Tensor` cannot be modified once built
+    :return: copies of the transforms with RGB outputs. Transforms without `Img2Tensor` (grey datasets converted with
+    `ToTensor`) are returned unchanged.
+    """
+    if transform_configs is not None:
+        return {k: TransformInterface(rgb_transform_config(v)) for k, v in transform_configs.items()}
+    rgb = {k: copy.deepcopy(v) for k, v in img_transforms.items()}
+    for transform in rgb.values():
+        _switch_to_rgb(transform)
+    return rgb
@@ -7,6 +7,8 @@ import numpy as np
 from PIL import Image
 
 from .cifar import CIFAR10
+from .npy_format import NPY_FOLDER, load_npy
+from .utils import load_raw_arrays
 
 
 class STL10(CIFAR10):
@@ -14,7 +16,8 @@ class STL10(CIFAR10):
 
     Args:
         root (string): Root directory of dataset where directory
-            ``stl10_binary`` exists.
+            ``stl10_binary`` exists. If the dataset has been converted under ``npy/stl10``,
+            the memory-mapped arrays are used instead.
         split (string): One of {'train', 'test', 'unlabeled', 'train+unlabeled'}.
             Accordingly dataset is selected.
         transform (callable, optional): A function/transform that  takes in an PIL image
@@ -24,10 +27,14 @@ class STL10(CIFAR10):
         download (bool, optional): If true, downloads the dataset from the internet and
             puts it in root directory. If dataset is already downloaded, it is not
             downloaded again.
+        verify (string, optional): One of {'never', 'once', 'always'}, how often the MD5 checksums
+            of the files are verified. See ``utils.VERIFY_MODES``.
 
     """
 
     base_folder = "stl10_binary"
+    _label_attr = "labels"
+    npy_name = "stl10"
     url = "http://ai.stanford.edu/~acoates/stl10/stl10_binary.tar.gz"
     filename = "stl10_binary.tar.gz"
     tgz_md5 = "91f7769df0f17e558f3565bffb0c7dfb"
@@ -45,7 +52,7 @@ class STL10(CIFAR10):
     splits = ("train", "train+unlabeled", "unlabeled", "test")
 
     def __init__(
-        self, root, split="train", transform=None, target_transform=None, download=False
+        self, root, split="train", transform=None, target_transform=None, download=False, verify="always"
     ):
         if split not in self.splits:
             raise ValueError(
@@ -57,6 +64,11 @@ class STL10(CIFAR10):
         self.transform = transform
         self.target_transform = target_transform
         self.split = split  # train/test/unlabeled set
+        self.verify = verify
+
+        # converted arrays are used when present, no original file is read then.
+        if self._load_converted():
+            return
 
         if download:
             self.download()
@@ -67,28 +79,8 @@ class STL10(CIFAR10):
                 "You can use download=True to download it"
             )
 
-        # now load the picked numpy arrays
-        if self.split == "train":
-            self.data, self.labels = self.__loadfile(
-                self.train_list[0][0], self.train_list[1][0]
-            )
-        elif self.split == "train+unlabeled":
-            self.data, self.labels = self.__loadfile(
-                self.train_list[0][0], self.train_list[1][0]
-            )
-            unlabeled_data, _ = self.__loadfile(self.train_list[2][0])
-            self.data = np.concatenate((self.data, unlabeled_data))
-            self.labels = np.concatenate(
-                (self.labels, np.asarray([-1] * unlabeled_data.shape[0]))
-            )
-
-        elif self.split == "unlabeled":
-            self.data, _ = self.__loadfile(self.train_list[2][0])
-            self.labels = np.asarray([-1] * self.data.shape[0])
-        else:  # self.split == 'test':
-            self.data, self.labels = self.__loadfile(
-                self.test_list[0][0], self.test_list[1][0]
-            )
+        # the arrays are shared with the other datasets reading the same files
+        self.data, self.labels = load_raw_arrays((self.base_folder, self.root, self.split), self._load_split)
 
         class_file = os.path.join(self.root, self.base_folder, self.class_names_file)
         if os.path.isfile(class_file):
@@ -101,7 +93,7 @@ class STL10(CIFAR10):
             index (int): Index
 
         Returns:
-            tuple: (image, target) where target is index of the target class.
+            tuple: (image, target, index) where target is index of the target class.
         """
         if self.labels is not None:
             img, target = self.data[index], int(self.labels[index])
@@ -110,7 +102,7 @@ class STL10(CIFAR10):
 
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
-        img = Image.fromarray(np.transpose(img, (1, 2, 0)))
+        img = Image.fromarray(img)
 
         if self.transform is not None:
             img = self.transform(img)
@@ -118,11 +110,54 @@ class STL10(CIFAR10):
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        return img, target
+        return img, target, index
 
     def __len__(self):
         return self.data.shape[0]
 
+    def _load_converted(self):
+        """
+        `train` and `unlabeled` are the two parts of the converted `train+unlabeled` split.
+        :return: True if the memory-mapped arrays of `npy_format` have been loaded
+        """
+        npy_split = "test" if self.split == "test" else "train+unlabeled"
+        converted = load_raw_arrays(
+            (NPY_FOLDER, self.npy_name, self.root, npy_split), lambda: load_npy(self.root, self.npy_name, npy_split)
+        )
+        if converted is None:
+            return False
+        data, labels, meta = converted
+        num_train = meta.get("num_train", len(labels))
+        rows = {"train": slice(0, num_train), "unlabeled": slice(num_train, None)}.get(self.split, slice(None))
+        self.data, self.labels = data[rows], labels[rows]
+        self.classes = meta["classes"]
+        return True
+
+    def _load_split(self):
+        # now load the picked numpy arrays
+        if self.split == "train":
+            data, labels = self.__loadfile(
+                self.train_list[0][0], self.train_list[1][0]
+            )
+        elif self.split == "train+unlabeled":
+            data, labels = self.__loadfile(
+                self.train_list[0][0], self.train_list[1][0]
+            )
+            unlabeled_data, _ = self.__loadfile(self.train_list[2][0])
+            data = np.concatenate((data, unlabeled_data))
+            labels = np.concatenate(
+                (labels, np.asarray([-1] * unlabeled_data.shape[0]))
+            )
+
+        elif self.split == "unlabeled":
+            data, _ = self.__loadfile(self.train_list[2][0])
+            labels = np.asarray([-1] * data.shape[0])
+        else:  # self.split == 'test':
+            data, labels = self.__loadfile(
+                self.test_list[0][0], self.test_list[1][0]
+            )
+        return data, labels
+
     def __loadfile(self, data_file, labels_file=None):
         labels = None
         if labels_file:
@@ -135,7 +170,7 @@ class STL10(CIFAR10):
             # read whole file in uint8 chunks
             everything = np.fromfile(f, dtype=np.uint8)
             images = np.reshape(everything, (-1, 3, 96, 96))
-            images = np.transpose(images, (0, 1, 3, 2))
+            images = np.transpose(images, (0, 3, 2, 1))  # column-major CWH to HWC
 
         return images, labels
 
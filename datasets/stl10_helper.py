@@ -21,6 +21,9 @@ class STL10ClusteringDatasetInterface(ClusterDatasetInterface):
             shuffle: bool = False,
             num_workers: int = 1,
             pin_memory: bool = True,
+            verify: str = "once",
+            batch_fetch: bool = False,
+            distributed: bool = False,
     ) -> None:
         super().__init__(
             STL10,
@@ -30,6 +33,9 @@ class STL10ClusteringDatasetInterface(ClusterDatasetInterface):
             shuffle,
             num_workers,
             pin_memory,
+            verify=verify,
+            batch_fetch=batch_fetch,
+            distributed=distributed,
         )
 
     def _creat_concatDataset(
@@ -51,6 +57,7 @@ class STL10ClusteringDatasetInterface(ClusterDatasetInterface):
                 transform=image_transform,
                 target_transform=target_transform,
                 download=True,
+                verify=self.verify,
                 **dataset_dict,
             )
             _datasets.append(dataset)
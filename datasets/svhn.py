@@ -6,11 +6,13 @@ import os.path
 import numpy as np
 from PIL import Image
 
-from .utils import download_url, check_integrity
+from .dataset import RawBatchMixin
+from .npy_format import NPY_FOLDER, load_npy
+from .utils import download_url, check_integrity, load_raw_arrays
 from .vision import VisionDataset
 
 
-class SVHN(VisionDataset):
+class SVHN(RawBatchMixin, VisionDataset):
     """`SVHN <http://ufldl.stanford.edu/housenumbers/>`_ Dataset.
     Note: The SVHN dataset assigns the label `10` to the digit `0`. However, in this Dataset,
     we assign the label `0` to the digit `0` to be compatible with PyTorch loss functions which
@@ -18,7 +20,8 @@ class SVHN(VisionDataset):
 
     Args:
         root (string): Root directory of dataset where directory
-            ``SVHN`` exists.
+            ``SVHN`` exists. If the split has been converted under ``npy/svhn``, the memory-mapped
+            arrays are used instead.
         split (string): One of {'train', 'test', 'extra'}.
             Accordingly dataset is selected. 'extra' is Extra training set.
         transform (callable, optional): A function/transform that  takes in an PIL image
@@ -28,12 +31,16 @@ class SVHN(VisionDataset):
         download (bool, optional): If true, downloads the dataset from the internet and
             puts it in root directory. If dataset is already downloaded, it is not
             downloaded again.
+        verify (string, optional): One of {'never', 'once', 'always'}, how often the MD5 checksums
+            of the files are verified. See ``utils.VERIFY_MODES``.
 
     """
 
     url = ""
     filename = ""
     file_md5 = ""
+    npy_name = "svhn"
+    _label_attr = "labels"
 
     split_list = {
         "train": [
@@ -54,12 +61,13 @@ class SVHN(VisionDataset):
     }
 
     def __init__(
-            self, root, split="train", transform=None, target_transform=None, download=False
+            self, root, split="train", transform=None, target_transform=None, download=False, verify="always"
     ):
         super(SVHN, self).__init__(root)
         self.transform = transform
         self.target_transform = target_transform
         self.split = split  # training set or test set or extra set
+        self.verify = verify
 
         if self.split not in self.split_list:
             raise ValueError(
@@ -71,6 +79,16 @@ class SVHN(VisionDataset):
         self.filename = self.split_list[split][1]
         self.file_md5 = self.split_list[split][2]
 
+        self.debug: bool = os.environ.get("PYDEBUG", False) == "1"
+
+        # converted arrays are used when present, no original file is read then.
+        converted = load_raw_arrays(
+            (NPY_FOLDER, self.npy_name, self.root, split), lambda: load_npy(self.root, self.npy_name, split)
+        )
+        if converted is not None:
+            self.data, self.labels, _ = converted
+            return
+
         if download:
             self.download()
 
@@ -80,27 +98,8 @@ class SVHN(VisionDataset):
                 + " You can use download=True to download it"
             )
 
-        # import here rather than at top of file because this is
-        # an optional dependency for torchvision
-        import scipy.io as sio
-
-        # reading(loading) mat file as array
-        loaded_mat = sio.loadmat(os.path.join(self.root, self.filename))
-
-        self.data = loaded_mat["X"]
-        # loading from the .mat file gives an np array of type np.uint8
-        # converting to np.int64, so that we have a LongTensor after
-        # the conversion from the numpy array
-        # the squeeze is needed to obtain a 1D tensor
-        self.labels = loaded_mat["y"].astype(np.int64).squeeze()
-
-        # the svhn dataset assigns the class label "10" to the digit 0
-        # this makes it inconsistent with several loss functions
-        # which expect the class labels to be in the range [0, C-1]
-        np.place(self.labels, self.labels == 10, 0)
-        self.data = np.transpose(self.data, (3, 2, 0, 1))
-
-        self.debug: bool = os.environ.get("PYDEBUG", False) == "1"
+        # the arrays are shared with the other datasets reading the same file
+        self.data, self.labels = load_raw_arrays((self.filename, self.root), self._load_data)
 
     def __getitem__(self, index):
         """
@@ -108,13 +107,13 @@ class SVHN(VisionDataset):
             index (int): Index
 
         Returns:
-            tuple: (image, target) where target is index of the target class.
+            tuple: (image, target, index) where target is index of the target class.
         """
         img, target = self.data[index], int(self.labels[index])
 
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
-        img = Image.fromarray(np.transpose(img, (1, 2, 0)))
+        img = Image.fromarray(img)
 
         if self.transform is not None:
             img = self.transform(img)
@@ -122,18 +121,40 @@ class SVHN(VisionDataset):
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        return img, target
+        return img, target, index
 
     def __len__(self):
         if self.debug:
             return int(len(self.data) / 100)
         return len(self.data)
 
+    def _load_data(self):
+        # import here rather than at top of file because this is
+        # an optional dependency for torchvision
+        import scipy.io as sio
+
+        # reading(loading) mat file as array
+        loaded_mat = sio.loadmat(os.path.join(self.root, self.filename))
+
+        data = loaded_mat["X"]
+        # loading from the .mat file gives an np array of type np.uint8
+        # converting to np.int64, so that we have a LongTensor after
+        # the conversion from the numpy array
+        # the squeeze is needed to obtain a 1D tensor
+        labels = loaded_mat["y"].astype(np.int64).squeeze()
+
+        # the svhn dataset assigns the class label "10" to the digit 0
+        # this makes it inconsistent with several loss functions
+        # which expect the class labels to be in the range [0, C-1]
+        np.place(labels, labels == 10, 0)
+        data = np.transpose(data, (3, 0, 1, 2))  # HWCN to NHWC
+        return data, labels
+
     def _check_integrity(self):
         root = self.root
         md5 = self.split_list[self.split][2]
         fpath = os.path.join(root, self.filename)
-        return check_integrity(fpath, md5)
+        return check_integrity(fpath, md5, verify=self.verify)
 
     def download(self):
         md5 = self.split_list[self.split][2]
@@ -22,6 +22,9 @@ class SVHNClusteringDatasetInterface(ClusterDatasetInterface):
             shuffle: bool = False,
             num_workers: int = 1,
             pin_memory: bool = True,
+            verify: str = "once",
+            batch_fetch: bool = False,
+            distributed: bool = False,
     ) -> None:
         super().__init__(
             SVHN,
@@ -31,6 +34,9 @@ class SVHNClusteringDatasetInterface(ClusterDatasetInterface):
             shuffle,
             num_workers,
             pin_memory,
+            verify=verify,
+            batch_fetch=batch_fetch,
+            distributed=distributed,
         )
 
     def _creat_concatDataset(
@@ -52,6 +58,7 @@ class SVHNClusteringDatasetInterface(ClusterDatasetInterface):
                 transform=image_transform,
                 target_transform=target_transform,
                 download=True,
+                verify=self.verify,
                 **dataset_dict,
             )
             _datasets.append(dataset)
@@ -1,5 +1,6 @@
 import errno
 import hashlib
+import json
 import os
 import os.path
 
@@ -18,22 +19,87 @@ def gen_bar_updater():
     return bar_update
 
 
-def check_integrity(fpath, md5=None):
-    if md5 is None:
-        return True
-    if not os.path.isfile(fpath):
-        return False
+# `never` only checks that the file exists, `once` hashes a file once and records the success in a sidecar
+# file keyed by its path, size and mtime, `always` hashes the file at every check.
+VERIFY_MODES = ("never", "once", "always")
+_VERIFIED_SUFFIX = ".verified"
+# files verified in this process, keyed by (path, size, mtime, md5)
+_verified_files = set()
+
+
+def _md5_matches(fpath, md5):
     md5o = hashlib.md5()
     with open(fpath, "rb") as f:
         # read in 1MB chunks
         for chunk in iter(lambda: f.read(1024 * 1024), b""):
             md5o.update(chunk)
     md5c = md5o.hexdigest()
-    if md5c != md5:
+    return md5c == md5
+
+
+def _verification_record(fpath, md5):
+    stat = os.stat(fpath)
+    return {"path": os.path.abspath(fpath), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "md5": md5}
+
+
+def _read_verification(fpath):
+    try:
+        with open(fpath + _VERIFIED_SUFFIX, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_verification(fpath, record):
+    try:
+        with open(fpath + _VERIFIED_SUFFIX, "w") as f:
+            json.dump(record, f)
+    except OSError:
+        # read-only dataset folders only keep the in-process record
+        pass
+
+
+def check_integrity(fpath, md5=None, verify="always"):
+    assert verify in VERIFY_MODES, f"`verify` should be in {VERIFY_MODES}, given {verify}."
+    if md5 is None:
+        return True
+    if not os.path.isfile(fpath):
+        return False
+    if verify == "never":
+        return True
+    if verify == "once":
+        record = _verification_record(fpath, md5)
+        key = tuple(record.values())
+        if key in _verified_files:
+            return True
+        if _read_verification(fpath) == record:
+            _verified_files.add(key)
+            return True
+    if not _md5_matches(fpath, md5):
         return False
+    if verify == "once":
+        _write_verification(fpath, record)
+        _verified_files.add(key)
     return True
 
 
+# raw arrays shared by all the datasets built in this process, keyed by the files they are read from
+_raw_arrays = {}
+
+
+def load_raw_arrays(key, loader):
+    """
+    load the raw arrays of a dataset once per process, so that all the views and loaders share the same memory.
+    The arrays must not be modified in place.
+    :param key: hashable identifying the files, such as (folder, root, split)
+    :param loader: callable reading the arrays, only called the first time `key` is requested
+    :return: the object returned by `loader`
+    """
+    if key not in _raw_arrays:
+        _raw_arrays[key] = loader()
+    return _raw_arrays[key]
+
+
 def makedir_exist_ok(dirpath):
     """
     Python2 support for os.makedirs(.., exist_ok=True)
@@ -1,7 +1,11 @@
 from deepclustering.arch import _register_arch
 
+from .grouped_head import ClusterNet5gTwoHeadGrouped, ClusterNet6cTwoHeadGrouped
 from .net5g_two_head import ClusterNet5gTwoHead
 from .net6c_two_head import ClusterNet6cTwoHead
 
 _register_arch("clusternet5gtwohead_sn", ClusterNet5gTwoHead)
 _register_arch("clusternet6ctwohead_sn", ClusterNet6cTwoHead)
+# sub-heads computed as one grouped linear layer, see grouped_head.py
+_register_arch("clusternet5gtwohead_grouped", ClusterNet5gTwoHeadGrouped)
+_register_arch("clusternet6ctwohead_grouped", ClusterNet6cTwoHeadGrouped)
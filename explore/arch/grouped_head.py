@@ -0,0 +1,169 @@
+"""
+Sub-head ensembles computed as one grouped linear layer: the weights of the `num_sub_heads` linear sub-heads are
+stored in a single (H, F, K) parameter and all the logits are computed with one `baddbmm`, instead of a python loop
+over `nn.Sequential(nn.Linear, nn.Softmax)` modules. The heads still return a list of simplexes.
+Checkpoints in the former `heads.<i>.0.weight` layout are converted when loaded, and `grouped_to_legacy` converts back.
+"""
+import math
+import re
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn as nn
+from deepclustering.arch import ClusterNet5gTwoHead, ClusterNet6cTwoHead
+from torch import Tensor
+
+__all__ = ["GroupedSubHeads", "GroupedClusterHead", "group_sub_heads", "legacy_to_grouped", "grouped_to_legacy",
+           "ClusterNet5gTwoHeadGrouped", "ClusterNet6cTwoHeadGrouped"]
+
+_LEGACY_KEY = re.compile(r"^(?P<prefix>(.*\.)?heads\.)(?P<index>\d+)\.0\.(?P<kind>weight|bias)$")
+_GROUPED_KEY = re.compile(r"^(?P<prefix>(.*\.)?heads\.)(?P<kind>weight|bias)$")
+
+
+def legacy_to_grouped(state_dict: Dict[str, Tensor]) -> Dict[str, Tensor]:
+    """
+    :param state_dict: state dict with sub-heads saved as `<prefix>heads.<i>.0.weight` (K, F) and `.bias` (K,)
+    :return: state dict with `<prefix>heads.weight` (H, F, K) and `<prefix>heads.bias` (H, K), other keys unchanged.
+    """
+    converted, groups = OrderedDict(), OrderedDict()
+    for key, value in state_dict.items():
+        match = _LEGACY_KEY.match(key)
+        if match is None:
+            converted[key] = value
+            continue
+        name = match.group("prefix") + match.group("kind")
+        converted.setdefault(name, None)  # keep the position of the first sub-head
+        groups.setdefault(name, {})[int(match.group("index"))] = value
+    for name, values in groups.items():
+        assert sorted(values) == list(range(len(values))), f"Missing sub-heads for {name}, given {sorted(values)}."
+        values = [values[i] for i in range(len(values))]
+        converted[name] = torch.stack([v.t() if v.dim() == 2 else v for v in values])
+    return converted
+
+
+def grouped_to_legacy(state_dict: Dict[str, Tensor]) -> Dict[str, Tensor]:
+    """
+    inverse of `legacy_to_grouped`, to load the weights of a grouped network into the former architectures.
+    """
+    converted = OrderedDict()
+    for key, value in state_dict.items():
+        match = _GROUPED_KEY.match(key)
+        kind = match.group("kind") if match is not None else None
+        if kind is None or value.dim() != {"weight": 3, "bias": 2}[kind]:
+            converted[key] = value
+            continue
+        for i, sub_value in enumerate(value.unbind(0)):
+            converted[f"{match.group('prefix')}{i}.0.{kind}"] = \
+                sub_value.t().contiguous() if kind == "weight" else sub_value.clone()
+    return converted
+
+
+class GroupedSubHeads(nn.Module):
+    """
+    `num_sub_heads` linear layers followed by a softmax, computed at once.
+    """
+
+    def __init__(self, num_sub_heads: int, in_features: int, output_k: int) -> None:
+        """
+        :param num_sub_heads: number of sub heads to form an ensemble-like prediction
+        :param in_features: size of the trunk features
+        :param output_k: number of clustering
+        """
+        super().__init__()
+        self.num_sub_heads = num_sub_heads
+        self.weight = nn.Parameter(torch.empty(num_sub_heads, in_features, output_k))
+        self.bias = nn.Parameter(torch.empty(num_sub_heads, output_k))
+        # the default initialization of nn.Linear
+        bound = 1.0 / math.sqrt(in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+        # indices of the computed sub-heads, None for all of them
+        self.active_sub_heads: Optional[List[int]] = None
+        self._register_load_state_dict_pre_hook(self._load_legacy)
+
+    @staticmethod
+    def _load_legacy(state_dict, prefix, *args):
+        # `prefix` ends with `heads.`, former keys continue with `<i>.0.weight` and `<i>.0.bias`
+        legacy_keys = [k for k in state_dict if k.startswith(prefix) and re.match(r"\d+\.0\.", k[len(prefix):])]
+        if not legacy_keys:
+            return
+        converted = legacy_to_grouped({k: state_dict.pop(k) for k in legacy_keys})
+        state_dict.update(converted)
+
+    def forward(self, features: Tensor) -> Tensor:
+        """
+        :param features: (N, F)
+        :return: simplexes with shape (H, N, K), H being the number of active sub-heads
+        """
+        weight, bias = self.weight, self.bias
+        if self.active_sub_heads is not None:
+            index = torch.tensor(self.active_sub_heads, device=weight.device)
+            weight, bias = weight.index_select(0, index), bias.index_select(0, index)
+        features = features.unsqueeze(0).expand(weight.shape[0], -1, -1)
+        logits = torch.baddbmm(bias.unsqueeze(1), features, weight)
+        return logits.softmax(2)
+
+    def extra_repr(self) -> str:
+        return f"num_sub_heads={self.num_sub_heads}, in_features={self.weight.shape[1]}, " \
+               f"output_k={self.weight.shape[2]}"
+
+
+class GroupedClusterHead(nn.Module):
+    """
+    drop-in replacement of the heads of `ClusterNet5gTwoHead` and `ClusterNet6cTwoHead`.
+    """
+
+    def __init__(self, num_sub_heads: int, in_features: int, output_k: int) -> None:
+        super().__init__()
+        self.num_sub_heads = num_sub_heads
+        self.heads = GroupedSubHeads(num_sub_heads, in_features, output_k)
+
+    @classmethod
+    def from_head(cls, head: nn.Module) -> "GroupedClusterHead":
+        """
+        :param head: head with a `heads` ModuleList of `nn.Sequential(nn.Linear, nn.Softmax)`
+        :return: grouped head with the same weights
+        """
+        linears: List[nn.Linear] = [sub_head[0] for sub_head in head.heads]
+        grouped = cls(len(linears), linears[0].in_features, linears[0].out_features)
+        with torch.no_grad():
+            grouped.heads.weight.copy_(torch.stack([l.weight.t() for l in linears]))
+            grouped.heads.bias.copy_(torch.stack([l.bias for l in linears]))
+        return grouped.to(linears[0].weight.device)
+
+    def set_active_sub_heads(self, indices: Optional[List[int]]) -> None:
+        """
+        :param indices: sub-heads computed by the forward, None for all of them
+        """
+        self.heads.active_sub_heads = None if indices is None else list(indices)
+
+    def forward(self, x: Tensor, kmeans_use_features: bool = False) -> List[Tensor]:
+        if kmeans_use_features:
+            num_active = len(self.heads.active_sub_heads or range(self.num_sub_heads))
+            return [x for _ in range(num_active)]  # duplicates
+        return list(self.heads(x).unbind(0))
+
+
+def group_sub_heads(net: nn.Module) -> nn.Module:
+    """
+    replace in place the sub-head ModuleLists of `head_A` and `head_B`, semisup heads are kept unchanged.
+    Parameters change, the optimizer has to be created after this call.
+    """
+    for head_name in ("head_A", "head_B"):
+        head = getattr(net, head_name, None)
+        if head is not None and isinstance(getattr(head, "heads", None), nn.ModuleList):
+            setattr(net, head_name, GroupedClusterHead.from_head(head))
+    return net
+
+
+class ClusterNet5gTwoHeadGrouped(ClusterNet5gTwoHead):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        group_sub_heads(self)
+
+
+class ClusterNet6cTwoHeadGrouped(ClusterNet6cTwoHead):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        group_sub_heads(self)
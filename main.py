@@ -1,16 +1,22 @@
+import os
 from pathlib import Path
 from typing import Dict, Union, Type, Tuple
 
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from deepclustering.manager import ConfigManger
 from deepclustering.model import Model, to_Apex
 from deepclustering.utils import fix_all_seed
 from torch.utils.data import DataLoader
 
 import trainer
+from explore.arch import _register_arch
 from trainer import trainer_mapping
 
 DATA_PATH = Path(".data")
 DATA_PATH.mkdir(exist_ok=True)
+_ = _register_arch  # registers the explore architectures, e.g. clusternet5gtwohead_grouped
 
 
 def get_trainer(config: Dict[str, Union[float, int, dict]]) -> Type[trainer.ClusteringGeneralTrainer]:
@@ -23,15 +29,23 @@ def get_dataloader(config: Dict[str, Union[float, int, dict, str]], DEFAULT_CONF
     DataLoader, DataLoader, DataLoader]:
     """
     We will use config.Config as the input yaml file to select dataset
-    config.DataLoader.transforms (naive or strong) to choose data augmentation for GEO
+    config.DataLoader.transforms (naive, strong or strong_batched) to choose data augmentation for GEO
+    config.EvalCache (optional) to cache the tf3 tensors of the val_loader
+    config.DataLoader.distributed (set by `run`) to load the shard of the current rank
+    config.Trainer.fold_sobel (with use_sobel) to load rgb images, converted to grey by the network
     """
+    # configurations the transforms are built from, when the dataset defines them with `TransformInterface`
+    transform_configs = {}
     if config.get("Config", DEFAULT_CONFIG).split("_")[-1].lower() == "cifar.yaml":
         from datasets import (
             cifar10_naive_transform as naive_transforms,
             cifar10_strong_transform as strong_transforms,
+            cifar10_naive_transform_config as naive_transform_config,
+            cifar10_strong_transform_config as strong_transform_config,
             Cifar10ClusteringDatasetInterface as DatasetInterface,
         )
         print("Checkout CIFAR10 dataset with transforms:")
+        transform_configs = {"naive": naive_transform_config, "strong": strong_transform_config}
         train_split_partition = ["train", "val"]
         val_split_partition = ["train", "val"]
         dataset_name = "cifar"
@@ -40,9 +54,12 @@ def get_dataloader(config: Dict[str, Union[float, int, dict, str]], DEFAULT_CONF
         from datasets import (
             cifar10_naive_transform as naive_transforms,
             cifar10_strong_transform as strong_transforms,
+            cifar10_naive_transform_config as naive_transform_config,
+            cifar10_strong_transform_config as strong_transform_config,
             Cifar20ClusteringDatasetInterface as DatasetInterface,
         )
         print("Checkout CIFAR20 dataset with transforms:")
+        transform_configs = {"naive": naive_transform_config, "strong": strong_transform_config}
         train_split_partition = ["train", "val"]
         val_split_partition = ["train", "val"]
         dataset_name = "cifar20"
@@ -51,9 +68,12 @@ def get_dataloader(config: Dict[str, Union[float, int, dict, str]], DEFAULT_CONF
         from datasets import (
             cifar10_naive_transform as naive_transforms,
             cifar10_strong_transform as strong_transforms,
+            cifar10_naive_transform_config as naive_transform_config,
+            cifar10_strong_transform_config as strong_transform_config,
             Cifar100ClusteringDatasetInterface as DatasetInterface,
         )
         print("Checkout CIFAR100 dataset with transforms:")
+        transform_configs = {"naive": naive_transform_config, "strong": strong_transform_config}
         train_split_partition = ["train", "val"]
         val_split_partition = ["train", "val"]
         dataset_name = "cifar100"
@@ -98,41 +118,59 @@ def get_dataloader(config: Dict[str, Union[float, int, dict, str]], DEFAULT_CONF
     assert config.get("DataLoader").get("transforms"), \
         f"Data augmentation must be provided in config.DataLoader, given {config['DataLoader']}."
     transforms = config.get("DataLoader").get("transforms")
-    assert transforms in ("naive", "strong"), f"Only predefined `naive` and `strong` transformations are supported."
+    assert transforms in ("naive", "strong", "strong_batched"), \
+        f"Only predefined `naive`, `strong` and `strong_batched` transformations are supported."
+    # number of tf2 views paired with one tf1 view for each sample.
+    num_tf2_views = int(config.get("DataLoader").get("num_tf2_views", 4))
+    assert num_tf2_views >= 1, f"`num_tf2_views` should be >= 1, given {num_tf2_views}."
     # like a switch statement in python.
     # todo: to determinate if we should include cutout or gaussian as the transformation.
-    img_transforms = {"naive": naive_transforms, "strong": strong_transforms}.get(transforms)
+    img_transforms = {"naive": naive_transforms, "strong": strong_transforms,
+                      "strong_batched": strong_transforms}.get(transforms)
     assert img_transforms
+    if config["DataLoader"].get("batch_fetch", False) and transforms == "naive":
+        from datasets.batch_transforms import naive_batch_transforms
+        # transforms without batched equivalent are applied sample by sample in the batch fetch path
+        img_transforms = naive_batch_transforms.get(dataset_name, img_transforms)
+        transform_configs = {}
     # print("image transformations:")
     # pprint(img_transforms)
+    # these keys are consumed here and should not be passed to the DatasetInterface
+    loader_dict = {k: v for k, v in config["DataLoader"].items() if k not in ("transforms", "num_tf2_views")}
+    if transforms == "strong_batched":
+        from datasets.batch_transforms import strong_batch_transforms
+        # the strong augmentation computed on whole uint8 batches, it needs the batch fetch path
+        img_transforms = strong_batch_transforms[dataset_name]
+        transform_configs = {}
+        loader_dict["batch_fetch"] = True
+    if config.get("Trainer", {}).get("use_sobel") and config.get("Trainer", {}).get("fold_sobel"):
+        from datasets import rgb_transform_config, rgb_transforms
+        # the grey conversion is folded with the sobel filter in front of the trunk, the loaders keep the rgb channels
+        img_transforms = rgb_transforms(img_transforms, transform_configs.get(transforms))
+        transform_configs = {k: {tf: rgb_transform_config(c) for tf, c in v.items()}
+                             for k, v in transform_configs.items()}
 
     train_loader_A = DatasetInterface(
         data_root=DATA_PATH,
         split_partitions=train_split_partition,
-        **{k: v for k, v in config["DataLoader"].items() if k != "transforms"}
+        **loader_dict
     ).ParallelDataLoader(
         img_transforms["tf1"],
-        img_transforms["tf2"],
-        img_transforms["tf2"],
-        img_transforms["tf2"],
-        img_transforms["tf2"],
+        *[img_transforms["tf2"] for _ in range(num_tf2_views)],
     )
     setattr(train_loader_A, "dataset_name", dataset_name)
 
     train_loader_B = DatasetInterface(
         data_root=DATA_PATH,
         split_partitions=train_split_partition,
-        **{k: v for k, v in config["DataLoader"].items() if k != "transforms"}
+        **loader_dict
     ).ParallelDataLoader(
         img_transforms["tf1"],
-        img_transforms["tf2"],
-        img_transforms["tf2"],
-        img_transforms["tf2"],
-        img_transforms["tf2"],
+        *[img_transforms["tf2"] for _ in range(num_tf2_views)],
     )
     setattr(train_loader_B, "dataset_name", dataset_name)
 
-    val_dict = {k: v for k, v in config["DataLoader"].items() if k != "transforms"}
+    val_dict = {**loader_dict}
     val_dict["shuffle"] = False
     val_loader = DatasetInterface(
         data_root=DATA_PATH,
@@ -140,15 +178,47 @@ def get_dataloader(config: Dict[str, Union[float, int, dict, str]], DEFAULT_CONF
         **val_dict
     ).ParallelDataLoader(img_transforms["tf3"])
     setattr(val_loader, "dataset_name", dataset_name)
+    # tf3 is deterministic, its output can be computed once and reused for all the evaluations.
+    eval_cache = config.get("EvalCache", {})
+    if eval_cache.get("enable", False):
+        from datasets import EvalTensorCache
+        val_loader = EvalTensorCache(
+            val_loader,
+            cache_dir=DATA_PATH / "eval_cache" if eval_cache.get("memmap", True) else None,
+            dtype=eval_cache.get("dtype", "uint8"),
+            batch_size=eval_cache.get("batch_size", 1000),
+            # without configuration, the parameters of the transform objects are hashed
+            transform_config=transform_configs.get(transforms, {}).get("tf3"),
+            # the shards of the ranks are cached apart
+            name=f"{dataset_name}_{transforms}" + (
+                f"_rank{dist.get_rank()}of{dist.get_world_size()}" if loader_dict.get("distributed") else ""),
+        ).CachedDataLoader()
 
     return train_loader_A, train_loader_B, val_loader
 
 
-if __name__ == '__main__':
-    DEFAULT_CONFIG = "config/config_MNIST.yaml"
-    merged_config = ConfigManger(DEFAULT_CONFIG_PATH=DEFAULT_CONFIG, verbose=False, integrality_check=True).config
+def run(rank: int, merged_config: Dict[str, Union[float, int, dict, str]], DEFAULT_CONFIG: str) -> None:
+    """
+    build the loaders, the model and the trainer of one process and train.
+    With `Distributed.world_size` > 1, `rank` joins the gloo process group and trains on its shard of the data with
+    `DataLoader.batch_size / world_size` samples per batch, so that the global batch is unchanged.
+    """
+    distributed_config = merged_config.get("Distributed", {})
+    world_size = int(distributed_config.get("world_size", 1))
+    if world_size > 1:
+        os.environ["MASTER_ADDR"] = str(distributed_config.get("master_addr", "127.0.0.1"))
+        os.environ["MASTER_PORT"] = str(distributed_config.get("master_port", 29500))
+        dist.init_process_group("gloo", rank=rank, world_size=world_size)
+        # the ranks share the cores of the machine
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+        batch_size = merged_config["DataLoader"]["batch_size"]
+        assert batch_size % world_size == 0, \
+            f"`DataLoader.batch_size` should be divisible by `Distributed.world_size`, given {batch_size} and " \
+            f"{world_size}."
+        merged_config = {**merged_config, "DataLoader": {
+            **merged_config["DataLoader"], "batch_size": batch_size // world_size, "distributed": True}}
 
-    # for reproducibility
+    # for reproducibility, the model is the same on all the ranks
     fix_all_seed(merged_config.get("Seed", 0))
 
     # get train loaders and validation loader
@@ -162,6 +232,9 @@ if __name__ == '__main__':
     )
     # if use automatic precision mixture training
     model = to_Apex(model, opt_level=None, verbosity=0)
+    if world_size > 1:
+        # different augmentations and regularization noises on each rank
+        fix_all_seed(merged_config.get("Seed", 0) + rank)
 
     # get specific trainer class
     Trainer = get_trainer(merged_config)
@@ -179,3 +252,18 @@ if __name__ == '__main__':
     # clusteringTrainer.draw_tsne(val_loader)
     # do not use clean up
     # clusteringTrainer.clean_up(wait_time=3)
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    DEFAULT_CONFIG = "config/config_MNIST.yaml"
+    merged_config = ConfigManger(DEFAULT_CONFIG_PATH=DEFAULT_CONFIG, verbose=False, integrality_check=True).config
+
+    world_size = int(merged_config.get("Distributed", {}).get("world_size", 1))
+    assert world_size >= 1, f"`Distributed.world_size` should be >= 1, given {world_size}."
+    if world_size > 1:
+        # one process per rank, data-parallel over gloo
+        mp.spawn(run, args=(merged_config, DEFAULT_CONFIG), nprocs=world_size)
+    else:
+        run(0, merged_config, DEFAULT_CONFIG)
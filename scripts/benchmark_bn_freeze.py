@@ -0,0 +1,70 @@
+"""
+Micro benchmark of the batch-norm freezing used by VAT on `ClusterNet5g`: the former `_disable_tracking_bn_stats`,
+walking the whole model twice with `model.apply` to toggle `track_running_stats`, against `RegHelper.BNStatsFreezer`
+saving and restoring the flags of the precomputed batch-norm list. The context alone and a frozen forward are timed,
+and both versions are checked to leave the running statistics unchanged.
+run from the project root: python scripts/benchmark_bn_freeze.py
+"""
+import contextlib
+import sys
+import timeit
+from pathlib import Path
+
+import torch
+from deepclustering.arch import ClusterNet5g, ClusterNet5g_Param
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from RegHelper import BNStatsFreezer  # noqa
+
+BATCH_SIZE = 32
+INPUT_SIZE = 64
+REPEAT = 200
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+@contextlib.contextmanager
+def disable_tracking_bn_stats(model):
+    # the former implementation
+    def switch_attr(m):
+        if hasattr(m, "track_running_stats"):
+            m.track_running_stats ^= True
+
+    model.apply(switch_attr)
+    yield
+    model.apply(switch_attr)
+
+
+def running_stats(model):
+    return [b.clone() for n, b in model.named_buffers() if "running" in n]
+
+
+def frozen_forward(context, net, images):
+    with context():
+        net(images)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+if __name__ == '__main__':
+    net = ClusterNet5g(**ClusterNet5g_Param).to(device).train()
+    images = torch.randn(BATCH_SIZE, ClusterNet5g_Param["num_channel"], INPUT_SIZE, INPUT_SIZE, device=device)
+    freezer = BNStatsFreezer(net)
+    contexts = {"model.apply toggle": lambda: disable_tracking_bn_stats(net), "BNStatsFreezer": freezer.frozen}
+    print(f"device: {device}, {len(freezer.bn_modules)} batch-norm layers in {len(list(net.modules()))} modules, "
+          f"batch size: {BATCH_SIZE}")
+    for name, context in contexts.items():
+        before = running_stats(net)
+        with torch.no_grad():
+            frozen_forward(context, net, images)
+        assert all(torch.equal(b, a) for b, a in zip(before, running_stats(net))), \
+            f"{name} changed the running statistics."
+
+        def enter_exit():
+            with context():
+                pass
+
+        context_time = min(timeit.repeat(enter_exit, number=REPEAT, repeat=3)) / REPEAT
+        with torch.no_grad():
+            forward_time = min(timeit.repeat(lambda: frozen_forward(context, net, images), number=REPEAT // 10,
+                                             repeat=3)) / (REPEAT // 10)
+        print(f"{name:>20}: enter+exit {context_time * 1e6:.1f} us, frozen forward {forward_time * 1e3:.3f} ms")
@@ -0,0 +1,56 @@
+"""
+Micro benchmark of the IIC joint distribution: the former (bn, k, k) outer product against the matmul path of
+`trainer.loss.compute_joint`, forward and backward, for the cluster numbers used in our configs.
+run from the project root: python scripts/benchmark_compute_joint.py
+"""
+import sys
+import timeit
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from trainer.loss import compute_joint, IIDLoss  # noqa
+
+BATCH_SIZE = 400
+REPEAT = 50
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def outer_product_joint(x_out, x_tf_out):
+    p_i_j = x_out.unsqueeze(2) * x_tf_out.unsqueeze(1)  # bn, k, k
+    p_i_j = p_i_j.sum(dim=0)
+    p_i_j = (p_i_j + p_i_j.t()) / 2.0
+    p_i_j /= p_i_j.sum()
+    return p_i_j
+
+
+def step(joint_func, x_logit, x_tf_logit):
+    x_out, x_tf_out = torch.softmax(x_logit, 1), torch.softmax(x_tf_logit, 1)
+    joint_func(x_out, x_tf_out).log().sum().backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+if __name__ == '__main__':
+    print(f"device: {device}, batch size: {BATCH_SIZE}")
+    for k in (10, 20, 70, 100):
+        x_logit = torch.randn(BATCH_SIZE, k, device=device, requires_grad=True)
+        x_tf_logit = torch.randn(BATCH_SIZE, k, device=device, requires_grad=True)
+        assert torch.allclose(
+            outer_product_joint(torch.softmax(x_logit, 1), torch.softmax(x_tf_logit, 1)),
+            compute_joint(torch.softmax(x_logit, 1), torch.softmax(x_tf_logit, 1)),
+            atol=1e-6
+        )
+        outer_time = min(timeit.repeat(lambda: step(outer_product_joint, x_logit, x_tf_logit), number=REPEAT,
+                                       repeat=3)) / REPEAT
+        matmul_time = min(timeit.repeat(lambda: step(compute_joint, x_logit, x_tf_logit), number=REPEAT,
+                                        repeat=3)) / REPEAT
+        iid_time = {}
+        for return_no_lamb in (True, False):
+            iid_time[return_no_lamb] = min(timeit.repeat(
+                lambda: IIDLoss()(torch.softmax(x_logit, 1), torch.softmax(x_tf_logit, 1),
+                                  return_no_lamb=return_no_lamb)[0].backward(), number=REPEAT, repeat=3)) / REPEAT
+        print(f"k={k:>3}: outer product {outer_time * 1e3:.3f} ms, matmul {matmul_time * 1e3:.3f} ms, "
+              f"outer product temporary {BATCH_SIZE * k * k * 4 / 1024 ** 2:.2f} MB | "
+              f"IIDLoss with loss_no_lamb {iid_time[True] * 1e3:.3f} ms, without {iid_time[False] * 1e3:.3f} ms")
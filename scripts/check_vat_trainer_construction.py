@@ -0,0 +1,55 @@
+"""
+Construction check of the trainers using VAT against the shipped configs: each trainer of `trainer_mapping` whose
+name contains `vat` or `pipeline` is built with the `Arch`, `Optim`, `Scheduler` and `Trainer` sections of every
+`config/config_*.yaml`, on cpu and with small random loaders. Nothing is trained, the run directories are written
+in a temporary directory.
+run from the project root: python scripts/check_vat_trainer_construction.py
+"""
+import sys
+import tempfile
+import traceback
+from pathlib import Path
+
+import torch
+import yaml
+from deepclustering.model import Model
+from torch.utils.data import DataLoader, TensorDataset
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from explore.arch import _register_arch  # noqa
+from trainer import trainer_mapping  # noqa
+
+CONFIG_DIR = Path(__file__).parent.parent / "config"
+VAT_TRAINERS = sorted(name for name in trainer_mapping if "vat" in name or "pipeline" in name)
+
+
+def random_loader(num_channel: int, input_size: int = 32) -> DataLoader:
+    images = torch.rand(8, num_channel, input_size, input_size)
+    return DataLoader(TensorDataset(images, torch.zeros(8, dtype=torch.long), torch.arange(8)), batch_size=4)
+
+
+def build(trainer_name: str, config: dict, run_path: str) -> None:
+    model = Model(arch_dict=config["Arch"], optim_dict=config["Optim"], scheduler_dict=config["Scheduler"])
+    loader = random_loader(config["Arch"].get("num_channel", 1))
+    trainer_class = trainer_mapping[trainer_name]
+    trainer_class.RUN_PATH = run_path
+    trainer_class(model=model, train_loader_A=loader, train_loader_B=loader, val_loader=loader, config=config,
+                  **{**config["Trainer"], "device": "cpu", "save_dir": trainer_name})
+
+
+if __name__ == '__main__':
+    failures = []
+    with tempfile.TemporaryDirectory() as run_path:
+        for config_path in sorted(CONFIG_DIR.glob("config_*.yaml")):
+            with open(config_path) as f:
+                config = yaml.safe_load(f)
+            for trainer_name in VAT_TRAINERS:
+                try:
+                    build(trainer_name, config, run_path)
+                except Exception:
+                    failures.append((config_path.name, trainer_name, traceback.format_exc()))
+    for config_name, trainer_name, error in failures:
+        print(f"{config_name} {trainer_name}:\n{error}")
+    print(f"{len(VAT_TRAINERS) * len(list(CONFIG_DIR.glob('config_*.yaml'))) - len(failures)} constructions passed, "
+          f"{len(failures)} failed.")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,69 @@
+"""
+One-time conversion of the datasets to the memory-mapped format of `datasets.npy_format`. Once converted, the
+dataset classes read `<root>/npy/<name>` instead of parsing the original pickle/mat/binary/torch files.
+run from the project root: python scripts/convert_datasets_to_npy.py --root .data --datasets cifar10 mnist
+"""
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from datasets.cifar import CIFAR10, CIFAR100  # noqa
+from datasets.mnist import MNIST  # noqa
+from datasets.npy_format import load_npy, save_npy, npy_paths  # noqa
+from datasets.stl10 import STL10  # noqa
+from datasets.svhn import SVHN  # noqa
+
+
+def _convert(root, dataset, split, **meta):
+    if load_npy(root, dataset.npy_name, split) is not None:
+        print(f"{dataset.npy_name}/{split} already converted, delete {npy_paths(root, dataset.npy_name, split)[0]} "
+              f"and the sibling files to convert it again.")
+        return
+    images = np.asarray(dataset.data)
+    labels = np.asarray(getattr(dataset, "targets", getattr(dataset, "labels", None)))
+    classes = [str(c) for c in getattr(dataset, "classes", sorted(set(labels.tolist())))]
+    save_npy(root, dataset.npy_name, split, images, labels, classes=classes, **meta)
+    print(f"{dataset.npy_name}/{split}: {images.shape} images converted.")
+
+
+def convert_cifar(root, DataClass):
+    for split in ("train", "test"):
+        _convert(root, DataClass(root, train=split == "train", download=True), split)
+
+
+def convert_stl10(root):
+    train_set = STL10(root, split="train", download=True)
+    _convert(root, STL10(root, split="train+unlabeled", download=True), "train+unlabeled",
+             num_train=len(train_set))
+    _convert(root, STL10(root, split="test", download=True), "test")
+
+
+def convert_svhn(root):
+    for split in ("train", "test", "extra"):
+        _convert(root, SVHN(root, split=split, download=True), split)
+
+
+def convert_mnist(root):
+    for split in ("train", "test"):
+        _convert(root, MNIST(root, train=split == "train", download=True), split)
+
+
+CONVERTERS = {
+    "cifar10": lambda root: convert_cifar(root, CIFAR10),
+    "cifar100": lambda root: convert_cifar(root, CIFAR100),
+    "stl10": convert_stl10,
+    "svhn": convert_svhn,
+    "mnist": convert_mnist,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert the datasets to memory-mapped npy files.")
+    parser.add_argument("--root", type=str, default=".data", help="data root of the datasets")
+    parser.add_argument("--datasets", type=str, nargs="+", default=list(CONVERTERS.keys()),
+                        choices=list(CONVERTERS.keys()))
+    args = parser.parse_args()
+    for name in args.datasets:
+        CONVERTERS[name](args.root)
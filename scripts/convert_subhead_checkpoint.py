@@ -0,0 +1,93 @@
+"""
+Convert a checkpoint (`last.pth`/`best.pth`) between the former sub-head layout (`heads.<i>.0.weight`) and the grouped
+layout of `explore.arch.grouped_head`, including the optimizer state, so that a run can be resumed with the other
+architecture. Loading only the network weights does not need this script: the grouped heads convert former keys.
+run from the project root:
+    python scripts/convert_subhead_checkpoint.py runs/cifar/best.pth runs/cifar/best_grouped.pth --to grouped
+"""
+import argparse
+import sys
+from pathlib import Path
+
+import torch
+from deepclustering.arch import get_arch
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from explore.arch.grouped_head import legacy_to_grouped, grouped_to_legacy  # noqa
+
+# former architecture name -> grouped architecture name
+GROUPED_ARCHS = {
+    "clusternet5gtwohead": "clusternet5gtwohead_grouped",
+    "clusternet6ctwohead": "clusternet6ctwohead_grouped",
+}
+
+
+def _parameter_names(arch_dict):
+    net = get_arch(arch_dict["name"], {k: v for k, v in arch_dict.items() if k != "name"})
+    return [name for name, _ in net.named_parameters()]
+
+
+def _source_name(name, to_grouped):
+    # name of the parameter whose non-tensor optimizer states (e.g. `step`) are reused
+    if to_grouped:
+        prefix, _, kind = name.rpartition(".")
+        return f"{prefix}.0.0.{kind}" if prefix.endswith("heads") else name
+    parts = name.split(".")
+    if len(parts) >= 4 and parts[-4] == "heads" and parts[-3].isdigit():
+        return ".".join(parts[:-3] + parts[-1:])
+    return name
+
+
+def convert_optimizer_state(optim_state, from_names, to_names, to_grouped):
+    convert = legacy_to_grouped if to_grouped else grouped_to_legacy
+    assert len(optim_state["param_groups"]) == 1, "Only optimizers with a single parameter group are supported."
+    param_ids = optim_state["param_groups"][0]["params"]
+    assert len(param_ids) == len(from_names), (len(param_ids), len(from_names))
+    named_states = {name: optim_state["state"][i] for name, i in zip(from_names, param_ids) if i in optim_state["state"]}
+    state_keys = {k for s in named_states.values() for k in s}
+    new_states = {name: {} for name in to_names}
+    for key in state_keys:
+        tensors = {n: s[key] for n, s in named_states.items() if key in s and torch.is_tensor(s[key]) and s[key].dim()}
+        for name, value in convert(tensors).items():
+            new_states[name][key] = value
+        for name in to_names:
+            source = named_states.get(_source_name(name, to_grouped), {})
+            if key not in new_states[name] and key in source:
+                value = source[key]
+                new_states[name][key] = value.clone() if torch.is_tensor(value) else value
+    new_ids = list(range(len(to_names)))
+    return {
+        "state": {i: new_states[name] for i, name in zip(new_ids, to_names) if new_states[name]},
+        "param_groups": [{**optim_state["param_groups"][0], "params": new_ids}],
+    }
+
+
+def convert_checkpoint(checkpoint, to_grouped):
+    model_state = checkpoint["model"]
+    arch_dict = dict(model_state["arch_dict"])
+    if to_grouped:
+        new_name = GROUPED_ARCHS[arch_dict["name"].lower()]
+    else:
+        new_name = {v: k for k, v in GROUPED_ARCHS.items()}[arch_dict["name"].lower()]
+    new_arch_dict = {**arch_dict, "name": new_name}
+    convert = legacy_to_grouped if to_grouped else grouped_to_legacy
+    new_model_state = {**model_state, "arch_dict": new_arch_dict,
+                       "net_state_dict": convert(model_state["net_state_dict"])}
+    if model_state.get("optim_state_dict") is not None:
+        new_model_state["optim_state_dict"] = convert_optimizer_state(
+            model_state["optim_state_dict"], _parameter_names(arch_dict), _parameter_names(new_arch_dict), to_grouped
+        )
+    return {**checkpoint, "model": new_model_state}
+
+
+if __name__ == "__main__":
+    import explore.arch  # noqa, registers the grouped architectures
+
+    parser = argparse.ArgumentParser(description="convert checkpoints between the former and the grouped sub-heads.")
+    parser.add_argument("checkpoint", type=str, help="checkpoint to convert")
+    parser.add_argument("output", type=str, help="path of the converted checkpoint")
+    parser.add_argument("--to", type=str, choices=("grouped", "legacy"), default="grouped")
+    args = parser.parse_args()
+    checkpoint = torch.load(args.checkpoint, map_location=torch.device("cpu"))
+    torch.save(convert_checkpoint(checkpoint, args.to == "grouped"), args.output)
+    print(f"{args.checkpoint} converted to the {args.to} layout in {args.output}.")
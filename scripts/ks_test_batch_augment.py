@@ -0,0 +1,95 @@
+"""
+Two-sample Kolmogorov-Smirnov tests between the strong PIL transforms and their batched equivalents of
+`datasets.batch_transforms.strong_batch_transforms`. Both pipelines augment the same images, then the distributions
+of the pixel values and of per-image statistics (mean, std, gradient energy) are compared.
+The images are smooth random images unless a converted split is given (see `convert_datasets_to_npy.py`).
+run from the project root: python scripts/ks_test_batch_augment.py --dataset cifar
+                           python scripts/ks_test_batch_augment.py --dataset mnist --root .data --npy_name mnist
+"""
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from scipy.stats import ks_2samp
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from datasets import (  # noqa
+    cifar10_strong_transform,
+    mnist_strong_transform,
+    stl10_strong_transform,
+    svhn_strong_transform,
+)
+from datasets.batch_transforms import strong_batch_transforms  # noqa
+from datasets.npy_format import load_npy  # noqa
+
+PIL_TRANSFORMS = {
+    "cifar": cifar10_strong_transform,
+    "mnist": mnist_strong_transform,
+    "stl10": stl10_strong_transform,
+    "svhn": svhn_strong_transform,
+}
+IMAGE_SHAPES = {"cifar": (32, 32, 3), "mnist": (28, 28), "stl10": (96, 96, 3), "svhn": (32, 32, 3)}
+
+
+def synthetic_images(num_images, shape, seed=0):
+    """
+    smooth uint8 images: upsampled low resolution noise, so that crops and resizes change the statistics.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    channels = shape[2] if len(shape) == 3 else 1
+    low = torch.rand(num_images, channels, shape[0] // 4, shape[1] // 4, generator=generator)
+    images = F.interpolate(low, size=shape[:2], mode="bilinear", align_corners=False)
+    images = (images * 255).round().byte().permute(0, 2, 3, 1)
+    return images.squeeze(3) if len(shape) == 2 else images
+
+
+def statistics(images):
+    """
+    :param images: float (N, C, H, W)
+    :return: dictionary of 1D arrays
+    """
+    images = images.double()
+    grad = (images[..., 1:] - images[..., :-1]).pow(2).mean((1, 2, 3))
+    pixels = images.flatten()
+    subsample = torch.randperm(pixels.numel())[:20000]
+    return {
+        "pixel": pixels[subsample].numpy(),
+        "mean": images.mean((1, 2, 3)).numpy(),
+        "std": images.std((2, 3)).mean(1).numpy(),
+        "gradient": grad.numpy(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KS tests of the batched strong augmentation.")
+    parser.add_argument("--dataset", type=str, default="cifar", choices=list(PIL_TRANSFORMS.keys()))
+    parser.add_argument("--num_images", type=int, default=2000)
+    parser.add_argument("--root", type=str, default=None, help="data root of a converted split")
+    parser.add_argument("--npy_name", type=str, default=None, help="name of the converted dataset, e.g. cifar10")
+    parser.add_argument("--alpha", type=float, default=0.01, help="significance level")
+    args = parser.parse_args()
+
+    if args.root is not None:
+        loaded = load_npy(args.root, args.npy_name or args.dataset, "test")
+        assert loaded is not None, f"{args.npy_name or args.dataset}/test is not converted in {args.root}."
+        images = torch.from_numpy(np.array(loaded[0][:args.num_images]))
+    else:
+        images = synthetic_images(args.num_images, IMAGE_SHAPES[args.dataset])
+    print(f"dataset: {args.dataset}, {images.shape[0]} images with shape {tuple(images.shape[1:])}")
+
+    rejected = 0
+    for name, batch_transform in strong_batch_transforms[args.dataset].items():
+        pil_transform = PIL_TRANSFORMS[args.dataset][name]
+        reference = torch.stack([pil_transform(Image.fromarray(img)) for img in images.numpy()])
+        batched = batch_transform(images)
+        assert reference.shape == batched.shape, (name, reference.shape, batched.shape)
+        reference_stats, batched_stats = statistics(reference), statistics(batched)
+        for stat in reference_stats:
+            d, p = ks_2samp(reference_stats[stat], batched_stats[stat])
+            rejected += p < args.alpha
+            print(f"{name} {stat:>8}: D={d:.4f}, p={p:.4f}{'  <- distributions differ' if p < args.alpha else ''}")
+    print(f"{rejected} test(s) rejected at alpha={args.alpha}.")
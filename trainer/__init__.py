@@ -4,6 +4,7 @@ from .clustering_trainer import *
 from .iic_regularized_trainer import *
 from .iic_trainer import *
 from .imsat_trainer import *
+from .pipeline_trainer import *
 
 trainer_mapping: Dict[str, Type[ClusteringGeneralTrainer]] = {
     # using different transforms for iic
@@ -55,4 +56,8 @@ trainer_mapping: Dict[str, Type[ClusteringGeneralTrainer]] = {
     "iicgeovatmixupcutoutreg": IICVATMixupCutout_RegTrainer,  # todo:checkout
     "iicgeomixupgaussianreg": IICMixupGaussian_RegTrainer,  # todo:checkout
 
+    # regularizations given by `Trainer.regularizers` and forwarded in one batch
+    "imsatpipeline": IMSATPipelineTrainer,  # imsat with a list of regularizations
+    "iicgeopipelinereg": IICPipeline_RegTrainer,  # iicgeo with a list of regularizations
+
 }
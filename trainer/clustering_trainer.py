@@ -1,10 +1,13 @@
 """
 This is the trainer general clustering trainer
 """
+import shutil
+import tempfile
 import time
 from collections import OrderedDict
+from functools import wraps
 from pathlib import Path
-from typing import List, Union, Dict, Tuple
+from typing import List, Union, Dict, Tuple, Optional
 
 import numpy as np
 import torch
@@ -22,15 +25,36 @@ from deepclustering.utils import (
     nice_dict,
     assert_list,
 )
-from deepclustering.utils.classification.assignment_mapping import (
-    flat_acc,
-    hungarian_match,
-)
 from termcolor import colored
 from torch import nn, Tensor
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset, BatchSampler
+
+from datasets.dataset import loader_num_samples
+from RegHelper import pred_histgram, cluster_size_histgram, VATModuleInterface, VATDirectionCache, MixUp, \
+    bn_stats_freezer
+from .distributed import is_distributed, is_main_process, get_rank, all_reduce_sum, all_reduce_gradients, \
+    all_reduce_mean_, broadcast_module, set_sampler_epoch, NullWriter
+from .loss import StackedKL_div, IIDLoss
+from .metrics import confusion_matrices, hungarian_from_confusion, nmi_ari_from_confusion
+from .prefilter import attach_prefilter
+
 
-from RegHelper import pred_histgram, VATModuleInterface, MixUp
+def _broadcast_views(tf1_pred_simplex: List[Tensor], tf2_pred_simplex: List[Tensor]) -> List[Tensor]:
+    """
+    Repeat tf1 predictions against the N tf2 views when tf1 is forwarded only once (`dedup_tf1`).
+    tf2 images are concatenated view by view, so the tf1 predictions are tiled N times along the batch. The losses
+    take predictions of the same shape, so the (n*b, k) predictions are copied: only the forwards of the repeated tf1
+    images are saved, not their memory.
+    :param tf1_pred_simplex: list of simplexes with shape (b, k)
+    :param tf2_pred_simplex: list of simplexes with shape (n*b, k)
+    :return: list of tf1 simplexes with shape (n*b, k)
+    """
+    num_views, remainder = divmod(tf2_pred_simplex[0].size(0), tf1_pred_simplex[0].size(0))
+    assert remainder == 0, f"tf2 predictions should be a multiple of tf1 predictions, " \
+        f"given {tf2_pred_simplex[0].shape} and {tf1_pred_simplex[0].shape}."
+    if num_views == 1:
+        return tf1_pred_simplex
+    return [p.repeat(num_views, 1) for p in tf1_pred_simplex]
 
 
 class GuassianAdder:
@@ -68,52 +92,528 @@ class TensorCutout:
         self.max_box = int(max_box)
         self.pad_value = pad_value
 
-    def _cutout_per_image(self, image_tensor: Tensor) -> Tensor:
+    def __call__(self, img_tensors: Tensor, inplace: bool = False) -> Tensor:
         """
-        Here the input should be one tensor image.
-        :param image_tensor:
-        :return:
+        Remove one box per image for the whole batch at once. Box sizes and centers are drawn on the device of
+        `img_tensors` and the boxes are applied with a single broadcast mask.
+        :param img_tensors: images with shape (b, c, h, w)
+        :param inplace: fill the boxes of `img_tensors` in place instead of returning a new tensor. Do not use it on
+        images which are still needed elsewhere, such as tf1_images.
+        :return: images with the boxes filled with `pad_value`
         """
-        c, h, w = image_tensor.shape
-        r_img_tensor = (
-            image_tensor.copy()
-            if isinstance(image_tensor, np.ndarray)
-            else image_tensor.clone()
-        )
-        # find left, upper, right, lower
-        box_sz = np.random.randint(self.min_box, self.max_box + 1)
-        half_box_sz = int(np.floor(box_sz / 2.0))
-        x_c = np.random.randint(half_box_sz, w - half_box_sz)
-        y_c = np.random.randint(half_box_sz, h - half_box_sz)
-        box = (
-            x_c - half_box_sz,
-            y_c - half_box_sz,
-            x_c + half_box_sz,
-            y_c + half_box_sz,
-        )
-        r_img_tensor[:, box[1]: box[3], box[0]: box[2]] = self.pad_value
-        return r_img_tensor
-
-    def __call__(self, img_tensors: Tensor) -> Tensor:
         assert isinstance(img_tensors, Tensor)
         b, c, h, w = img_tensors.shape
-        r_img_tensors = torch.stack([self._cutout_per_image(img) for img in img_tensors], dim=0)
-        return r_img_tensors
+        device = img_tensors.device
+        box_sz = torch.randint(self.min_box, self.max_box + 1, (b,), device=device)
+        half_box_sz = box_sz // 2
+        # centers are uniform in [half_box_sz, size - half_box_sz)
+        x_c = half_box_sz + (torch.rand(b, device=device) * (w - 2 * half_box_sz).float()).long()
+        y_c = half_box_sz + (torch.rand(b, device=device) * (h - 2 * half_box_sz).float()).long()
+        xs = torch.arange(w, device=device).view(1, 1, w)
+        ys = torch.arange(h, device=device).view(1, h, 1)
+        x_c, y_c, half_box_sz = x_c.view(b, 1, 1), y_c.view(b, 1, 1), half_box_sz.view(b, 1, 1)
+        # mask with shape (b, 1, h, w), broadcast over the channels
+        mask = (
+                (xs >= x_c - half_box_sz) & (xs < x_c + half_box_sz)
+                & (ys >= y_c - half_box_sz) & (ys < y_c + half_box_sz)
+        ).unsqueeze(1)
+        if inplace:
+            return img_tensors.masked_fill_(mask, self.pad_value)
+        return img_tensors.masked_fill(mask, self.pad_value)
+
+
+class PredictionCache:
+    """
+    Step-scoped cache for model predictions, keyed by (tensor identity, tensor version, head, grad-mode).
+    The trainer resets it at the beginning and the end of each step, so that predictions are never reused after
+    the parameters have been updated. A reference to the input tensor is kept so that its `id` cannot be recycled
+    within the step, and the version counter invalidates entries of tensors modified in place.
+    """
+
+    def __init__(self) -> None:
+        self._cache: Dict[tuple, Tuple[Tensor, List[Tensor]]] = {}
+
+    @staticmethod
+    def _key(images: Tensor, head_name: str, grad_enabled: bool) -> tuple:
+        return id(images), images._version, head_name, grad_enabled
+
+    def get(self, images: Tensor, head_name: str) -> Union[List[Tensor], None]:
+        """
+        :param images: input tensor
+        :param head_name: head name for model inference
+        :return: cached list of simplexes or None. Under `torch.no_grad()`, a prediction computed with grad is
+        reused in its detached form.
+        """
+        grad_enabled = torch.is_grad_enabled()
+        entry = self._cache.get(self._key(images, head_name, grad_enabled))
+        if entry is not None:
+            return entry[1]
+        if not grad_enabled:
+            entry = self._cache.get(self._key(images, head_name, True))
+            if entry is not None:
+                return [p.detach() for p in entry[1]]
+        return None
+
+    def put(self, images: Tensor, head_name: str, preds: List[Tensor]) -> None:
+        self._cache[self._key(images, head_name, torch.is_grad_enabled())] = (images, preds)
+
+    def reset(self) -> None:
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class TeacherCache:
+    """
+    Detached predictions of the clean tf1 images kept across steps, per head, as a float16 (N, H, K) tensor indexed by
+    the dataset index of the samples, with the step at which each sample was predicted. Predictions are refreshed
+    each time the samples are forwarded, and a batch is served from the cache when all its samples are at most
+    `max_staleness` steps old, so that the no-grad forwards computing the targets of the regularizations are skipped.
+    The cache is kept on the device of the predictions and is not saved in the checkpoints.
+    """
+
+    def __init__(self, max_staleness: int = 0, dtype: torch.dtype = torch.float16) -> None:
+        """
+        :param max_staleness: maximum number of optimizer steps since the prediction of a cached sample
+        :param dtype: storage type of the simplexes
+        """
+        assert max_staleness >= 0, f"max_staleness should be non-negative, given {max_staleness}."
+        self.max_staleness = max_staleness
+        self.dtype = dtype
+        self._simplexes: Dict[str, Tensor] = {}
+        self._steps: Dict[str, Tensor] = {}  # -1 for the samples never predicted
+
+    def _reserve(self, head_name: str, size: int, shape: torch.Size, device: torch.device) -> None:
+        simplexes = self._simplexes.get(head_name)
+        if simplexes is not None and (simplexes.shape[1:] != shape or simplexes.device != device):
+            # the number of active sub-heads changed
+            simplexes = None
+        current_size = 0 if simplexes is None else simplexes.shape[0]
+        if size <= current_size:
+            return
+        size = max(size, 2 * current_size)
+        new_simplexes = torch.zeros(size, *shape, dtype=self.dtype, device=device)
+        new_steps = torch.full((size,), -1, dtype=torch.long, device=device)
+        if current_size:
+            new_simplexes[:current_size] = simplexes
+            new_steps[:current_size] = self._steps[head_name]
+        self._simplexes[head_name], self._steps[head_name] = new_simplexes, new_steps
+
+    def put(self, head_name: str, indices: Tensor, preds: List[Tensor], step: int) -> None:
+        """
+        :param head_name: head of the predictions
+        :param indices: dataset indices of the samples, the last one is kept for repeated indices
+        :param preds: list of H simplexes with shape (N, K)
+        :param step: current optimizer step
+        """
+        stacked = torch.stack([p.detach() for p in preds], dim=1)  # (N, H, K)
+        self._reserve(head_name, int(indices.max()) + 1, stacked.shape[1:], stacked.device)
+        indices = indices.to(stacked.device)
+        self._simplexes[head_name][indices] = stacked.to(self.dtype)
+        self._steps[head_name][indices] = step
+
+    def get(self, head_name: str, indices: Tensor, step: int) -> Union[List[Tensor], None]:
+        """
+        :return: list of H float simplexes with shape (N, K) if all the samples are fresh enough, otherwise None
+        """
+        simplexes = self._simplexes.get(head_name)
+        if simplexes is None or int(indices.max()) >= simplexes.shape[0]:
+            return None
+        indices = indices.to(simplexes.device)
+        steps = self._steps[head_name][indices]
+        if bool(((steps < 0) | (step - steps > self.max_staleness)).any()):
+            return None
+        cached = simplexes[indices].float()
+        cached = cached / cached.sum(dim=2, keepdim=True)  # renormalized after the float16 rounding
+        return list(cached.unbind(dim=1))
+
+    def reset(self) -> None:
+        self._simplexes.clear()
+        self._steps.clear()
+
+
+class MeterBuffer:
+    """
+    Deferred accumulation of training statistics. Values are kept as detached tensors on their device and are only
+    copied to the host when `flush` is called, so that the training loop does not synchronize with the device on each
+    `.item()`. Values are replayed into the meters in the order they were added, keeping the meter summaries unchanged.
+    """
+
+    def __init__(self) -> None:
+        self._buffer: List[Tuple[str, Union[Tensor, float]]] = []
+
+    def add(self, meter_name: str, value: Union[Tensor, float]) -> None:
+        """
+        :param meter_name: name of the meter registered in the MeterInterface
+        :param value: scalar tensor or python number
+        """
+        if isinstance(value, Tensor):
+            assert value.numel() == 1, f"Only scalar tensors can be recorded, given shape {value.shape}."
+            value = value.detach().reshape(())
+        self._buffer.append((meter_name, value))
+
+    def flush(self, meter_interface: MeterInterface) -> None:
+        """
+        move all the buffered values to the meters with a single device-to-host copy.
+        :param meter_interface: MeterInterface holding the meters
+        """
+        if not self._buffer:
+            return
+        tensor_positions = [i for i, (_, v) in enumerate(self._buffer) if isinstance(v, Tensor)]
+        values = [v for _, v in self._buffer]
+        if tensor_positions:
+            host_values = torch.stack([values[i].float() for i in tensor_positions]).cpu().tolist()
+            for i, v in zip(tensor_positions, host_values):
+                values[i] = v
+        for (meter_name, _), v in zip(self._buffer, values):
+            meter_interface[meter_name].add(v)
+        self._buffer.clear()
+
+    def __len__(self):
+        return len(self._buffer)
+
+
+class SubHeadPruner:
+    """
+    Drop the worst sub-heads from the training computation. Each head keeps an exponential moving average of the
+    per-subhead training loss (the IIC loss or the negative IMSAT MI, no label is used). After `warmup` epochs and
+    every `interval` epochs, the `drop` active sub-heads with the highest average loss are frozen, until `keep` remain.
+    During `_train_loop`, the heads only hold their active sub-heads, so that the forward, the losses and the
+    regularizations are computed on them only. Outside of it the heads are complete, so that the evaluation, the
+    reports and the checkpoints include the frozen sub-heads. Frozen weights are restored after each optimizer step,
+    as the optimizer may still move parameters having no gradient (momentum, weight decay).
+    """
+
+    def __init__(self, torchnet: nn.Module, num_sub_heads: int, warmup: int = 10, interval: int = 5, drop: int = 1,
+                 keep: int = 1, momentum: float = 0.9) -> None:
+        """
+        :param torchnet: two-head network
+        :param num_sub_heads: number of sub-heads of each head
+        :param warmup: epochs trained with all the sub-heads
+        :param interval: epochs between two prunings
+        :param drop: number of sub-heads frozen at each pruning
+        :param keep: minimum number of active sub-heads
+        :param momentum: momentum of the moving average of the losses
+        """
+        assert 1 <= keep <= num_sub_heads, f"`keep` should be in [1, {num_sub_heads}], given {keep}."
+        assert warmup >= 0 and interval >= 1 and drop >= 1, (warmup, interval, drop)
+        self.torchnet = torchnet
+        self.num_sub_heads = num_sub_heads
+        self.warmup, self.interval, self.drop, self.keep, self.momentum = warmup, interval, drop, keep, momentum
+        self.head_names = [h for h in ("A", "B") if hasattr(torchnet, f"head_{h}")]
+        self.active: Dict[str, List[int]] = {h: list(range(num_sub_heads)) for h in self.head_names}
+        self._loss_ema: Dict[str, Tensor] = {}
+        self._frozen: Dict[str, List[Tuple[Tensor, Tensor]]] = {h: [] for h in self.head_names}
+        self._full_heads: Dict[str, nn.ModuleList] = {}
+
+    def record(self, head_name: str, losses: Tensor) -> None:
+        """
+        :param head_name: head of the losses
+        :param losses: losses of the active sub-heads with shape (num_active,), kept on device
+        """
+        losses = losses.detach().float()
+        active = self.active[head_name]
+        assert losses.shape == (len(active),), f"Expected {len(active)} sub-head losses, given {losses.shape}."
+        if head_name not in self._loss_ema:
+            self._loss_ema[head_name] = torch.full((self.num_sub_heads,), float("nan"), device=losses.device)
+        ema = self._loss_ema[head_name] = self._loss_ema[head_name].to(losses.device)
+        index = torch.tensor(active, device=losses.device)
+        previous = ema[index]
+        ema[index] = torch.where(torch.isnan(previous), losses, self.momentum * previous + (1 - self.momentum) * losses)
+
+    def step(self, epoch: int) -> None:
+        """
+        freeze the worst sub-heads at the end of `epoch` if it is a pruning epoch.
+        """
+        if epoch + 1 < self.warmup or (epoch + 1 - self.warmup) % self.interval != 0:
+            return
+        # the ranks of a distributed training have to freeze the same sub-heads
+        all_reduce_mean_(self._loss_ema.values())
+        for head_name in self.head_names:
+            active = self.active[head_name]
+            num_drop = min(self.drop, len(active) - self.keep)
+            if num_drop <= 0 or head_name not in self._loss_ema:
+                continue
+            losses = self._loss_ema[head_name][active].tolist()
+            ranked = sorted(range(len(active)), key=lambda i: losses[i], reverse=True)
+            dropped = sorted(active[i] for i in ranked[:num_drop])
+            self.active[head_name] = [i for i in active if i not in dropped]
+            print(f"Epoch {epoch}: sub-heads {dropped} of head {head_name} frozen, "
+                  f"active sub-heads: {self.active[head_name]}.")
+        self._snapshot()
+
+    def _sub_head_tensors(self, head_name: str, sub_head: int) -> List[Tensor]:
+        head = getattr(self.torchnet, f"head_{head_name}")
+        heads = self._full_heads.get(head_name, head.heads)
+        if isinstance(heads, nn.ModuleList):
+            return list(heads[sub_head].parameters())
+        return [heads.weight[sub_head], heads.bias[sub_head]]  # grouped sub-heads, views of the parameters
+
+    def _snapshot(self) -> None:
+        for head_name in self.head_names:
+            frozen = sorted(set(range(self.num_sub_heads)) - set(self.active[head_name]))
+            self._frozen[head_name] = [(t, t.detach().clone()) for i in frozen
+                                       for t in self._sub_head_tensors(head_name, i)]
+
+    @torch.no_grad()
+    def restore_frozen(self) -> None:
+        for frozen in self._frozen.values():
+            for tensor, value in frozen:
+                tensor.copy_(value)
+
+    def select(self) -> None:
+        """
+        keep only the active sub-heads in the heads, until `restore`.
+        """
+        for head_name in self.head_names:
+            active = self.active[head_name]
+            if len(active) == self.num_sub_heads:
+                continue
+            head = getattr(self.torchnet, f"head_{head_name}")
+            if isinstance(head.heads, nn.ModuleList):
+                self._full_heads[head_name] = head.heads
+                head.heads = nn.ModuleList([head.heads[i] for i in active])
+                head.num_sub_heads = len(active)
+            else:
+                head.set_active_sub_heads(active)
+
+    def restore(self) -> None:
+        for head_name in self.head_names:
+            head = getattr(self.torchnet, f"head_{head_name}")
+            if head_name in self._full_heads:
+                head.heads = self._full_heads.pop(head_name)
+                head.num_sub_heads = self.num_sub_heads
+            elif not isinstance(head.heads, nn.ModuleList):
+                head.set_active_sub_heads(None)
+
+    def state_dict(self) -> dict:
+        return {"active": self.active, "loss_ema": {h: v.cpu() for h, v in self._loss_ema.items()}}
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        self.active = {h: list(v) for h, v in state_dict["active"].items()}
+        self._loss_ema = dict(state_dict["loss_ema"])
+        # the network is loaded first, the frozen weights are taken from the checkpoint
+        self._snapshot()
+
+
+class RegScheduler:
+    """
+    Per-regularization schedule, given in the `reg_schedule` section of the Trainer config, e.g.
+    >>> reg_schedule = {"VAT": {"every_n_steps": 4, "batch_fraction": 0.5, "warmup_steps": 1000}}
+    `every_n_steps`: the regularization is only computed every n training steps, with its loss scaled by n (as the
+    lazy R1 regularization of GANs), and is zero in between;
+    `batch_fraction`: the regularization is computed on a random fraction of the batch;
+    `warmup_steps`: the loss is scaled by a linear ramp from 0 to 1 during the first training steps.
+    Regularizations without schedule are computed at every step on the whole batch.
+    """
+    OPTIONS = ("every_n_steps", "batch_fraction", "warmup_steps")
+
+    def __init__(self, schedules: Dict[str, Dict[str, Union[int, float]]] = None) -> None:
+        self.schedules: Dict[str, Dict[str, Union[int, float]]] = {}
+        for name, schedule in (schedules or {}).items():
+            assert set(schedule) <= set(self.OPTIONS), \
+                f"Schedule options of {name} should be in {self.OPTIONS}, given {list(schedule)}."
+            schedule = {"every_n_steps": 1, "batch_fraction": 1.0, "warmup_steps": 0, **schedule}
+            assert int(schedule["every_n_steps"]) >= 1 and int(schedule["warmup_steps"]) >= 0, schedule
+            assert 0 < float(schedule["batch_fraction"]) <= 1, schedule
+            self.schedules[name] = schedule
+        # number of optimizer steps since the beginning of the training
+        self.step = 0
+
+    def is_active(self, name: str) -> bool:
+        schedule = self.schedules.get(name)
+        return schedule is None or self.step % int(schedule["every_n_steps"]) == 0
+
+    def weight(self, name: str) -> float:
+        schedule = self.schedules.get(name)
+        if schedule is None:
+            return 1.0
+        warmup_steps = int(schedule["warmup_steps"])
+        ramp = min(1.0, (self.step + 1) / warmup_steps) if warmup_steps else 1.0
+        return ramp * int(schedule["every_n_steps"])
+
+    def batch_fraction(self, name: str) -> float:
+        return float(self.schedules.get(name, {}).get("batch_fraction", 1.0))
+
+    def state_dict(self) -> dict:
+        return {"step": self.step}
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        self.step = state_dict["step"]
+
+
+def _subsample_batch(values: tuple, fraction: float) -> tuple:
+    """
+    restrict the tensors and the lists of tensors of `values` to a random fraction of the batch. The batch size N is
+    the one of the first tensor, tensors stacking m views of the batch (m * N samples) keep the same samples in each
+    view. Other values are returned unchanged.
+    """
+    first = next(v if isinstance(v, Tensor) else v[0] for v in values
+                 if isinstance(v, Tensor) or (isinstance(v, list) and v and isinstance(v[0], Tensor)))
+    batch_size = first.shape[0]
+    index = torch.randperm(batch_size, device=first.device)[:max(1, int(round(batch_size * fraction)))]
+
+    def _take(t: Tensor) -> Tensor:
+        if t.dim() == 0 or t.shape[0] % batch_size != 0:
+            return t
+        views = t.shape[0] // batch_size
+        return t[(index.to(t.device).unsqueeze(0) + batch_size * torch.arange(views, device=t.device)[:, None]).view(-1)]
+
+    return tuple(
+        _take(v) if isinstance(v, Tensor) else
+        [_take(x) for x in v] if isinstance(v, list) and v and all(isinstance(x, Tensor) for x in v) else v
+        for v in values
+    )
+
+
+def scheduled_regularization(name: str, num_outputs: int = 1):
+    """
+    apply the `RegScheduler` schedule of `name` to a regularization method of the mixins below and record its cost,
+    as the number of samples forwarded by the network, in `train_<name>_cost`.
+    :param name: name of the regularization in the `reg_schedule` config
+    :param num_outputs: the loss is the first of `num_outputs` outputs, the others are None on skipped steps
+    """
+
+    def decorator(regularization):
+        @wraps(regularization)
+        def wrapper(self, *args, **kwargs):
+            scheduler: RegScheduler = getattr(self, "_reg_scheduler", None)
+            if scheduler is None:
+                return regularization(self, *args, **kwargs)
+            if not scheduler.is_active(name):
+                loss = torch.zeros((), device=self.device)
+                return loss if num_outputs == 1 else (loss, *[None] * (num_outputs - 1))
+            if scheduler.batch_fraction(name) < 1:
+                args = _subsample_batch(args, scheduler.batch_fraction(name))
+            forward_samples = self._forward_samples
+            outputs = regularization(self, *args, **kwargs)
+            self._reg_costs[name] = self._reg_costs.get(name, 0) + self._forward_samples - forward_samples
+            weight = scheduler.weight(name)
+            if weight == 1:
+                return outputs
+            return outputs * weight if num_outputs == 1 else (outputs[0] * weight, *outputs[1:])
+
+        return wrapper
+
+    return decorator
+
+
+class _IndexedSubset(Dataset):
+    """
+    Subset of a dataset whose items are whole batches (the evaluation cache or a batch fetch dataset).
+    """
+
+    def __init__(self, dataset: Dataset, indices: Tensor) -> None:
+        self.dataset = dataset
+        self.indices = indices
+
+    def __getitem__(self, index: slice):
+        return self.dataset[self.indices[index].numpy()]
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def stratified_subset_indices(targets: Tensor, subset_size: int, seed: int = 0) -> Tensor:
+    """
+    sample indices keeping the class proportions of `targets`.
+    :param targets: class labels with shape (N,)
+    :param subset_size: number of indices to draw
+    :param seed: seed of the sampling, so that all the intermediate evaluations use the same subset
+    :return: sorted LongTensor of indices
+    """
+    targets = targets.cpu()
+    generator = torch.Generator().manual_seed(seed)
+    classes, counts = targets.unique(return_counts=True)
+    quotas = (counts.double() * subset_size / len(targets)).round().long().clamp_(min=1)
+    indices = []
+    for c, quota in zip(classes, quotas):
+        class_indices = (targets == c).nonzero().view(-1)
+        choice = torch.randperm(len(class_indices), generator=generator)[:quota]
+        indices.append(class_indices[choice])
+    return torch.cat(indices).sort()[0]
+
+
+def subset_loader(val_loader: DataLoader, indices: Tensor) -> DataLoader:
+    """
+    build a loader iterating only the `indices` of `val_loader.dataset`, with the same loading settings.
+    """
+    if val_loader.batch_size is None:
+        # batches are produced by the dataset itself from slices or from the index lists of a BatchSampler
+        if isinstance(val_loader.sampler, BatchSampler):
+            batch_size = val_loader.sampler.batch_size
+        else:
+            batch_size = max(s.stop - s.start for s in val_loader.sampler)
+        slices = [slice(i, i + batch_size) for i in range(0, len(indices), batch_size)]
+        loader = DataLoader(
+            _IndexedSubset(val_loader.dataset, indices),
+            batch_size=None,
+            sampler=slices,
+            num_workers=val_loader.num_workers,
+            collate_fn=val_loader.collate_fn,
+            pin_memory=val_loader.pin_memory,
+        )
+    else:
+        loader = DataLoader(
+            torch.utils.data.Subset(val_loader.dataset, indices.tolist()),
+            batch_size=val_loader.batch_size,
+            shuffle=False,
+            num_workers=val_loader.num_workers,
+            collate_fn=val_loader.collate_fn,
+            pin_memory=val_loader.pin_memory,
+        )
+    setattr(loader, "dataset_name", getattr(val_loader, "dataset_name", None))
+    return loader
 
 
 class VATReg:
+    """
+    VAT_params may contain, besides the parameters of `VATModuleInterface`:
+    `direction_cache`: warm-start the power iteration from the direction found for the same sample at the previous
+    epoch, so that `ip: 1` is enough;
+    `fraction`: the power iteration only runs on this random fraction of the batch, the other samples keep their
+    cached (or random) direction.
+    """
 
     def __init__(self, VAT_params: Dict[str, Union[str, float]] = {"eps": 10}, MeterInterface=None) -> None:
         # super().__init__()
 
         self.VAT_params = VAT_params
+        VAT_params = dict(VAT_params)
+        direction_cache = VAT_params.pop("direction_cache", False)
+        self.vat_fraction = float(VAT_params.pop("fraction", 1.0))
+        assert 0 < self.vat_fraction <= 1, f"VAT fraction should be in (0, 1], given {self.vat_fraction}."
         self.vat_module = VATModuleInterface(VAT_params)
+        self._vat_directions = VATDirectionCache() if direction_cache else None
         self.MeterInterface = MeterInterface
         if self.MeterInterface:
             self.MeterInterface.register_new_meter("train_adv", AverageValueMeter())
 
+    def _vat_sample_indices(self, img: Tensor) -> Optional[Tensor]:
+        # dataset indices of the current step, repeated when `img` stacks several views of the batch
+        indices = getattr(self, "_batch_indices", None)
+        if indices is None or img.shape[0] % indices.shape[0] != 0:
+            return None
+        return indices.repeat(img.shape[0] // indices.shape[0])
+
+    @scheduled_regularization("VAT", num_outputs=3)
     def _vat_regularization(self, model: Model, img: Tensor, head="B") -> Tuple[Tensor, Tensor, Tensor]:
-        vat_loss, adv_image, noise = self.vat_module(model, img, head=head)
+        # the clean prediction is taken from the step cache if `img` has already been forwarded, or from the teacher
+        # cache if enabled.
+        pred = self._teacher_predict(img, head)
+        indices = self._vat_sample_indices(img) if self._vat_directions is not None else None
+        direction = self._vat_directions.get(indices, img) if indices is not None else None
+        refine_index = None
+        if self.vat_fraction < 1:
+            num_refined = max(1, int(round(img.shape[0] * self.vat_fraction)))
+            refine_index = torch.randperm(img.shape[0], device=img.device)[:num_refined]
+        vat_loss, adv_image, noise = self.vat_module(
+            model, img, pred=pred, direction=direction, refine_index=refine_index, head=head
+        )
+        if indices is not None:
+            refined = noise.detach() if refine_index is None else noise.detach()[refine_index]
+            self._vat_directions.put(indices if refine_index is None else indices[refine_index.cpu()], refined)
         if self.MeterInterface:
             self.MeterInterface["train_adv"].add(vat_loss.item())
         return vat_loss, adv_image, noise
@@ -124,7 +624,9 @@ class GeoReg:
     def __init__(self) -> None:
         # super().__init__()
         self.kl_div = KL_div(reduce=True)
+        self.stacked_kl_div = StackedKL_div()
 
+    @scheduled_regularization("Geo")
     def _geo_regularization(self, tf1_pred_simplex, tf2_pred_simplex) -> Tensor:
         """
         :param tf1_pred_simplex: basic
@@ -136,22 +638,26 @@ class GeoReg:
                 and assert_list(simplex, tf2_pred_simplex)
                 and tf1_pred_simplex.__len__() == tf2_pred_simplex.__len__()
         ), f"Error on tf1 and tf2 predictions."
-        _batch_loss: List[torch.Tensor] = []  # type: ignore
-        for subhead in range(tf1_pred_simplex.__len__()):
-            _loss = self.kl_div(
-                tf2_pred_simplex[subhead], tf1_pred_simplex[subhead].detach()
-            )
-            _batch_loss.append(_loss)
-        batch_loss: torch.Tensor = sum(_batch_loss) / len(_batch_loss)  # type:ignore
+        tf1_pred_simplex = _broadcast_views(tf1_pred_simplex, tf2_pred_simplex)
+        # kl of all the subheads computed at once
+        batch_loss: torch.Tensor = self.stacked_kl_div(
+            tf2_pred_simplex, [p.detach() for p in tf1_pred_simplex]
+        ).mean()
         return batch_loss
 
 
 class MixupReg:
 
-    def __init__(self) -> None:
+    def __init__(self, shared_forward: bool = False) -> None:
+        """
+        :param shared_forward: mix the images once with alphas shared by all the subheads and forward the mixup image
+        once, instead of one mixup image and one forward per subhead.
+        """
         # super().__init__()
         self.mixup_module = MixUp(self.device, num_classes=self.model.arch_dict["output_k_B"])
         self.kl_div = KL_div(reduce=True)
+        self.stacked_kl_div = StackedKL_div()
+        self.mixup_shared_forward = shared_forward
 
     def _mixup_image_pred_index(self, tf1_image, tf1_pred, tf2_image, tf2_pred) -> Tuple[Tensor, Tensor, Tensor]:
         """
@@ -163,6 +669,30 @@ class MixupReg:
         )
         return mixup_img, mixup_label, mixup_index
 
+    @scheduled_regularization("Mixup")
+    def _mixup_regularization(self, images: Tensor, img_pred_simplex: List[Tensor], head_name="B") -> Tensor:
+        """
+        KL between the predictions on the mixup of `images` with its flipped batch and the mixup of the predictions.
+        :param images: basic transformed images
+        :param img_pred_simplex: list of simplexes on `images`
+        :param head_name: head name for model inference
+        :return: loss averaged over subheads
+        """
+        if self.mixup_shared_forward:
+            mixup_img, mixup_labels, _ = self.mixup_module.mixup_multihead(
+                images, img_pred_simplex, images.flip(0), [p.flip(0) for p in img_pred_simplex]
+            )
+            mixup_pred_simplex = self._predict(mixup_img, head_name)
+            return self.stacked_kl_div(mixup_pred_simplex, mixup_labels).mean()
+        reg_losses: List[Tensor] = []
+        for subhead, tf1_pred in enumerate(img_pred_simplex):
+            mixup_img, mixup_label, mixup_index = self._mixup_image_pred_index(
+                images, tf1_pred, images.flip(0), tf1_pred.flip(0)
+            )
+            subhead_loss = self.kl_div(self._predict(mixup_img, head_name)[subhead], mixup_label)
+            reg_losses.append(subhead_loss)
+        return sum(reg_losses) / len(reg_losses)  # type: ignore
+
 
 class GaussianReg:
 
@@ -170,7 +700,9 @@ class GaussianReg:
         # super().__init__()
         self.gaussian_adder = GuassianAdder(gaussian_std)
         self.kl_div = KL_div(reduce=True)
+        self.stacked_kl_div = StackedKL_div()
 
+    @scheduled_regularization("Gaussian")
     def _gaussian_regularization(self, model: Model, tf1_images, tf1_pred_simplex: List[Tensor],
                                  head_name="B") -> Tensor:
         """
@@ -180,14 +712,11 @@ class GaussianReg:
         :return:  loss
         """
         _tf1_images_gaussian = self.gaussian_adder(tf1_images)
-        _tf1_gaussian_simplex = model.torchnet(_tf1_images_gaussian, head=head_name)
+        _tf1_gaussian_simplex = self._predict(_tf1_images_gaussian, head_name)
         assert assert_list(simplex, tf1_pred_simplex)
         assert assert_list(simplex, _tf1_gaussian_simplex)
         assert tf1_pred_simplex.__len__() == _tf1_gaussian_simplex.__len__()
-        reg_loss = []
-        for __tf1_simplex, __tf1_gaussian_simplex in zip(tf1_pred_simplex, _tf1_gaussian_simplex):
-            reg_loss.append(self.kl_div(__tf1_gaussian_simplex, __tf1_simplex.detach()))
-        return sum(reg_loss) / len(reg_loss)  # type: ignore
+        return self.stacked_kl_div(_tf1_gaussian_simplex, [p.detach() for p in tf1_pred_simplex]).mean()
 
 
 class CutoutReg:
@@ -202,15 +731,14 @@ class CutoutReg:
         print(
             colored(f"Initialize `Cutout` with max_box={max_box}, min_box={min_box}, pad_value={pad_value}.", "green"))
         self.kl_div = KL_div(reduce=True)
+        self.stacked_kl_div = StackedKL_div()
 
+    @scheduled_regularization("Cutout")
     def _cutout_regularization(self, model, tf1_images: Tensor, tf1_pred_simplex: List[Tensor],
                                head_name="B") -> Tensor:
         _tf1_cutout_images = self._cutout_images(tf1_images)
-        _tf1_cutout_pred_simplex = model.torchnet(_tf1_cutout_images, head=head_name)
-        _loss: List[Tensor] = []
-        for head_num, (_tf1_cutout_pred, _tf1_pred) in enumerate(zip(_tf1_cutout_pred_simplex, tf1_pred_simplex)):
-            _loss.append(self.kl_div(_tf1_cutout_pred, _tf1_pred.detach()))
-        loss: Tensor = sum(_loss) / len(_loss)  # type: ignore
+        _tf1_cutout_pred_simplex = self._predict(_tf1_cutout_images, head_name)
+        loss: Tensor = self.stacked_kl_div(_tf1_cutout_pred_simplex, [p.detach() for p in tf1_pred_simplex]).mean()
         return loss
 
     def _cutout_images(self, image):
@@ -218,10 +746,18 @@ class CutoutReg:
         return self.tensorcutout(image)
 
 
+# regularization mixins, by their name in the `reg_schedule` config
+REGULARIZATIONS = OrderedDict(
+    [("VAT", VATReg), ("Geo", GeoReg), ("Mixup", MixupReg), ("Gaussian", GaussianReg), ("Cutout", CutoutReg)]
+)
+
+
 class ClusteringGeneralTrainer(_Trainer):
     # project save dirs for training statistics
     RUN_PATH = str(Path(__file__).parent.parent / "runs")
     ARCHIVE_PATH = str(Path(__file__).parent.parent / "archives")
+    # regularizations whose outputs replace the images of the main loss, which cannot be skipped
+    _unscheduled_regularizations: Tuple[str, ...] = ()
 
     def __init__(
             self,
@@ -237,8 +773,25 @@ class ClusteringGeneralTrainer(_Trainer):
             head_control_params: Dict[str, int] = {"B": 1},
             use_sobel: bool = False,  # both IIC and IMSAT may need this sobel filter
             config: dict = None,
+            dedup_tf1: bool = False,  # forward tf1 once and repeat its predictions for the tf2 views
+            meter_flush_interval: int = 10,  # steps between two copies of the training statistics to the host
+            report_interval: int = 10,  # steps between two refreshes of the progress bar
+            eval_interval: int = 1,  # evaluate every `eval_interval` epochs, the last epoch is always evaluated
+            full_eval_interval: int = 1,  # full evaluation every `full_eval_interval` epochs and at the last epoch
+            eval_subset_size: int = None,  # size of the stratified subset used by the other evaluations
+            streaming_eval: bool = False,  # evaluate from confusion matrices without storing the predictions
+            fold_sobel: bool = False,  # rgb images through one frozen grey+sobel filter before the trunk, see prefilter.py
+            joint_heads: bool = False,  # one trunk forward feeds head A and head B, with a weighted sum of the losses
+            joint_head_weights: Dict[str, float] = None,  # loss weights of the joint mode, `head_control_params` if None
+            subhead_pruning: Dict[str, Union[int, float]] = None,  # parameters of `SubHeadPruner`, None to disable
+            reg_schedule: Dict[str, Dict[str, Union[int, float]]] = None,  # see `RegScheduler`, None to disable
+            teacher_cache: Dict[str, int] = None,  # parameters of `TeacherCache`, None to disable
             **kwargs,
     ) -> None:
+        if is_distributed() and not is_main_process():
+            # metrics and checkpoints are written by rank 0 only: the run directory, its config and the tensorboard
+            # writer created by the base trainer go to a temporary directory, removed once the null writer is set.
+            self.RUN_PATH = tempfile.mkdtemp(prefix=f"rank{get_rank()}_")
         super().__init__(
             model,
             None,
@@ -258,9 +811,73 @@ class ClusteringGeneralTrainer(_Trainer):
         self.criterion = criterion
         self.criterion.to(self.device)
         self.use_sobel = use_sobel
-        if self.use_sobel:
+        assert use_sobel or not fold_sobel, f"`fold_sobel` requires `use_sobel`, given {use_sobel} and {fold_sobel}."
+        self.fold_sobel = fold_sobel
+        if self.use_sobel and self.fold_sobel:
+            # the loaders output rgb images (see main.py), converted to grey and filtered by one frozen convolution in
+            # front of the trunk. The regularizations perturbing the images (VAT, mixup, Gaussian, Cutout) then act on
+            # the rgb images before the sobel filter, instead of on the sobel responses.
+            attach_prefilter(self.model.torchnet)
+        elif self.use_sobel:
             self.sobel = SobelProcess(include_origin=False)
             self.sobel.to(self.device)  # sobel filter return a tensor (bn, 1, w, h)
+        self.dedup_tf1 = dedup_tf1
+        # predictions shared by the loss and the regularizations within one step
+        self._prediction_cache = PredictionCache()
+        self._batch_indices: Optional[Tensor] = None
+        # count the forward passes of the network run in each step, and the samples they forward
+        self._forward_count = 0
+        self._forward_samples = 0
+        self.model.torchnet.register_forward_pre_hook(self._count_forward)
+        # batch-norm layers listed once, for the forwards that must not update the running statistics
+        self._bn_freezer = bn_stats_freezer(self.model.torchnet)
+        assert meter_flush_interval >= 1 and report_interval >= 1, \
+            f"Intervals must be >= 1, given {meter_flush_interval} and {report_interval}."
+        self.meter_flush_interval = meter_flush_interval
+        self.report_interval = report_interval
+        # training statistics are kept on device and moved to the meters every `meter_flush_interval` steps
+        self._meter_buffer = MeterBuffer()
+        assert eval_interval >= 1 and full_eval_interval >= 1, \
+            f"Evaluation intervals must be >= 1, given {eval_interval} and {full_eval_interval}."
+        assert eval_subset_size is None or eval_subset_size >= 1, eval_subset_size
+        self.eval_interval = eval_interval
+        self.full_eval_interval = full_eval_interval
+        self.eval_subset_size = eval_subset_size
+        # built from the targets of the first full evaluation
+        self._eval_subset_loader: DataLoader = None
+        self._eval_target: Tensor = None
+        self.streaming_eval = streaming_eval
+        self.joint_heads = joint_heads
+        if self.joint_heads:
+            assert hasattr(self.model.torchnet, "head_A") and hasattr(self.model.torchnet, "head_B"), \
+                f"`joint_heads` needs a two-head architecture, given {self.model.torchnet.__class__.__name__}."
+        self.joint_head_weights = joint_head_weights
+        self._sub_head_pruner: SubHeadPruner = None
+        if subhead_pruning:
+            self._sub_head_pruner = SubHeadPruner(
+                self.model.torchnet, self.model.arch_dict["num_sub_heads"], **subhead_pruning
+            )
+        for name in self._unscheduled_regularizations:
+            assert name not in (reg_schedule or {}), \
+                f"{name} generates the images of the main loss of {self.__class__.__name__} and cannot be scheduled."
+        self._reg_scheduler = RegScheduler(reg_schedule)
+        # samples forwarded by each regularization in the current step
+        self._reg_costs: Dict[str, int] = {}
+        self._teacher_cache: TeacherCache = TeacherCache(**teacher_cache) if teacher_cache else None
+        # tf1 images of the current step, whose predictions are kept in the teacher cache
+        self._tf1_images: Optional[Tensor] = None
+        # data-parallel training over the ranks launched by main.py, see distributed.py
+        self._distributed = is_distributed()
+        if self._distributed:
+            assert eval_subset_size is None, f"Subset evaluations are not supported by the distributed training."
+            # the ranks start from the same weights and the IIC loss sees the joint distribution of the global batch
+            broadcast_module(self.model.torchnet)
+            if isinstance(self.criterion, IIDLoss):
+                self.criterion.all_reduce_joint = True
+            if not is_main_process():
+                self.writer.close()
+                self.writer = NullWriter()
+                shutil.rmtree(self.RUN_PATH, ignore_errors=True)
 
     def __init_meters__(self) -> List[Union[str, List[str]]]:
         """
@@ -271,9 +888,20 @@ class ClusteringGeneralTrainer(_Trainer):
             "val_average_acc": AverageValueMeter(),
             "val_best_acc": AverageValueMeter(),
             "val_worst_acc": AverageValueMeter(),
+            "val_average_nmi": AverageValueMeter(),
+            "val_average_ari": AverageValueMeter(),
+            "train_forwards": AverageValueMeter(),  # number of network forwards per step
+            # samples forwarded by each regularization per step, in batches of tf1 images (0 on skipped steps)
+            **{f"train_{name}_cost": AverageValueMeter() for name in self._regularization_names},
+            "val_full_eval": AverageValueMeter(),  # 1 for a full evaluation, 0 for a subset one, nan if skipped
         }
         self.METERINTERFACE = MeterInterface(METER_CONFIG)
-        return [["val_average_acc_mean", "val_best_acc_mean", "val_worst_acc_mean"]]
+        return [["val_average_acc_mean", "val_best_acc_mean", "val_worst_acc_mean"],
+                ["val_average_nmi_mean", "val_average_ari_mean"]]
+
+    @property
+    def _regularization_names(self) -> List[str]:
+        return [name for name, mixin in REGULARIZATIONS.items() if isinstance(self, mixin)]
 
     @property
     def _training_report_dict(self) -> Dict[str, float]:
@@ -289,6 +917,8 @@ class ClusteringGeneralTrainer(_Trainer):
             "average_acc": self.METERINTERFACE.val_average_acc.summary()["mean"],
             "best_acc": self.METERINTERFACE.val_best_acc.summary()["mean"],
             "worst_acc": self.METERINTERFACE.val_worst_acc.summary()["mean"],
+            "nmi": self.METERINTERFACE.val_average_nmi.summary()["mean"],
+            "ari": self.METERINTERFACE.val_average_ari.summary()["mean"],
         }
         report_dict = dict_filter(report_dict)
         return report_dict
@@ -299,19 +929,47 @@ class ClusteringGeneralTrainer(_Trainer):
         :return:
         """
         for epoch in range(self._start_epoch, self.max_epoch):
-            self._train_loop(
-                train_loader_A=self.train_loader_A,
-                train_loader_B=self.train_loader_B,
-                epoch=epoch,
-                head_control_param=self.head_control_params,
-            )
-            with torch.no_grad():
-                current_score = self._eval_loop(self.val_loader, epoch)
+            # frozen sub-heads are only removed from the heads during the training loop
+            if self._sub_head_pruner is not None:
+                self._sub_head_pruner.select()
+            try:
+                self._train_loop(
+                    train_loader_A=self.train_loader_A,
+                    train_loader_B=self.train_loader_B,
+                    epoch=epoch,
+                    head_control_param=self.head_control_params,
+                )
+            finally:
+                if self._sub_head_pruner is not None:
+                    self._sub_head_pruner.restore()
+            # the running statistics of the batch-norm layers are averaged, so that the ranks evaluate the same model
+            all_reduce_mean_(self.model.torchnet.buffers())
+            if self._sub_head_pruner is not None:
+                self._sub_head_pruner.step(epoch)
+                if self._teacher_cache is not None:
+                    # cached predictions may include the sub-heads frozen by this step
+                    self._teacher_cache.reset()
+            eval_kind = self._eval_kind(epoch)
+            # only full evaluations are trusted to select the best checkpoint
+            current_score = float("-inf")
+            if eval_kind is not None:
+                val_loader = self.val_loader if eval_kind == "full" else self._eval_subset_loader
+                with torch.no_grad():
+                    score = self._eval_loop(val_loader, epoch)
+                self.METERINTERFACE["val_full_eval"].add(float(eval_kind == "full"))
+                if eval_kind == "full":
+                    current_score = score
+                    if self.eval_subset_size is not None and self._eval_subset_loader is None:
+                        self._eval_subset_loader = subset_loader(
+                            self.val_loader, stratified_subset_indices(self._eval_target, self.eval_subset_size)
+                        )
 
             # update meters
             self.METERINTERFACE.step()
             # update model scheduler
             self.model.schedulerStep()
+            if not is_main_process():
+                continue
             # save meters and checkpoints
             SUMMARY = self.METERINTERFACE.summary()
             SUMMARY.to_csv(self.save_dir / f"wholeMeter.csv")
@@ -323,6 +981,18 @@ class ClusteringGeneralTrainer(_Trainer):
         time.sleep(3)
         self.writer.close()
 
+    def _eval_kind(self, epoch: int) -> Union[str, None]:
+        """
+        :param epoch: current epoch
+        :return: `full`, `subset`, or None to skip the evaluation
+        """
+        last_epoch = epoch == self.max_epoch - 1
+        if not last_epoch and (epoch + 1) % self.eval_interval != 0:
+            return None
+        if last_epoch or self._eval_subset_loader is None or (epoch + 1) % self.full_eval_interval == 0:
+            return "full"
+        return "subset"
+
     def _train_loop(
             self,
             train_loader_A: DataLoader = None,
@@ -367,36 +1037,74 @@ class ClusteringGeneralTrainer(_Trainer):
             f"given `len(train_loader_A)`:{len(train_loader_A)} and `len(train_loader_B)`:{len(train_loader_B)}."
         )
 
-        for head_name, head_iterations in head_control_param.items():
-            assert head_name in ("A", "B"), head_name
-            train_loader = eval(f"train_loader_{head_name}")  # change the dataset for different head
+        if self.joint_heads:
+            # a single pass where each step trains both heads on the same trunk features
+            head_weights = self._joint_weights(head_control_param)
+            head_passes = [("+".join(head_weights.keys()), train_loader_B, 1)]
+        else:
+            head_passes = [(head_name, eval(f"train_loader_{head_name}"), head_iterations)  # dataset of each head
+                           for head_name, head_iterations in head_control_param.items()]
+        for head_name, train_loader, head_iterations in head_passes:
             for head_epoch in range(head_iterations):
+                set_sampler_epoch(train_loader, epoch * head_iterations + head_epoch)
                 # given one head, one iteration in this head, and one train_loader.
                 train_loader_: tqdm = tqdm_(train_loader)  # reinitialize the train_loader
                 train_loader_.set_description(
                     f"Training epoch: {epoch} head:{head_name}, head_epoch:{head_epoch + 1}/{head_iterations}"
                 )
                 for batch, image_labels in enumerate(train_loader_):
-                    images, *_ = list(zip(*image_labels))
+                    images, *others = list(zip(*image_labels))
+                    # dataset indices of the samples, used to key per-sample states such as the VAT directions
+                    self._batch_indices = others[1][0] if len(others) > 1 else None
                     # extract tf1_images, tf2_images and put then to self.device
-                    tf1_images = torch.cat(tuple([images[0] for _ in range(len(images) - 1)]), dim=0).to(self.device)
+                    if self.dedup_tf1:
+                        # tf1 is forwarded once, its predictions are repeated for the tf2 views.
+                        tf1_images = images[0].to(self.device)
+                    else:
+                        tf1_images = torch.cat(tuple([images[0] for _ in range(len(images) - 1)]), dim=0).to(
+                            self.device)
                     tf2_images = torch.cat(tuple(images[1:]), dim=0).to(self.device)
-                    assert tf1_images.shape == tf2_images.shape, f"`tf1_images` should have the same size as `tf2_images`," \
-                        f"given {tf1_images.shape} and {tf2_images.shape}."
+                    assert tf1_images.shape[1:] == tf2_images.shape[1:] \
+                           and tf2_images.shape[0] % tf1_images.shape[0] == 0, \
+                        f"`tf2_images` should be views of `tf1_images`, given {tf1_images.shape} and {tf2_images.shape}."
                     # if images are processed with sobel filters
-                    if self.use_sobel:
+                    if self.use_sobel and not self.fold_sobel:
                         tf1_images = self.sobel(tf1_images)
                         tf2_images = self.sobel(tf2_images)
-                        assert tf1_images.shape == tf2_images.shape
+                    self._tf1_images = tf1_images
+                    # predictions can only be shared within one step
+                    self._prediction_cache.reset()
+                    self._forward_count = 0
+                    self._forward_samples = 0
                     # Here you have two kinds of geometric transformations
                     # todo: functions to be overwritten
-                    batch_loss = self._trainer_specific_loss(tf1_images, tf2_images, head_name)
+                    if self.joint_heads:
+                        batch_loss = sum(weight * self._trainer_specific_loss(tf1_images, tf2_images, name)
+                                         for name, weight in head_weights.items())
+                    else:
+                        batch_loss = self._trainer_specific_loss(tf1_images, tf2_images, head_name)
                     # update model with self-defined context manager support Apex module
                     with ZeroGradientBackwardStep(batch_loss, self.model) as loss:
                         loss.backward()
+                        all_reduce_gradients(self.model.torchnet.parameters())
+                    if self._sub_head_pruner is not None:
+                        self._sub_head_pruner.restore_frozen()
+                    self._prediction_cache.reset()
+                    self._meter_buffer.add("train_forwards", self._forward_count)
+                    for name in self._regularization_names:
+                        self._meter_buffer.add(f"train_{name}_cost", self._reg_costs.get(name, 0) / len(images[0]))
+                    self._reg_costs.clear()
+                    self._reg_scheduler.step += 1
+                    if (batch + 1) % self.meter_flush_interval == 0:
+                        self._meter_buffer.flush(self.METERINTERFACE)
                     # write value to tqdm module for system monitoring
-                    report_dict = self._training_report_dict
-                    train_loader_.set_postfix(report_dict)
+                    if (batch + 1) % self.report_interval == 0:
+                        self._meter_buffer.flush(self.METERINTERFACE)
+                        train_loader_.set_postfix(self._training_report_dict)
+                self._meter_buffer.flush(self.METERINTERFACE)
+                report_dict = self._training_report_dict
+                train_loader_.set_postfix(report_dict)
+        report_dict = {**report_dict, "forwards": self.METERINTERFACE["train_forwards"].summary()["mean"]}
         # for tensorboard recording
         self.writer.add_scalar_with_tag("train", report_dict, epoch)
         # for std recording
@@ -416,20 +1124,27 @@ class ClusteringGeneralTrainer(_Trainer):
         # make sure the model is in eval mode.
         assert (not self.model.training), f"Model should be in eval model in _eval_loop, given {self.model.training}."
         val_loader_: tqdm = tqdm_(val_loader)
-        # prediction initialization with shape: (num_sub_heads, num_samples)
-        preds = torch.zeros(self.model.arch_dict["num_sub_heads"],
-                            val_loader.dataset.__len__(),
-                            dtype=torch.long,
-                            device=self.device)
+        num_sub_heads, num_classes = self.model.arch_dict["num_sub_heads"], self.model.arch_dict["output_k_B"]
+        # flat predictions are only kept when they are needed, the metrics come from the confusion matrices.
+        streaming = self.streaming_eval and not return_soft_predict
+        # the shard of the rank in a distributed training
+        num_samples = loader_num_samples(val_loader)
+        # confusion matrices with shape: (num_sub_heads, num_classes, num_classes), indexed by [subhead, pred, gt]
+        confusion = torch.zeros(num_sub_heads, num_classes, num_classes, dtype=torch.long, device=self.device)
+        keep_target = not streaming or (self.eval_subset_size is not None and self._eval_subset_loader is None)
+        if not streaming:
+            # prediction initialization with shape: (num_sub_heads, num_samples)
+            preds = torch.zeros(num_sub_heads, num_samples, dtype=torch.long, device=self.device)
         # soft_prediction initialization with shape (num_sub_heads, num_sample, num_classes)
         if return_soft_predict:
-            soft_preds = torch.zeros(self.model.arch_dict["num_sub_heads"],
-                                     val_loader.dataset.__len__(),
-                                     self.model.arch_dict["output_k_B"],
+            soft_preds = torch.zeros(num_sub_heads,
+                                     num_samples,
+                                     num_classes,
                                      dtype=torch.float,
                                      device=torch.device("cpu"))  # I put it into cpu
         # target initialization with shape: (num_samples)
-        target = torch.zeros(val_loader.dataset.__len__(), dtype=torch.long, device=self.device)
+        if keep_target:
+            target = torch.zeros(num_samples, dtype=torch.long, device=self.device)
         # begin index
         slice_done = 0
         subhead_accs = []
@@ -439,41 +1154,47 @@ class ClusteringGeneralTrainer(_Trainer):
             # only take the tf3 image and gts, put them to self.device
             images, gt = images[0].to(self.device), gt[0].to(self.device)
             # if use sobel filter
-            if self.use_sobel:
+            if self.use_sobel and not self.fold_sobel:
                 images = self.sobel(images)
             # using default head_B for inference, _pred should be a list of simplex by default.
             _pred = self.model.torchnet(images, head="B")
             assert assert_list(simplex, _pred), "pred should be a list of simplexes."
-            assert _pred.__len__() == self.model.arch_dict["num_sub_heads"]
+            assert _pred.__len__() == num_sub_heads
+            batch_preds = torch.stack([p.max(1)[1] for p in _pred], dim=0)
+            confusion += confusion_matrices(batch_preds, gt, num_classes)
             # slice window definition
             bSlicer = slice(slice_done, slice_done + images.shape[0])
-            for subhead in range(self.model.arch_dict["num_sub_heads"]):
+            if not streaming:
                 # save predictions for each subhead for each batch
-                preds[subhead][bSlicer] = _pred[subhead].max(1)[1]
-                if return_soft_predict:
+                preds[:, bSlicer] = batch_preds
+            if return_soft_predict:
+                for subhead in range(num_sub_heads):
                     soft_preds[subhead][bSlicer] = _pred[subhead]
             # save target for each batch
-            target[bSlicer] = gt
+            if keep_target:
+                target[bSlicer] = gt
             # update slice index
             slice_done += gt.shape[0]
         # make sure that all the dataset has been done. Errors will raise if dataloader.drop_last=True
-        assert slice_done == val_loader.dataset.__len__(), "Slice not completed."
-        for subhead in range(self.model.arch_dict["num_sub_heads"]):
-            # remap pred for each head and compare with target to get subhead_acc
-            reorder_pred, remap = hungarian_match(
-                flat_preds=preds[subhead],
-                flat_targets=target,
-                preds_k=self.model.arch_dict["output_k_B"],
-                targets_k=self.model.arch_dict["output_k_B"],
-            )
-            _acc = flat_acc(reorder_pred, target)
+        assert slice_done == num_samples, "Slice not completed."
+        if keep_target:
+            self._eval_target = target
+        # the metrics of all the shards come from the summed confusion matrices
+        confusion = all_reduce_sum(confusion).cpu().numpy()
+        for subhead in range(num_sub_heads):
+            # remap pred for each head with the hungarian assignment on its confusion matrix
+            _acc, remap = hungarian_from_confusion(confusion[subhead])
             subhead_accs.append(_acc)
             # record average acc
             self.METERINTERFACE.val_average_acc.add(_acc)
+            _nmi, _ari = nmi_ari_from_confusion(confusion[subhead])
+            self.METERINTERFACE.val_average_nmi.add(_nmi)
+            self.METERINTERFACE.val_average_ari.add(_ari)
 
             if return_soft_predict:
+                mapping = torch.tensor([remap[k] for k in range(num_classes)], device=preds.device)
                 soft_preds[subhead][:, list(remap.values())] = soft_preds[subhead][:, list(remap.keys())]
-                assert torch.allclose(soft_preds[subhead].max(1)[1], reorder_pred.cpu())
+                assert torch.allclose(soft_preds[subhead].max(1)[1], mapping[preds[subhead]].cpu())
 
         # record best acc
         self.METERINTERFACE.val_best_acc.add(max(subhead_accs))
@@ -485,7 +1206,10 @@ class ClusteringGeneralTrainer(_Trainer):
         # record results for tensorboard
         self.writer.add_scalar_with_tag("val", report_dict, epoch)
         # using multithreads to call histogram interface of tensorboard.
-        pred_histgram(self.writer, preds, epoch=epoch)
+        if streaming or self._distributed:
+            cluster_size_histgram(self.writer, confusion.sum(2), epoch=epoch)
+        else:
+            pred_histgram(self.writer, preds, epoch=epoch)
         # return the current score to save the best checkpoint.
         if return_soft_predict:
             return self.METERINTERFACE.val_best_acc.summary()["mean"], (
@@ -493,6 +1217,87 @@ class ClusteringGeneralTrainer(_Trainer):
 
         return self.METERINTERFACE.val_best_acc.summary()["mean"]
 
+    def _count_forward(self, module: nn.Module, input) -> None:
+        # forward pre-hook of the network
+        self._forward_count += 1
+        self._forward_samples += input[0].shape[0] if input else 0
+
+    def _frozen_bn_stats(self):
+        """
+        context where the forwards of the network leave the running statistics of its batch-norm layers unchanged,
+        for the regularizations forwarding perturbed images.
+        """
+        return self._bn_freezer.frozen()
+
+    def _predict(self, images: Tensor, head_name: str = "B") -> List[Tensor]:
+        """
+        Forward `images` on the given head, reusing the prediction if the same tensor has already been forwarded
+        in the current step with the same grad mode.
+        :param images: input images with device = self.device
+        :param head_name: head name for model inference
+        :return: list of simplexes
+        """
+        preds = self._prediction_cache.get(images, head_name)
+        if preds is None:
+            if self.joint_heads:
+                # the trunk features are cached as well, so that the other head reuses them
+                features = self._prediction_cache.get(images, "trunk")
+                if features is None:
+                    features = [self.model.torchnet(images, trunk_features=True)]
+                    self._prediction_cache.put(images, "trunk", features)
+                preds = getattr(self.model.torchnet, f"head_{head_name}")(features[0])
+            else:
+                preds = self.model.torchnet(images, head=head_name)
+            self._prediction_cache.put(images, head_name, preds)
+            indices = self._tf1_indices(images)
+            if indices is not None:
+                self._teacher_cache.put(head_name, indices, preds, self._reg_scheduler.step)
+        return preds
+
+    def _tf1_indices(self, images: Tensor) -> Optional[Tensor]:
+        """
+        :return: dataset indices of `images` if they are the tf1 images of the step and the teacher cache is enabled
+        """
+        if self._teacher_cache is None or images is not self._tf1_images or self._batch_indices is None:
+            return None
+        return self._batch_indices.repeat(images.shape[0] // self._batch_indices.shape[0])
+
+    def _teacher_predict(self, images: Tensor, head_name: str = "B") -> List[Tensor]:
+        """
+        Detached prediction of `images`, used as the target of a regularization. For the tf1 images, it is taken from
+        the teacher cache when all the samples have been predicted at most `max_staleness` steps ago.
+        :param images: input images with device = self.device
+        :param head_name: head name for model inference
+        :return: list of detached simplexes
+        """
+        with torch.no_grad():
+            preds = self._prediction_cache.get(images, head_name)
+            indices = self._tf1_indices(images)
+            if preds is None and indices is not None:
+                preds = self._teacher_cache.get(head_name, indices, self._reg_scheduler.step)
+            return preds if preds is not None else self._predict(images, head_name)
+
+    def _record_subhead_losses(self, head_name: str, losses: Tensor) -> None:
+        """
+        :param head_name: head name of the losses
+        :param losses: unsupervised losses of the sub-heads with shape (num_sub_heads,), the lower the better
+        """
+        if self._sub_head_pruner is not None:
+            self._sub_head_pruner.record(head_name, losses)
+
+    def _joint_weights(self, head_control_param: OrderedDict) -> Dict[str, float]:
+        """
+        loss weights of the joint mode. By default, the iterations of `head_control_params` become the weights,
+        so that a step weights the heads as the separate passes did over an epoch.
+        :param head_control_param: iterations of each head
+        :return: non-zero weights by head name
+        """
+        weights = self.joint_head_weights if self.joint_head_weights is not None else head_control_param
+        assert set(weights.keys()) <= {"A", "B"}, f"Joint head weights must be given for `A` or `B`, given {weights}."
+        weights = OrderedDict((k, float(v)) for k, v in sorted(weights.items()) if v > 0)
+        assert len(weights) > 0, f"At least one head must have a positive weight, given {weights}."
+        return weights
+
     def _trainer_specific_loss(self, tf1_images: Tensor, tf2_images: Tensor, head_name: str):
         """
         functions to be overrided
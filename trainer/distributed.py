@@ -0,0 +1,127 @@
+"""
+Helpers of the multi-process data-parallel training launched by `main.py` (see the `Distributed` config section).
+Each rank holds a full copy of the network and trains on its shard of the batches. The gradients are averaged with
+one all-reduce per step instead of wrapping the network in `DistributedDataParallel`, which does not support the
+several forwards per step of the regularizations (VAT power iterations, heads trained alternately). Everything is a
+no-op when `torch.distributed` is not initialized.
+"""
+from typing import Iterable
+
+import torch
+import torch.distributed as dist
+from torch import nn, Tensor
+from torch.utils.data import DataLoader, BatchSampler
+from torch.utils.data.distributed import DistributedSampler
+
+__all__ = ["is_distributed", "get_rank", "get_world_size", "is_main_process", "all_reduce_sum",
+           "all_reduce_gradients", "all_reduce_mean_", "broadcast_module", "set_sampler_epoch", "NullWriter"]
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+class _AllReduceSum(torch.autograd.Function):
+    """
+    differentiable sum over the ranks: the gradient of each rank is the sum of the upstream gradients of all the
+    ranks, as each of them contributes to the summed value seen by all the ranks.
+    """
+
+    @staticmethod
+    def forward(ctx, tensor: Tensor) -> Tensor:
+        tensor = tensor.clone()
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+        return tensor
+
+    @staticmethod
+    def backward(ctx, grad_output: Tensor) -> Tensor:
+        grad_output = grad_output.clone()
+        dist.all_reduce(grad_output, op=dist.ReduceOp.SUM)
+        return grad_output
+
+
+def all_reduce_sum(tensor: Tensor) -> Tensor:
+    """
+    :return: the sum of `tensor` over the ranks, keeping the graph of the local `tensor`
+    """
+    if not is_distributed():
+        return tensor
+    if not (torch.is_grad_enabled() and tensor.requires_grad):
+        tensor = tensor.clone()
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+        return tensor
+    return _AllReduceSum.apply(tensor)
+
+
+def all_reduce_gradients(parameters: Iterable[nn.Parameter]) -> None:
+    """
+    average the gradients over the ranks with a single all-reduce of the flattened gradients. The parameters
+    without gradient are skipped, they must be the same on all the ranks.
+    """
+    if not is_distributed():
+        return
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if not grads:
+        return
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def all_reduce_mean_(tensors: Iterable[Tensor]) -> None:
+    """
+    replace in place each floating tensor by its average over the ranks, such as the batch-norm statistics.
+    """
+    if not is_distributed():
+        return
+    for tensor in tensors:
+        if tensor.is_floating_point():
+            dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+            tensor /= get_world_size()
+
+
+def broadcast_module(module: nn.Module, src: int = 0) -> None:
+    """
+    copy the parameters and the buffers of rank `src` to all the ranks.
+    """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(tensor.data, src=src)
+
+
+def set_sampler_epoch(loader: DataLoader, epoch: int) -> None:
+    """
+    reshuffle the shards of a loader built with a `DistributedSampler` for the new epoch.
+    """
+    sampler = loader.sampler
+    if isinstance(sampler, BatchSampler):
+        sampler = sampler.sampler
+    if isinstance(sampler, DistributedSampler):
+        sampler.set_epoch(epoch)
+
+
+class NullWriter(object):
+    """
+    summary writer of the ranks other than 0, discarding all the records.
+    """
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
@@ -54,11 +54,11 @@ class IICGeo_RegTrainer(IICGeoTrainer, GeoReg):
         # vat regularization
         reg_loss = torch.tensor(0.0)
         if head_name == "B":
-            tf1_pred_simplex = self.model.torchnet(tf1_images, head=head_name)
-            tf2_pred_simplex = self.model.torchnet(tf2_images, head=head_name)
+            tf1_pred_simplex = self._predict(tf1_images, head_name)
+            tf2_pred_simplex = self._predict(tf2_images, head_name)
 
             reg_loss = self._geo_regularization(tf1_pred_simplex, tf2_pred_simplex)
-        self.METERINTERFACE["train_adv"].add(reg_loss.item())
+        self._meter_buffer.add("geo_reg", reg_loss)
         return geo_loss + self.reg_weight * reg_loss
 
 
@@ -102,7 +102,7 @@ class IICVAT_RegTrainer(IICGeoTrainer, VATReg):
         geo_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
         # vat regularization
         vat_loss, *_ = self._vat_regularization(self.model.torchnet, tf1_images, head=head_name)
-        self.METERINTERFACE["train_adv"].add(vat_loss.item())
+        self._meter_buffer.add("train_adv", vat_loss)
         return geo_loss + self.reg_weight * vat_loss
 
 
@@ -138,6 +138,7 @@ class IICMixup_RegTrainer(IICGeoTrainer, MixupReg):
             use_sobel: bool = False,
             config: dict = None,
             reg_weight: float = 0.05,
+            Mixup_params: dict = {},
             **kwargs,
     ) -> None:
         IICGeoTrainer.__init__(self,
@@ -155,7 +156,7 @@ class IICMixup_RegTrainer(IICGeoTrainer, MixupReg):
                                **kwargs,
                                )
         self.reg_weight = reg_weight
-        MixupReg.__init__(self)
+        MixupReg.__init__(self, **Mixup_params)
         print(f"reg_weight={reg_weight}")
 
     def __init_meters__(self) -> List[Union[str, List[str]]]:
@@ -177,16 +178,9 @@ class IICMixup_RegTrainer(IICGeoTrainer, MixupReg):
     ):
         # original loss
         geo_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
-        reg_losses: List[Tensor] = []
-        img_pred_simplex = self.model.torchnet(tf1_images, head=head_name)
-        for subhead, tf1_pred in enumerate(img_pred_simplex):
-            mixup_img, mixup_label, mixup_index = self._mixup_image_pred_index(
-                tf1_images, tf1_pred, tf1_images.flip(0), tf1_pred.flip(0)
-            )
-            subhead_loss = self.kl_div(self.model.torchnet(mixup_img, head=head_name)[subhead], mixup_label)
-            reg_losses.append(subhead_loss)
-        _reg_losses: Tensor = sum(reg_losses) / len(reg_losses)
-        self.METERINTERFACE["train_mixup"].add(_reg_losses.item())
+        img_pred_simplex = self._predict(tf1_images, head_name)
+        _reg_losses = self._mixup_regularization(tf1_images, img_pred_simplex, head_name)
+        self._meter_buffer.add("train_mixup", _reg_losses)
         return geo_loss + self.reg_weight * _reg_losses
 
 
@@ -220,7 +214,7 @@ class IICVATMixup_RegTrainer(IICMixup_RegTrainer, VATReg):
     def _trainer_specific_loss(self, tf1_images: Tensor, tf2_images: Tensor, head_name: str):
         geo_mixup_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
         vat_loss, *_ = self._vat_regularization(self.model.torchnet, tf1_images, head=head_name)
-        self.METERINTERFACE["train_adv"].add(vat_loss.item())
+        self._meter_buffer.add("train_adv", vat_loss)
         return geo_mixup_loss + vat_loss
 
 
@@ -243,7 +237,9 @@ class IICVATMI_VATKLTrainer(IICVAT_RegTrainer):
             self, tf1_images: Tensor, tf2_images: Tensor, head_name: str
     ):
         # replace tf2_image from geo-transformed to adversarial images based on MI, then calling super() would be fine.
-        _, tf2_images, _ = self.mi_vat_module(self.model.torchnet, tf1_images, head=head_name)
+        with torch.no_grad():
+            tf1_pred_simplex = self._predict(tf1_images, head_name)
+        _, tf2_images, _ = self.mi_vat_module(self.model.torchnet, tf1_images, pred=tf1_pred_simplex, head=head_name)
         assert tf1_images.shape == tf2_images.shape
         loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
         return loss
@@ -279,9 +275,9 @@ class IICCutout_RegTrainer(IICGeoTrainer, CutoutReg):
 
     def _trainer_specific_loss(self, tf1_images: Tensor, tf2_images: Tensor, head_name: str):
         geo_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
-        cutout_loss = self._cutout_regularization(self.model, tf1_images, self.model(tf1_images, head=head_name),
+        cutout_loss = self._cutout_regularization(self.model, tf1_images, self._predict(tf1_images, head_name),
                                                   head_name)
-        self.METERINTERFACE["train_cutout"].add(cutout_loss.item())
+        self._meter_buffer.add("train_cutout", cutout_loss)
         return geo_loss + cutout_loss * self.reg_weight
 
 
@@ -311,9 +307,9 @@ class IICGaussian_RegTrainer(IICGeoTrainer, GaussianReg):
 
     def _trainer_specific_loss(self, tf1_images: Tensor, tf2_images: Tensor, head_name: str):
         geo_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
-        gaussian_reg = self._gaussian_regularization(self.model, tf1_images, self.model(tf1_images, head_name),
+        gaussian_reg = self._gaussian_regularization(self.model, tf1_images, self._predict(tf1_images, head_name),
                                                      head_name)
-        self.METERINTERFACE["train_gaussian"].add(gaussian_reg.item())
+        self._meter_buffer.add("train_gaussian", gaussian_reg)
         return geo_loss + self.reg_weight * gaussian_reg
 
 
@@ -345,9 +341,9 @@ class IICVATGaussian_RegTrainer(IICVAT_RegTrainer, GaussianReg):
 
     def _trainer_specific_loss(self, tf1_images: Tensor, tf2_images: Tensor, head_name: str):
         geo_vat_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
-        gaussian_loss = self._gaussian_regularization(self.model, tf1_images, self.model(tf1_images, head_name),
+        gaussian_loss = self._gaussian_regularization(self.model, tf1_images, self._predict(tf1_images, head_name),
                                                       head_name)
-        self.METERINTERFACE["train_gaussian"].add(gaussian_loss.item())
+        self._meter_buffer.add("train_gaussian", gaussian_loss)
         return geo_vat_loss + self.reg_weight * gaussian_loss
 
 
@@ -371,7 +367,7 @@ class IICVATCutout_RegTrainer(IICCutout_RegTrainer, VATReg):
     def _trainer_specific_loss(self, tf1_images: Tensor, tf2_images: Tensor, head_name: str):
         geo_cutout_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
         vat_loss, _, _ = self._vat_regularization(self.model, tf1_images, head_name)
-        self.METERINTERFACE["train_vat"].add(vat_loss.item())
+        self._meter_buffer.add("train_vat", vat_loss)
         return geo_cutout_loss + self.reg_weight * vat_loss
 
 
@@ -394,9 +390,9 @@ class IICVATCutoutGaussian_RegTrainer(IICVATCutout_RegTrainer, GaussianReg):
 
     def _trainer_specific_loss(self, tf1_images: Tensor, tf2_images: Tensor, head_name: str):
         geo_vat_cutout_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
-        gaussian_loss = self._gaussian_regularization(self.model, tf1_images, self.model(tf1_images, head_name),
+        gaussian_loss = self._gaussian_regularization(self.model, tf1_images, self._predict(tf1_images, head_name),
                                                       head_name=head_name)
-        self.METERINTERFACE["train_gaussian"].add(gaussian_loss.item())
+        self._meter_buffer.add("train_gaussian", gaussian_loss)
         return geo_vat_cutout_loss + self.reg_weight * gaussian_loss
 
 
@@ -422,9 +418,9 @@ class IICVATMixupCutout_RegTrainer(IICVATMixup_RegTrainer, CutoutReg):
 
     def _trainer_specific_loss(self, tf1_images: Tensor, tf2_images: Tensor, head_name: str):
         geo_vat_mixup_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
-        cutout_loss = self._cutout_regularization(self.model, tf1_images, self.model(tf1_images, head=head_name),
+        cutout_loss = self._cutout_regularization(self.model, tf1_images, self._predict(tf1_images, head_name),
                                                   head_name)
-        self.METERINTERFACE["train_cutout"].add(cutout_loss.item())
+        self._meter_buffer.add("train_cutout", cutout_loss)
         return geo_vat_mixup_loss + self.reg_weight * cutout_loss
 
 
@@ -448,9 +444,9 @@ class IICMixupCutout_RegTrainer(IICMixup_RegTrainer, CutoutReg):
 
     def _trainer_specific_loss(self, tf1_images: Tensor, tf2_images: Tensor, head_name: str):
         geo_mixup_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
-        cutout_loss = self._cutout_regularization(self.model, tf1_images, self.model(tf1_images, head=head_name),
+        cutout_loss = self._cutout_regularization(self.model, tf1_images, self._predict(tf1_images, head_name),
                                                   head_name)
-        self.METERINTERFACE["train_cutout"].add(cutout_loss.item())
+        self._meter_buffer.add("train_cutout", cutout_loss)
         return geo_mixup_loss + self.reg_weight * cutout_loss
 
 
@@ -474,9 +470,9 @@ class IICMixupGaussian_RegTrainer(IICMixup_RegTrainer, GaussianReg):
 
     def _trainer_specific_loss(self, tf1_images: Tensor, tf2_images: Tensor, head_name: str):
         geo_mixup_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
-        gaussian_loss = self._gaussian_regularization(self.model, tf1_images, self.model(tf1_images, head=head_name),
+        gaussian_loss = self._gaussian_regularization(self.model, tf1_images, self._predict(tf1_images, head_name),
                                                       head_name)
-        self.METERINTERFACE["train_gaussian"].add(gaussian_loss.item())
+        self._meter_buffer.add("train_gaussian", gaussian_loss)
         return geo_mixup_loss + self.reg_weight * gaussian_loss
 
 
@@ -501,7 +497,7 @@ class IICMixupCutoutGaussian_RegTrainer(IICMixupCutout_RegTrainer, GaussianReg):
 
     def _trainer_specific_loss(self, tf1_images: Tensor, tf2_images: Tensor, head_name: str):
         geo_mixup_cutout_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
-        gaussian_loss = self._gaussian_regularization(self.model, tf1_images, self.model(tf1_images, head=head_name),
+        gaussian_loss = self._gaussian_regularization(self.model, tf1_images, self._predict(tf1_images, head_name),
                                                       head_name)
-        self.METERINTERFACE["train_gaussian"].add(gaussian_loss.item())
+        self._meter_buffer.add("train_gaussian", gaussian_loss)
         return geo_mixup_cutout_loss + self.reg_weight * gaussian_loss
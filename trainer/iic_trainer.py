@@ -15,8 +15,8 @@ from torch import Tensor
 from torch.nn import functional as F
 from torch.utils.data import DataLoader
 
-from .clustering_trainer import ClusteringGeneralTrainer, VATReg, MixupReg, GaussianReg, CutoutReg
-from .loss import IIDLoss
+from .clustering_trainer import ClusteringGeneralTrainer, VATReg, MixupReg, GaussianReg, CutoutReg, _broadcast_views
+from .loss import StackedIIDLoss
 
 
 # GEO
@@ -50,7 +50,7 @@ class IICGeoTrainer(ClusteringGeneralTrainer):
             train_loader_A,
             train_loader_B,
             val_loader,
-            IIDLoss(),
+            StackedIIDLoss(),
             max_epoch,
             save_dir,
             checkpoint_path,
@@ -84,24 +84,21 @@ class IICGeoTrainer(ClusteringGeneralTrainer):
         :param head_name: head_name
         :return: loss tensor to call .backward()
         """
-        tf1_pred_simplex = self.model.torchnet(tf1_images, head=head_name)
-        tf2_pred_simplex = self.model.torchnet(tf2_images, head=head_name)
+        tf1_pred_simplex = self._predict(tf1_images, head_name)
+        tf2_pred_simplex = self._predict(tf2_images, head_name)
         assert (
                 assert_list(simplex, tf1_pred_simplex)
                 and assert_list(simplex, tf2_pred_simplex)
                 and tf1_pred_simplex.__len__() == tf2_pred_simplex.__len__()
         ), f"Error on tf1 and tf2 predictions."
+        # expand tf1 predictions if tf1 is not repeated to the number of tf2 views.
+        tf1_pred_simplex = _broadcast_views(tf1_pred_simplex, tf2_pred_simplex)
 
-        batch_loss: List[torch.Tensor] = []  # type: ignore
-        for subhead in range(tf1_pred_simplex.__len__()):
-            _loss, _loss_no_lambda = self.criterion(
-                tf1_pred_simplex[subhead], tf2_pred_simplex[subhead]
-            )
-            batch_loss.append(_loss)
-        batch_loss: torch.Tensor = sum(batch_loss) / len(batch_loss)  # type:ignore
-        self.METERINTERFACE[f"train_head_{head_name}"].add(
-            -batch_loss.item()
-        )  # type: ignore
+        # per-subhead losses computed at once on stacked predictions
+        _loss, _loss_no_lambda = self.criterion(tf1_pred_simplex, tf2_pred_simplex)
+        self._record_subhead_losses(head_name, _loss)
+        batch_loss: torch.Tensor = _loss.mean()
+        self._meter_buffer.add(f"train_head_{head_name}", -batch_loss)  # type: ignore
 
         return batch_loss
 
@@ -113,6 +110,7 @@ class IICVATTrainer(IICGeoTrainer, VATReg):
     so that the MI takes tf1_images and VAT(tf1_images).
     No tf2_images are used in this trainer.
     """
+    _unscheduled_regularizations = ("VAT",)
 
     def __init__(
             self,
@@ -281,6 +279,7 @@ class IICGeoMixupTrainer(IICMixupTrainer):
 
 # Mixup+VAT
 class IICVatMixupTrainer(IICMixupTrainer, VATReg):
+    _unscheduled_regularizations = ("VAT",)
 
     def __init__(self, model: Model, train_loader_A: DataLoader, train_loader_B: DataLoader, val_loader: DataLoader,
                  max_epoch: int = 100, save_dir: str = "IICTrainer", checkpoint_path: str = None, device="cpu",
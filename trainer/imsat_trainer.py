@@ -8,8 +8,6 @@ __all__ = ["IMSATAbstractTrainer", "IMSATVATGeoMixupTrainer", "IMSATVATGeoTraine
 from typing import List, Union, Dict
 
 import torch
-from deepclustering.loss.IID_losses import IIDLoss
-from deepclustering.loss.IMSAT_loss import MultualInformaton_IMSAT
 from deepclustering.loss.loss import KL_div
 from deepclustering.meters import AverageValueMeter
 from deepclustering.model import Model
@@ -21,7 +19,9 @@ from deepclustering.utils import (
 from torch import Tensor
 from torch.utils.data import DataLoader
 
-from .clustering_trainer import ClusteringGeneralTrainer, MixupReg, VATReg, GeoReg, GaussianReg, CutoutReg
+from .clustering_trainer import ClusteringGeneralTrainer, MixupReg, VATReg, GeoReg, GaussianReg, CutoutReg, \
+    _broadcast_views
+from .loss import StackedIIDLoss, StackedMI_IMSAT
 
 
 class IMSATAbstractTrainer(ClusteringGeneralTrainer):
@@ -54,7 +54,7 @@ class IMSATAbstractTrainer(ClusteringGeneralTrainer):
             train_loader_A,
             train_loader_B,
             val_loader,
-            MultualInformaton_IMSAT(**MI_params),
+            StackedMI_IMSAT(**MI_params),
             max_epoch,
             save_dir,
             checkpoint_path,
@@ -108,23 +108,18 @@ class IMSATAbstractTrainer(ClusteringGeneralTrainer):
         """
         assert (head_name == "B"), "Only head B is supported in IMSAT, try to set head_control_parameter as {`B`:1}"
         # only tf1_images are needed
-        tf1_pred_simplex = self.model.torchnet(tf1_images, head=head_name)
+        tf1_pred_simplex = self._predict(tf1_images, head_name)
         assert assert_list(simplex, tf1_pred_simplex), "Prediction must be a list of simplexes."
-        batch_loss: List[torch.Tensor] = []  # type: ignore
-        entropies: List[torch.Tensor] = []
-        centropies: List[torch.Tensor] = []
-        for pred in tf1_pred_simplex:
-            mi, (entropy, centropy) = self.criterion(pred)
-            batch_loss.append(mi)
-            entropies.append(entropy)
-            centropies.append(centropy)
+        # per-subhead MI computed at once on stacked predictions
+        mi, (entropies, centropies) = self.criterion(tf1_pred_simplex)
+        self._record_subhead_losses(head_name, -mi)
         # MI object function to be maximized.
-        batch_loss: Tensor = sum(batch_loss) / len(batch_loss)  # type: ignore
-        entropies: Tensor = sum(entropies) / len(entropies)  # type: ignore
-        centropies: Tensor = sum(centropies) / len(centropies)  # type: ignore
-        self.METERINTERFACE["train_mi"].add(batch_loss.item())  # type: ignore
-        self.METERINTERFACE["train_entropy"].add(entropies.item())  # type: ignore
-        self.METERINTERFACE["train_centropy"].add(centropies.item())  # type: ignore
+        batch_loss: Tensor = mi.mean()
+        entropies: Tensor = entropies.mean()
+        centropies: Tensor = centropies.mean()
+        self._meter_buffer.add("train_mi", batch_loss)  # type: ignore
+        self._meter_buffer.add("train_entropy", entropies)  # type: ignore
+        self._meter_buffer.add("train_centropy", centropies)  # type: ignore
         # add regularizations such as VAT, Mixup, GEO or more.
         reg_loss = self._regulaze(tf1_images, tf2_images, tf1_pred_simplex, head_name)
         # decrease the importance of MI, based on the IMSAT chainer implementation.
@@ -167,10 +162,10 @@ class IMSATGeoTrainer(IMSATAbstractTrainer, GeoReg):
             head_name: str = "B",
     ) -> Tensor:
         # advanced transformed images
-        tf_pred_simplex = self.model.torchnet(tf_images, head=head_name)
+        tf_pred_simplex = self._predict(tf_images, head_name)
         assert assert_list(simplex, tf_pred_simplex) and len(tf_pred_simplex) == len(img_pred_simplex)
         geo_loss = self._geo_regularization(img_pred_simplex, tf_pred_simplex)
-        self.METERINTERFACE["train_geo"].add(geo_loss.item())
+        self._meter_buffer.add("train_geo", geo_loss)
         # the regularization for the two are 1:1 by default for the sake for simplification.
         return geo_loss
 
@@ -222,7 +217,7 @@ class IMSATVATTrainer(IMSATAbstractTrainer, VATReg):
         No tf1_images are used for VAT
         """
         reg_loss, *_ = self._vat_regularization(self.model.torchnet, images, head=head_name)
-        self.METERINTERFACE["train_adv"].add(reg_loss.item())
+        self._meter_buffer.add("train_adv", reg_loss)
         return reg_loss
 
 
@@ -237,11 +232,11 @@ class IMSATMixupTrainer(IMSATAbstractTrainer, MixupReg):
     def __init__(self, model: Model, train_loader_A: DataLoader, train_loader_B: DataLoader, val_loader: DataLoader,
                  max_epoch: int = 100, save_dir: str = "IMSATAbstractTrainer", checkpoint_path: str = None,
                  device="cpu", head_control_params: Dict[str, int] = {"B": 1}, use_sobel: bool = False,
-                 config: dict = None, MI_params: dict = {}, **kwargs) -> None:
+                 config: dict = None, MI_params: dict = {}, Mixup_params: dict = {}, **kwargs) -> None:
         IMSATAbstractTrainer.__init__(self, model, train_loader_A, train_loader_B, val_loader, max_epoch, save_dir,
                                       checkpoint_path,
                                       device, head_control_params, use_sobel, config, MI_params, **kwargs)
-        MixupReg.__init__(self)
+        MixupReg.__init__(self, **Mixup_params)
 
     def __init_meters__(self) -> List[Union[str, List[str]]]:
         columns = super().__init_meters__()
@@ -267,15 +262,8 @@ class IMSATMixupTrainer(IMSATAbstractTrainer, MixupReg):
     ) -> Tensor:
         # here just use the tf1_image to mixup
         # nothing with tf2_images
-        reg_losses: List[Tensor] = []
-        for subhead, tf1_pred in enumerate(img_pred_simplex):
-            mixup_img, mixup_label, mixup_index = self._mixup_image_pred_index(
-                images, tf1_pred, images.flip(0), tf1_pred.flip(0)
-            )
-            subhead_loss = self.kl_div(self.model.torchnet(mixup_img, head=head_name)[subhead], mixup_label)
-            reg_losses.append(subhead_loss)
-        _reg_losses: Tensor = sum(reg_losses) / len(reg_losses)
-        self.METERINTERFACE["train_mixup"].add(_reg_losses.item())
+        _reg_losses = self._mixup_regularization(images, img_pred_simplex, head_name)
+        self._meter_buffer.add("train_mixup", _reg_losses)
         return _reg_losses
 
 
@@ -308,7 +296,7 @@ class IMSATGaussianTrainer(IMSATAbstractTrainer, GaussianReg):
     def _regulaze(self, images: Tensor, tf_images: Tensor, img_pred_simplex: List[Tensor],
                   head_name: str = "B") -> Tensor:
         _reg_loss = self._gaussian_regularization(self.model, images, img_pred_simplex, head_name)
-        self.METERINTERFACE["train_gaussian"].add(_reg_loss.item())
+        self._meter_buffer.add("train_gaussian", _reg_loss)
         return _reg_loss
 
 
@@ -341,7 +329,7 @@ class IMSATCutoutTrainer(IMSATAbstractTrainer, CutoutReg):
         :return:
         """
         _reg_loss = self._cutout_regularization(self.model, images, img_pred_simplex, head_name)
-        self.METERINTERFACE["train_cutout"].add(_reg_loss.item())
+        self._meter_buffer.add("train_cutout", _reg_loss)
         return _reg_loss
 
     @property
@@ -400,10 +388,10 @@ class IMSATVATGeoTrainer(IMSATAbstractTrainer, VATReg, GeoReg):
         """
         # VAT loss for images
         vat_loss, *_ = self._vat_regularization(self.model.torchnet, images, head=head_name)
-        self.METERINTERFACE["train_adv"].add(vat_loss.item())
-        tf_pred_simplex = self.model.torchnet(tf_images, head=head_name)
+        self._meter_buffer.add("train_adv", vat_loss)
+        tf_pred_simplex = self._predict(tf_images, head_name)
         geo_loss = self._geo_regularization(img_pred_simplex, tf_pred_simplex)
-        self.METERINTERFACE["train_geo"].add(geo_loss.item())
+        self._meter_buffer.add("train_geo", geo_loss)
         return vat_loss + geo_loss
 
 
@@ -447,7 +435,7 @@ class IMSATVATMixupTrainer(IMSATMixupTrainer, VATReg):
         # nothing with tf2_images
         mixup_loss = super()._regulaze(images, tf_images, img_pred_simplex, head_name)
         vat_loss, *_ = self._vat_regularization(self.model.torchnet, images, head=head_name)
-        self.METERINTERFACE["train_adv"].add(vat_loss.item())
+        self._meter_buffer.add("train_adv", vat_loss)
         return mixup_loss + vat_loss
 
 
@@ -468,9 +456,11 @@ class IMSATGeoMixupTrainer(IMSATMixupTrainer, GeoReg):
             head_name="B",
     ) -> Tensor:
         mixup_loss = super()._regulaze(images, tf_images, img_pred_simplex, head_name)
-        tf_pred_simplex = self.model.torchnet(images, head=head_name)
+        # advanced transformed images, as `IMSATGeoTrainer`
+        tf_pred_simplex = self._predict(tf_images, head_name)
+        assert assert_list(simplex, tf_pred_simplex) and len(tf_pred_simplex) == len(img_pred_simplex)
         geo_loss = self._geo_regularization(img_pred_simplex, tf_pred_simplex)
-        self.METERINTERFACE["train_geo"].add(geo_loss.item())
+        self._meter_buffer.add("train_geo", geo_loss)
         return mixup_loss + geo_loss
 
 
@@ -508,7 +498,9 @@ class IMSATVATGeoMixupTrainer(IMSATVATMixupTrainer, GeoReg):
             head_name="B",
     ) -> Tensor:
         vat_mixup_loss = super()._regulaze(images, tf_images, img_pred_simplex, head_name)
-        tf_pred_simplex = self.model.torchnet(images, head=head_name)
+        # advanced transformed images, as `IMSATGeoTrainer`
+        tf_pred_simplex = self._predict(tf_images, head_name)
+        assert assert_list(simplex, tf_pred_simplex) and len(tf_pred_simplex) == len(img_pred_simplex)
         geo_loss = self._geo_regularization(img_pred_simplex, tf_pred_simplex)
         # vat: geo: mixup= 1: 1: 1 for the sake for simplification.
         return vat_mixup_loss + geo_loss
@@ -526,7 +518,8 @@ class IMSATVATIICGeoTrainer(IMSATVATTrainer):
                  config: dict = None, MI_params: dict = {"mu": 4}, VAT_params: dict = {"eps": 1}, **kwargs) -> None:
         super().__init__(model, train_loader_A, train_loader_B, val_loader, max_epoch, save_dir, checkpoint_path,
                          device, head_control_params, use_sobel, config, MI_params, VAT_params, **kwargs)
-        self.IIC_loss = IIDLoss()
+        self.IIC_loss = StackedIIDLoss()
+        self.IIC_loss.all_reduce_joint = self._distributed
 
     def __init_meters__(self) -> List[Union[str, List[str]]]:
         columns_to_draw = super().__init_meters__()
@@ -552,18 +545,14 @@ class IMSATVATIICGeoTrainer(IMSATVATTrainer):
             head_name="B",
     ) -> Tensor:
         vat_loss = super()._regulaze(images, tf_images, img_pred_simplex, head_name)
-        tf_img_pred_simplex = self.model.torchnet(tf_images, head=head_name)
+        tf_img_pred_simplex = self._predict(tf_images, head_name)
         assert_list(simplex, tf_img_pred_simplex)
+        img_pred_simplex = _broadcast_views(img_pred_simplex, tf_img_pred_simplex)
 
         # IICloss
-        batch_loss: List[torch.Tensor] = []  # type: ignore
-        for subhead in range(img_pred_simplex.__len__()):
-            _loss, _loss_no_lambda = self.IIC_loss(
-                img_pred_simplex[subhead], tf_img_pred_simplex[subhead]
-            )
-            batch_loss.append(_loss)
-        batch_loss: torch.Tensor = sum(batch_loss) / len(batch_loss)  # type:ignore
-        self.METERINTERFACE[f"train_head_{head_name}"].add(-batch_loss.item())  # type: ignore
+        _loss, _loss_no_lambda = self.IIC_loss(img_pred_simplex, tf_img_pred_simplex)
+        batch_loss: torch.Tensor = _loss.mean()
+        self._meter_buffer.add(f"train_head_{head_name}", -batch_loss)  # type: ignore
         return batch_loss + vat_loss
 
 
@@ -590,13 +579,13 @@ class IMSATGeoGaussianTrainer(IMSATGaussianTrainer, GeoReg):
     def _regulaze(self, images: Tensor, tf_images: Tensor, img_pred_simplex: List[Tensor],
                   head_name: str = "B") -> Tensor:
         gaussian_reg = super()._regulaze(images, tf_images, img_pred_simplex, head_name)
-        tf_pred_simplex = self.model(tf_images)
+        tf_pred_simplex = self._predict(tf_images, head_name)
         # dimension check
         assert assert_list(simplex, tf_pred_simplex)
         assert assert_list(simplex, img_pred_simplex)
         assert len(tf_pred_simplex) == len(img_pred_simplex)
         geo_reg = self._geo_regularization(img_pred_simplex, tf_pred_simplex)
-        self.METERINTERFACE["train_geo"].add(geo_reg.item())
+        self._meter_buffer.add("train_geo", geo_reg)
         return gaussian_reg + geo_reg
 
 
@@ -655,7 +644,7 @@ class IMSATMixupGaussianTrainer(IMSATMixupTrainer, GaussianReg):
     def _regulaze(self, images: Tensor, tf_images: Tensor, img_pred_simplex: List[Tensor], head_name="B") -> Tensor:
         mixup_reg = super()._regulaze(images, tf_images, img_pred_simplex, head_name)
         gaussian_reg = self._gaussian_regularization(self.model, images, img_pred_simplex)
-        self.METERINTERFACE["train_gaussian"].add(gaussian_reg.item())
+        self._meter_buffer.add("train_gaussian", gaussian_reg)
         return mixup_reg + gaussian_reg
 
 
@@ -677,7 +666,7 @@ class IMSATGeoCutoutTrainer(IMSATCutoutTrainer, GeoReg):
     def _regulaze(self, images: Tensor, tf_images: Tensor, img_pred_simplex: List[Tensor],
                   head_name: str = "B") -> Tensor:
         cutout_reg = super()._regulaze(images, tf_images, img_pred_simplex, head_name)
-        tf_pred_simplex = self.model.torchnet(tf_images, head=head_name)
+        tf_pred_simplex = self._predict(tf_images, head_name)
         geo_reg = self._geo_regularization(img_pred_simplex, tf_pred_simplex)
         return cutout_reg + geo_reg
 
@@ -710,7 +699,7 @@ class IMSATVATCutoutTrainer(IMSATVATTrainer, CutoutReg):
     def _regulaze(self, images: Tensor, tf_images: Tensor, img_pred_simplex: List[Tensor], head_name="B") -> Tensor:
         vat_reg = super()._regulaze(images, tf_images, img_pred_simplex, head_name)
         cutout_reg = self._cutout_regularization(self.model, images, img_pred_simplex, head_name)
-        self.METERINTERFACE["train_cutout"].add(cutout_reg.item())
+        self._meter_buffer.add("train_cutout", cutout_reg)
         return vat_reg + cutout_reg
 
 
@@ -740,7 +729,7 @@ class IMSATMixupCutoutTrainer(IMSATMixupTrainer, CutoutReg):
     def _regulaze(self, images: Tensor, tf_images: Tensor, img_pred_simplex: List[Tensor], head_name="B") -> Tensor:
         mixup_reg = super()._regulaze(images, tf_images, img_pred_simplex, head_name)
         cutout_reg = self._cutout_regularization(self.model, images, img_pred_simplex)
-        self.METERINTERFACE["train_cutout"].add(cutout_reg.item())
+        self._meter_buffer.add("train_cutout", cutout_reg)
         return mixup_reg + cutout_reg
 
 
@@ -813,7 +802,7 @@ class IMSATGeoVATGaussianTrainer(IMSATVATGaussianTrainer, GeoReg):
 
     def _regulaze(self, images: Tensor, tf_images: Tensor, img_pred_simplex: List[Tensor], head_name="B") -> Tensor:
         vat_gaussian_reg = super()._regulaze(images, tf_images, img_pred_simplex, head_name)
-        tf_pred_simplex = self.model(tf_images)
+        tf_pred_simplex = self._predict(tf_images, head_name)
         geo_reg = self._geo_regularization(img_pred_simplex, tf_pred_simplex)
         return geo_reg + vat_gaussian_reg
 
@@ -823,7 +812,7 @@ class IMSATGeoMixupCutoutTrainer(IMSATMixupCutoutTrainer, GeoReg):
 
     def _regulaze(self, images: Tensor, tf_images: Tensor, img_pred_simplex: List[Tensor], head_name="B") -> Tensor:
         mixup_cutout_reg = super()._regulaze(images, tf_images, img_pred_simplex, head_name)
-        tf1_pred_simplex = self.model(tf_images)
+        tf1_pred_simplex = self._predict(tf_images, head_name)
         geo_reg = self._geo_regularization(img_pred_simplex, tf1_pred_simplex)
         return mixup_cutout_reg + geo_reg
 
@@ -875,5 +864,5 @@ class IMSATVATMixupCutoutTrainer(IMSATVATMixupTrainer, CutoutReg):
     def _regulaze(self, images: Tensor, tf_images: Tensor, img_pred_simplex: List[Tensor], head_name="B") -> Tensor:
         vat_mixup_reg = super()._regulaze(images, tf_images, img_pred_simplex, head_name)
         cutout_reg = self._cutout_regularization(self.model, images, img_pred_simplex, head_name)
-        self.METERINTERFACE["train_cutout"].add(cutout_reg.item())
+        self._meter_buffer.add("train_cutout", cutout_reg)
         return vat_mixup_reg + cutout_reg
@@ -2,6 +2,7 @@
 This is taken from the IIC paper.
 """
 import sys
+from typing import List, Tuple, Union
 
 import torch
 from deepclustering.loss import Entropy
@@ -9,6 +10,8 @@ from deepclustering.utils import simplex, fix_all_seed
 from torch import Tensor
 from torch import nn
 
+from .distributed import all_reduce_sum
+
 
 class IIDLoss(nn.Module):
     def __init__(self, lamb: float = 1.0, eps: float = sys.float_info.epsilon):
@@ -20,18 +23,21 @@ class IIDLoss(nn.Module):
         self.lamb = float(lamb)
         self.eps = float(eps)
         self.torch_vision = torch.__version__
+        # sum the joint distribution over the ranks of a distributed training, so that the loss sees the global batch
+        self.all_reduce_joint = False
 
-    def forward(self, x_out: Tensor, x_tf_out: Tensor):
+    def forward(self, x_out: Tensor, x_tf_out: Tensor, return_no_lamb: bool = False):
         """
         return the inverse of the MI. if the x_out == y_out, return the inverse of Entropy
         :param x_out:
         :param x_tf_out:
-        :return:
+        :param return_no_lamb: compute the loss without lambda as well, otherwise None is returned in its place.
+        :return: loss, loss_no_lamb
         """
         assert simplex(x_out), f"x_out not normalized."
         assert simplex(x_tf_out), f"x_tf_out not normalized."
         _, k = x_out.size()
-        p_i_j = compute_joint(x_out, x_tf_out)
+        p_i_j = compute_joint(x_out, x_tf_out, all_reduce=self.all_reduce_joint)
         assert p_i_j.size() == (k, k)
 
         p_i = (
@@ -52,11 +58,128 @@ class IIDLoss(nn.Module):
                 torch.log(p_i_j) - self.lamb * torch.log(p_j) - self.lamb * torch.log(p_i)
         )
         loss = loss.sum()
+        if not return_no_lamb:
+            return loss, None
         loss_no_lamb = -p_i_j * (torch.log(p_i_j) - torch.log(p_j) - torch.log(p_i))
         loss_no_lamb = loss_no_lamb.sum()
         return loss, loss_no_lamb
 
 
+def _apply_stacked(func, *simplex_lists: Union[Tensor, List[Tensor]]) -> Tensor:
+    """
+    Apply a stacked kernel on lists of subhead predictions. Lists are stacked to (H, B, K) if all the subheads share
+    a shape, otherwise the kernel is applied head by head on (1, B, K) tensors.
+    :return: tensor with shape (H, ...)
+    """
+    if isinstance(simplex_lists[0], Tensor):
+        return func(*simplex_lists)
+    shapes = set(t.shape for simplex_list in simplex_lists for t in simplex_list)
+    if shapes.__len__() == 1:
+        return func(*[torch.stack(tuple(simplex_list), dim=0) for simplex_list in simplex_lists])
+    return torch.cat([func(*[t.unsqueeze(0) for t in subhead]) for subhead in zip(*simplex_lists)], dim=0)
+
+
+class StackedIIDLoss(IIDLoss):
+    """
+    IIDLoss for all the subheads at once, taking (H, B, K) tensors or lists of (B, K) simplexes.
+    """
+
+    def forward(self, x_out: Union[Tensor, List[Tensor]], x_tf_out: Union[Tensor, List[Tensor]],
+                return_no_lamb: bool = False):
+        """
+        :return: per-head loss and per-head loss without lambda (None if not `return_no_lamb`), both with shape (H,)
+        """
+        losses = _apply_stacked(
+            lambda x, x_tf: self._stacked_forward(x, x_tf, return_no_lamb), x_out, x_tf_out
+        )
+        if return_no_lamb:
+            return losses.unbind(1)
+        return losses[:, 0], None
+
+    def _stacked_forward(self, x_out: Tensor, x_tf_out: Tensor, return_no_lamb: bool = False) -> Tensor:
+        assert simplex(x_out, axis=2), f"x_out not normalized."
+        assert simplex(x_tf_out, axis=2), f"x_tf_out not normalized."
+        h, _, k = x_out.size()
+        p_i_j = compute_joint_stacked(x_out, x_tf_out, all_reduce=self.all_reduce_joint)
+        assert p_i_j.size() == (h, k, k)
+
+        p_i = p_i_j.sum(dim=2, keepdim=True)  # h, k, 1
+        p_j = p_i_j.sum(dim=1, keepdim=True)  # h, 1, k
+        if self.torch_vision < "1.3.0":
+            p_i_j = p_i_j.clamp(min=self.eps)
+            p_j = p_j.clamp(min=self.eps)
+            p_i = p_i.clamp(min=self.eps)
+
+        loss = -p_i_j * (
+                torch.log(p_i_j) - self.lamb * torch.log(p_j) - self.lamb * torch.log(p_i)
+        )
+        loss = loss.sum(dim=(1, 2))
+        if not return_no_lamb:
+            return loss.unsqueeze(1)
+        loss_no_lamb = -p_i_j * (torch.log(p_i_j) - torch.log(p_j) - torch.log(p_i))
+        loss_no_lamb = loss_no_lamb.sum(dim=(1, 2))
+        return torch.stack([loss, loss_no_lamb], dim=1)
+
+
+class StackedKL_div(nn.Module):
+    """
+    KL_div(reduce=True) for all the subheads at once, taking (H, B, K) tensors or lists of (B, K) simplexes.
+    """
+
+    def __init__(self, eps: float = 1e-16) -> None:
+        super().__init__()
+        self.eps = eps
+
+    def forward(self, prob: Union[Tensor, List[Tensor]], target: Union[Tensor, List[Tensor]]) -> Tensor:
+        """
+        :param prob: predictions to get approached
+        :param target: fixed targets without grad
+        :return: per-head KL divergence with shape (H,)
+        """
+        return _apply_stacked(self._stacked_forward, prob, target)
+
+    def _stacked_forward(self, prob: Tensor, target: Tensor) -> Tensor:
+        assert prob.shape == target.shape, f"Shape mismatch, given {prob.shape} and {target.shape}."
+        assert simplex(prob, axis=2) and simplex(target, axis=2)
+        assert not target.requires_grad
+        kl = (-target * torch.log((prob + self.eps) / (target + self.eps))).sum(2)
+        return kl.mean(1)
+
+
+class StackedMI_IMSAT(nn.Module):
+    """
+    IMSAT mutual information mu * H(mean(p)) - mean(H(p)) for all the subheads at once, built from `MI_params`.
+    """
+
+    def __init__(self, mu: float = 4.0, eps: float = 1e-8, separate_return: bool = True) -> None:
+        """
+        :param mu: balance term between entropy(average(p_y)) and average(entropy(p_y))
+        :param eps: small value for calculation stability
+        :param separate_return: kept for the `MI_params` of `MultualInformaton_IMSAT`, the entropies are always returned
+        """
+        super().__init__()
+        assert mu > 0, f"mu should be positive, given {mu}."
+        assert separate_return, f"StackedMI_IMSAT always returns the separate entropies, given {separate_return}."
+        self.mu = mu
+        self.eps = eps
+
+    def forward(self, probs: Union[Tensor, List[Tensor]]) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+        """
+        :param probs: (H, B, K) tensor or list of (B, K) simplexes
+        :return: per-head mi, (per-head marginal entropy, per-head conditional entropy), all with shape (H,)
+        """
+        mi, marginal_entropy, conditional_entropy = _apply_stacked(self._stacked_forward, probs).unbind(1)
+        return mi, (marginal_entropy, conditional_entropy)
+
+    def _stacked_forward(self, probs: Tensor) -> Tensor:
+        assert simplex(probs, axis=2), f"probs not normalized."
+        p_average = probs.mean(1)  # h, k
+        marginal_entropy = -(p_average * (p_average + self.eps).log()).sum(1)
+        conditional_entropy = -(probs * (probs + self.eps).log()).sum(2).mean(1)
+        return torch.stack([self.mu * marginal_entropy - conditional_entropy, marginal_entropy, conditional_entropy],
+                           dim=1)
+
+
 class CustomizedIICLoss(nn.Module):
 
     def __init__(self, lamda=1.0, error=1e-3) -> None:
@@ -111,11 +234,12 @@ class CustomizedIICLossDual(nn.Module):
             return weight
 
 
-def compute_joint(x_out: Tensor, x_tf_out: Tensor) -> Tensor:
+def compute_joint(x_out: Tensor, x_tf_out: Tensor, all_reduce: bool = False) -> Tensor:
     r"""
     return joint probability
     :param x_out: p1, simplex
     :param x_tf_out: p2, simplex
+    :param all_reduce: aggregate the batches of all the ranks of a distributed training
     :return: joint probability
     """
     # produces variable that requires grad (since args require grad)
@@ -125,14 +249,33 @@ def compute_joint(x_out: Tensor, x_tf_out: Tensor) -> Tensor:
     bn, k = x_out.shape
     assert x_tf_out.size(0) == bn and x_tf_out.size(1) == k
 
-    p_i_j = x_out.unsqueeze(2) * x_tf_out.unsqueeze(1)  # bn, k, k
-    p_i_j = p_i_j.sum(dim=0)  # k, k aggregated over one batch
+    # matmul instead of the (bn, k, k) outer product summed over the batch
+    p_i_j = x_out.t() @ x_tf_out  # k, k aggregated over one batch
+    if all_reduce:
+        p_i_j = all_reduce_sum(p_i_j)
     p_i_j = (p_i_j + p_i_j.t()) / 2.0  # symmetric
     p_i_j /= p_i_j.sum()  # normalise
 
     return p_i_j
 
 
+def compute_joint_stacked(x_out: Tensor, x_tf_out: Tensor, all_reduce: bool = False) -> Tensor:
+    r"""
+    return joint probabilities of all the subheads with one batched matmul
+    :param x_out: p1, simplexes with shape (h, bn, k)
+    :param x_tf_out: p2, simplexes with shape (h, bn, k)
+    :param all_reduce: aggregate the batches of all the ranks of a distributed training
+    :return: joint probabilities with shape (h, k, k)
+    """
+    assert x_out.shape == x_tf_out.shape, f"Shape mismatch, given {x_out.shape} and {x_tf_out.shape}."
+    p_i_j = torch.bmm(x_out.transpose(1, 2), x_tf_out)  # h, k, k aggregated over one batch
+    if all_reduce:
+        p_i_j = all_reduce_sum(p_i_j)
+    p_i_j = (p_i_j + p_i_j.transpose(1, 2)) / 2.0  # symmetric
+    p_i_j = p_i_j / p_i_j.sum(dim=(1, 2), keepdim=True)  # normalise
+    return p_i_j
+
+
 if __name__ == '__main__':
     fix_all_seed(0)
 
@@ -0,0 +1,69 @@
+"""
+Clustering metrics computed from confusion matrices, so that the evaluation can be streamed batch by batch.
+"""
+from typing import Dict, Tuple, Union
+
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+from torch import Tensor
+
+
+def confusion_matrices(preds: Tensor, target: Tensor, num_classes: int) -> Tensor:
+    """
+    count the (prediction, target) pairs of each subhead with a single bincount.
+    :param preds: predicted clusters with shape (num_subheads, batch_size)
+    :param target: ground truth with shape (batch_size,)
+    :param num_classes: number of clusters and of classes
+    :return: LongTensor with shape (num_subheads, num_classes, num_classes), indexed by [subhead, pred, target]
+    """
+    assert preds.dim() == 2 and preds.shape[1] == target.shape[0], (preds.shape, target.shape)
+    num_subheads = preds.shape[0]
+    offsets = torch.arange(num_subheads, device=preds.device).view(-1, 1) * num_classes ** 2
+    flat_index = offsets + preds * num_classes + target.view(1, -1)
+    counts = torch.bincount(flat_index.view(-1), minlength=num_subheads * num_classes ** 2)
+    return counts.view(num_subheads, num_classes, num_classes)
+
+
+def hungarian_from_confusion(confusion: Union[Tensor, np.ndarray]) -> Tuple[float, Dict[int, int]]:
+    """
+    one to one mapping maximizing the matched samples.
+    :param confusion: (num_classes, num_classes) matrix indexed by [pred, target]
+    :return: accuracy after the remapping and the mapping from predictions to targets
+    """
+    confusion = np.asarray(confusion, dtype=np.float64)
+    pred_index, target_index = linear_sum_assignment(-confusion)
+    acc = confusion[pred_index, target_index].sum() / confusion.sum()
+    return float(acc), dict(zip(pred_index.tolist(), target_index.tolist()))
+
+
+def nmi_ari_from_confusion(confusion: Union[Tensor, np.ndarray]) -> Tuple[float, float]:
+    """
+    normalized mutual information (arithmetic normalization) and adjusted rand index of a contingency matrix.
+    :param confusion: (num_classes, num_classes) matrix indexed by [pred, target]
+    :return: nmi, ari
+    """
+    confusion = np.asarray(confusion, dtype=np.float64)
+    num_samples = confusion.sum()
+    pred_counts, target_counts = confusion.sum(1), confusion.sum(0)
+
+    nonzero = confusion > 0
+    joint = confusion[nonzero] / num_samples
+    outer = np.outer(pred_counts, target_counts)[nonzero] / num_samples ** 2
+    mi = (joint * np.log(joint / outer)).sum()
+
+    def _entropy(counts):
+        p = counts[counts > 0] / num_samples
+        return -(p * np.log(p)).sum()
+
+    normalizer = (_entropy(pred_counts) + _entropy(target_counts)) / 2
+    nmi = 1.0 if normalizer == 0 else float(min(max(mi, 0.0) / normalizer, 1.0))
+
+    def _pairs(counts):
+        return (counts * (counts - 1) / 2).sum()
+
+    index = _pairs(confusion)
+    expected = _pairs(pred_counts) * _pairs(target_counts) / _pairs(np.asarray([num_samples]))
+    maximum = (_pairs(pred_counts) + _pairs(target_counts)) / 2
+    ari = 1.0 if maximum == expected else float((index - expected) / (maximum - expected))
+    return nmi, ari
@@ -0,0 +1,330 @@
+"""
+Composable regularizations for IMSAT and IIC.
+Instead of chaining `_regulaze` through `super()` in one class per combination, the regularizations listed in
+`Trainer.regularizers` first build their perturbed inputs and detached targets, the inputs are concatenated in one
+large batch and forwarded once, and the outputs are split back to compute one KL per regularization.
+The geo regularization reuses the predictions on the tf2 images from the step cache, and the VAT adversarial images
+are forwarded apart with frozen batch-norm statistics, as in the sequential trainers. The regularizations follow the
+`reg_schedule` of the trainer under the names of `REGULARIZATIONS`.
+Note that in train mode the BatchNorm layers see statistics of the concatenated batch, so results are close to but
+not identical to the sequential trainers, which are kept for reproducibility.
+"""
+__all__ = ["RegularizerPipeline", "PipelineReg", "IMSATPipelineTrainer", "IICPipeline_RegTrainer"]
+import contextlib
+from typing import List, Union, Dict, Tuple, Callable, ContextManager
+
+import torch
+from deepclustering.meters import AverageValueMeter
+from deepclustering.model import Model
+from deepclustering.utils import simplex, assert_list, dict_filter
+from termcolor import colored
+from torch import Tensor, nn
+from torch.utils.data import DataLoader
+
+from RegHelper import VATModuleInterface, MixUp
+from .clustering_trainer import GuassianAdder, TensorCutout, RegScheduler, _subsample_batch
+from .iic_trainer import IICGeoTrainer
+from .imsat_trainer import IMSATAbstractTrainer
+from .loss import StackedKL_div
+
+
+class _Regularizer:
+    """
+    A regularization builds perturbed inputs and the detached targets of their predictions.
+    """
+    name: str
+    meter_name: str
+    # name in the `reg_schedule` config and in the `train_<name>_cost` meters, as in `REGULARIZATIONS`
+    schedule_name: str
+    # inputs forwarded in the fused batch, otherwise predicted apart through the step cache
+    fused: bool = True
+    # inputs forwarded without updating the running statistics of the batch-norm layers
+    freeze_bn_stats: bool = False
+
+    def perturb(self, model: nn.Module, tf1_images: Tensor, tf2_images: Tensor, tf1_pred_simplex: List[Tensor],
+                head_name: str) -> Tuple[Tensor, List[Tensor]]:
+        """
+        :param model: network to generate the perturbation if needed
+        :param tf1_images: basic transformed images
+        :param tf2_images: advanced transformed images
+        :param tf1_pred_simplex: list of simplexes on `tf1_images`
+        :param head_name: head name for model inference
+        :return: perturbed inputs and one detached target simplex per subhead
+        """
+        raise NotImplementedError
+
+
+class GeoRegularizer(_Regularizer):
+    name = "geo"
+    meter_name = "train_geo"
+    schedule_name = "Geo"
+    # the tf2 images have been forwarded by the IIC loss, their predictions are taken from the step cache
+    fused = False
+
+    def perturb(self, model, tf1_images, tf2_images, tf1_pred_simplex, head_name):
+        # tf1 predictions are expanded if tf1 is forwarded only once for the tf2 views
+        num_views = tf2_images.size(0) // tf1_images.size(0)
+        return tf2_images, [p.detach().unsqueeze(0).expand(num_views, *p.shape).reshape(-1, p.size(1))
+                            for p in tf1_pred_simplex]
+
+
+class VATRegularizer(_Regularizer):
+    name = "vat"
+    meter_name = "train_adv"
+    schedule_name = "VAT"
+    freeze_bn_stats = True
+
+    def __init__(self, VAT_params: Dict[str, Union[str, float]] = {"eps": 10}) -> None:
+        assert VAT_params.get("name", "kl") == "kl", \
+            f"Only `kl` is supported for VAT in the pipeline, given {VAT_params.get('name')}."
+        # the direction cache and the partial power iteration of `VATReg` are not supported in the pipeline
+        assert not VAT_params.get("direction_cache", False) and float(VAT_params.get("fraction", 1.0)) == 1.0, \
+            f"`direction_cache` and `fraction` are not supported for VAT in the pipeline, given {VAT_params}."
+        self.vat_module = VATModuleInterface(VAT_params)
+
+    def perturb(self, model, tf1_images, tf2_images, tf1_pred_simplex, head_name):
+        targets = [p.detach() for p in tf1_pred_simplex]
+        r_adv = self.vat_module.adversarial_noise(model, tf1_images, targets, head=head_name)
+        return tf1_images + r_adv, targets
+
+
+class MixupRegularizer(_Regularizer):
+    name = "mixup"
+    meter_name = "train_mixup"
+    schedule_name = "Mixup"
+
+    def __init__(self, device: torch.device, num_classes: int) -> None:
+        self.mixup_module = MixUp(device, num_classes=num_classes)
+
+    def perturb(self, model, tf1_images, tf2_images, tf1_pred_simplex, head_name):
+        # the same mixup image is used for all subheads, targets are mixed from each subhead's own prediction.
+        mixup_images, targets, _ = self.mixup_module.mixup_multihead(
+            tf1_images, tf1_pred_simplex, tf1_images.flip(0), [p.flip(0) for p in tf1_pred_simplex]
+        )
+        return mixup_images, targets
+
+
+class GaussianRegularizer(_Regularizer):
+    name = "gaussian"
+    meter_name = "train_gaussian"
+    schedule_name = "Gaussian"
+
+    def __init__(self, gaussian_std: float = 0.1) -> None:
+        self.gaussian_adder = GuassianAdder(gaussian_std)
+
+    def perturb(self, model, tf1_images, tf2_images, tf1_pred_simplex, head_name):
+        return self.gaussian_adder(tf1_images), [p.detach() for p in tf1_pred_simplex]
+
+
+class CutoutRegularizer(_Regularizer):
+    name = "cutout"
+    meter_name = "train_cutout"
+    schedule_name = "Cutout"
+
+    def __init__(self, min_box: int = 6, max_box: int = 12, pad_value: float = 0.0) -> None:
+        self.tensorcutout = TensorCutout(min_box=min_box, max_box=max_box, pad_value=pad_value)
+
+    def perturb(self, model, tf1_images, tf2_images, tf1_pred_simplex, head_name):
+        return self.tensorcutout(tf1_images), [p.detach() for p in tf1_pred_simplex]
+
+
+class RegularizerPipeline:
+    """
+    Forward the perturbed inputs of all regularizations in one batch.
+    """
+
+    def __init__(self, regularizers: List[_Regularizer]) -> None:
+        assert regularizers.__len__() > 0, f"At least one regularization should be given, given {regularizers}."
+        assert len(set(r.name for r in regularizers)) == len(regularizers), \
+            f"Duplicated regularizations, given {[r.name for r in regularizers]}."
+        self.regularizers = regularizers
+        self.stacked_kl_div = StackedKL_div()
+
+    def __call__(self, predict, model: nn.Module, tf1_images: Tensor, tf2_images: Tensor,
+                 tf1_pred_simplex: List[Tensor], head_name: str, scheduler: RegScheduler = None,
+                 forward_samples: Callable[[], int] = None,
+                 frozen_bn_stats: Callable[[], ContextManager] = None) -> Tuple[Dict[str, Tensor], Dict[str, int]]:
+        """
+        :param predict: function taking (images, head_name) and returning a list of simplexes
+        :param model: network to generate the perturbation if needed
+        :param scheduler: skip, subsample and weight the regularizations by their `schedule_name`
+        :param forward_samples: counter of the samples forwarded by the network, to measure the costs
+        :param frozen_bn_stats: context freezing the batch-norm statistics of the network, for VAT
+        :return: dict of regularization name and loss averaged over subheads (zero on skipped steps), and dict of
+        regularization name and number of forwarded samples
+        """
+        assert assert_list(simplex, tf1_pred_simplex), "Prediction must be a list of simplexes."
+        scheduler = scheduler or RegScheduler()
+        forward_samples = forward_samples or (lambda: 0)
+        frozen_bn_stats = frozen_bn_stats or contextlib.suppress
+        losses: Dict[str, Tensor] = {}
+        costs: Dict[str, int] = {}
+        inputs: Dict[str, Tensor] = {}
+        targets: Dict[str, List[Tensor]] = {}
+        for regularizer in self.regularizers:
+            name = regularizer.schedule_name
+            if not scheduler.is_active(name):
+                losses[regularizer.name] = torch.zeros((), device=tf1_images.device)
+                continue
+            args = (tf1_images, tf2_images, tf1_pred_simplex)
+            if scheduler.batch_fraction(name) < 1:
+                args = _subsample_batch(args, scheduler.batch_fraction(name))
+            samples = forward_samples()
+            inputs[regularizer.name], targets[regularizer.name] = regularizer.perturb(model, *args, head_name)
+            costs[name] = forward_samples() - samples
+        # one forward per group of fused regularizations, the others are predicted apart
+        groups: List[List[_Regularizer]] = [
+            [r for r in self.regularizers if r.name in inputs and r.fused and r.freeze_bn_stats == frozen]
+            for frozen in (False, True)
+        ] + [[r] for r in self.regularizers if r.name in inputs and not r.fused]
+        for group in filter(None, groups):
+            group_inputs = [inputs[r.name] for r in group]
+            sizes = [x.size(0) for x in group_inputs]
+            fused_inputs = group_inputs[0] if len(group_inputs) == 1 else torch.cat(group_inputs, dim=0)
+            samples = forward_samples()
+            with frozen_bn_stats() if group[0].freeze_bn_stats else contextlib.suppress():
+                # list of subheads, each being a tuple of predictions split by regularization
+                fused_pred_simplex = [p.split(sizes, dim=0) for p in predict(fused_inputs, head_name)]
+            forwarded = forward_samples() - samples
+            for i, regularizer in enumerate(group):
+                name = regularizer.schedule_name
+                # the samples of a fused forward are attributed to each regularization by its share of the batch
+                costs[name] += forwarded * sizes[i] // sum(sizes)
+                losses[regularizer.name] = scheduler.weight(name) * self.stacked_kl_div(
+                    [subhead_pred[i] for subhead_pred in fused_pred_simplex], list(targets[regularizer.name])
+                ).mean()
+        return losses, costs
+
+
+_REGULARIZERS = (GeoRegularizer, VATRegularizer, MixupRegularizer, GaussianRegularizer, CutoutRegularizer)
+
+
+class PipelineReg:
+    """
+    Mixin building a `RegularizerPipeline` from the names given in config.
+    """
+
+    def __init__(self, regularizers: List[str], VAT_params: Dict[str, Union[str, float]] = {"eps": 10},
+                 Gaussian_params: dict = {}, Cutout_params: dict = {}) -> None:
+        # super().__init__()
+        _regularizers = {
+            "geo": lambda: GeoRegularizer(),
+            "vat": lambda: VATRegularizer(VAT_params),
+            "mixup": lambda: MixupRegularizer(self.device, self.model.arch_dict["output_k_B"]),
+            "gaussian": lambda: GaussianRegularizer(**Gaussian_params),
+            "cutout": lambda: CutoutRegularizer(**Cutout_params),
+        }
+        for name in regularizers:
+            assert name in _regularizers, f"Regularization should be in {list(_regularizers.keys())}, given {name}."
+        self.reg_pipeline = RegularizerPipeline([_regularizers[name]() for name in regularizers])
+        print(colored(f"Regularization pipeline: {', '.join(regularizers)}.", "green"))
+
+    @staticmethod
+    def _pipeline_meter_names(regularizers: List[str]) -> List[str]:
+        _meter_names = {r.name: r.meter_name for r in _REGULARIZERS}
+        return [_meter_names[name] for name in regularizers]
+
+    @staticmethod
+    def _pipeline_schedule_names(regularizers: List[str]) -> List[str]:
+        _schedule_names = {r.name: r.schedule_name for r in _REGULARIZERS}
+        return [_schedule_names[name] for name in regularizers]
+
+    def _pipeline_regularization(self, tf1_images: Tensor, tf2_images: Tensor, tf1_pred_simplex: List[Tensor],
+                                 head_name: str = "B") -> Tensor:
+        losses, costs = self.reg_pipeline(
+            self._predict, self.model.torchnet, tf1_images, tf2_images, tf1_pred_simplex, head_name,
+            scheduler=self._reg_scheduler, forward_samples=lambda: self._forward_samples,
+            frozen_bn_stats=self._frozen_bn_stats,
+        )
+        for name, cost in costs.items():
+            self._reg_costs[name] = self._reg_costs.get(name, 0) + cost
+        for regularizer in self.reg_pipeline.regularizers:
+            self._meter_buffer.add(regularizer.meter_name, losses[regularizer.name])
+        return sum(losses.values())  # type: ignore
+
+
+class IMSATPipelineTrainer(IMSATAbstractTrainer, PipelineReg):
+    """
+    IMSAT with the regularizations given in `regularizers`, weighted 1:1 as in the combination trainers.
+    """
+
+    def __init__(self, model: Model, train_loader_A: DataLoader, train_loader_B: DataLoader, val_loader: DataLoader,
+                 max_epoch: int = 100, save_dir: str = "IMSATAbstractTrainer", checkpoint_path: str = None,
+                 device="cpu", head_control_params: Dict[str, int] = {"B": 1}, use_sobel: bool = False,
+                 config: dict = None, MI_params: dict = {"mu": 4}, regularizers: List[str] = ["vat"],
+                 VAT_params: dict = {"eps": 10}, Gaussian_params: dict = {}, Cutout_params: dict = {},
+                 **kwargs) -> None:
+        # meters are initialized within the __init__ of the father class
+        self.regularizers = list(regularizers)
+        IMSATAbstractTrainer.__init__(self, model, train_loader_A, train_loader_B, val_loader, max_epoch, save_dir,
+                                      checkpoint_path, device, head_control_params, use_sobel, config, MI_params,
+                                      **kwargs)
+        PipelineReg.__init__(self, self.regularizers, VAT_params, Gaussian_params, Cutout_params)
+
+    def __init_meters__(self) -> List[Union[str, List[str]]]:
+        columns = super().__init_meters__()
+        meter_names = self._pipeline_meter_names(self.regularizers)
+        for meter_name in meter_names:
+            self.METERINTERFACE.register_new_meter(meter_name, AverageValueMeter())
+        return [f"{meter_name}_mean" for meter_name in meter_names] + columns
+
+    @property
+    def _training_report_dict(self):
+        report_dict = super()._training_report_dict
+        report_dict.update({meter_name: self.METERINTERFACE[meter_name].summary()["mean"]
+                            for meter_name in self._pipeline_meter_names(self.regularizers)})
+        return dict_filter(report_dict)
+
+    @property
+    def _regularization_names(self) -> List[str]:
+        names = super()._regularization_names
+        return names + [n for n in self._pipeline_schedule_names(self.regularizers) if n not in names]
+
+    def _regulaze(self, images: Tensor, tf_images: Tensor, img_pred_simplex: List[Tensor],
+                  head_name: str = "B") -> Tensor:
+        return self._pipeline_regularization(images, tf_images, img_pred_simplex, head_name)
+
+
+class IICPipeline_RegTrainer(IICGeoTrainer, PipelineReg):
+    """
+    IIC Geo regularized by `reg_weight` times the sum of the regularizations given in `regularizers`.
+    """
+
+    def __init__(self, model: Model, train_loader_A: DataLoader, train_loader_B: DataLoader, val_loader: DataLoader,
+                 max_epoch: int = 100, save_dir: str = "IICTrainer", checkpoint_path: str = None, device="cpu",
+                 head_control_params: Dict[str, int] = {"B": 1}, use_sobel: bool = False, config: dict = None,
+                 regularizers: List[str] = ["vat"], VAT_params: Dict[str, Union[int, float, str]] = {"name": "kl"},
+                 Gaussian_params: dict = {}, Cutout_params: dict = {}, reg_weight: float = 0.05, **kwargs) -> None:
+        self.regularizers = list(regularizers)
+        IICGeoTrainer.__init__(self, model, train_loader_A, train_loader_B, val_loader, max_epoch, save_dir,
+                               checkpoint_path, device, head_control_params, use_sobel, config, **kwargs)
+        PipelineReg.__init__(self, self.regularizers, VAT_params, Gaussian_params, Cutout_params)
+        self.reg_weight = reg_weight
+        print(f"reg_weight={reg_weight}")
+
+    def __init_meters__(self) -> List[Union[str, List[str]]]:
+        columns = super().__init_meters__()
+        meter_names = self._pipeline_meter_names(self.regularizers)
+        for meter_name in meter_names:
+            self.METERINTERFACE.register_new_meter(meter_name, AverageValueMeter())
+        return [f"{meter_name}_mean" for meter_name in meter_names] + columns
+
+    @property
+    def _training_report_dict(self):
+        report_dict = super()._training_report_dict
+        report_dict.update({meter_name: self.METERINTERFACE[meter_name].summary()["mean"]
+                            for meter_name in self._pipeline_meter_names(self.regularizers)})
+        return dict_filter(report_dict)
+
+    @property
+    def _regularization_names(self) -> List[str]:
+        names = super()._regularization_names
+        return names + [n for n in self._pipeline_schedule_names(self.regularizers) if n not in names]
+
+    def _trainer_specific_loss(self, tf1_images: Tensor, tf2_images: Tensor, head_name: str):
+        # original loss
+        geo_loss = super()._trainer_specific_loss(tf1_images, tf2_images, head_name)
+        # tf1 predictions are taken from the step cache
+        tf1_pred_simplex = self._predict(tf1_images, head_name)
+        reg_loss = self._pipeline_regularization(tf1_images, tf2_images, tf1_pred_simplex, head_name)
+        return geo_loss + self.reg_weight * reg_loss
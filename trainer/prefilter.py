@@ -0,0 +1,69 @@
+"""
+Greyscale and Sobel filtering folded into a single frozen convolution in front of the trunk. Both are fixed linear
+filters: the luma of `Img2Tensor` and the two kernels of `SobelProcess` compose into one 3x3 convolution applied on
+the raw RGB (or grey) images. With `fold_sobel`, the loaders output the RGB channels (see `datasets.rgb_transforms`),
+so that the per-sample grey conversion of `Img2Tensor(include_grey=True)` is skipped and the network input goes
+through one full-resolution filter instead of two.
+Up to the uint8 rounding of the grey conversion of PIL, the filtered RGB images are the Sobel responses of the grey
+images. Note that the regularizations perturbing the network input (VAT, Gaussian, Cutout, mixup) then act on the RGB
+images before the Sobel filter instead of on its output.
+"""
+import torch
+import torch.nn.functional as F
+from torch import nn, Tensor
+
+__all__ = ["GreySobelPrefilter", "attach_prefilter"]
+
+# ITU-R 601-2 luma of `Img2Tensor`
+_LUMA = (0.299, 0.587, 0.114)
+# dx and dy kernels of `SobelProcess`
+_SOBEL = ([[1, 0, -1], [2, 0, -2], [1, 0, -1]], [[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+
+
+class GreySobelPrefilter(object):
+    """
+    frozen equivalent of `SobelProcess(include_origin=False)` applied on grey images. RGB inputs are converted to grey
+    within the same convolution, which replaces the per-sample conversion of `Img2Tensor(include_grey=True)`.
+    As `SobelProcess`, it is not a `nn.Module`: its kernels are neither trained nor saved in the checkpoints.
+    """
+    padding = 1
+
+    def __init__(self) -> None:
+        super().__init__()
+        sobel = torch.tensor(_SOBEL, dtype=torch.float).unsqueeze(1)  # (2, 1, 3, 3)
+        self.grey_weight = sobel
+        self.rgb_weight = sobel * torch.tensor(_LUMA).view(1, 3, 1, 1)
+
+    def weight(self, in_channels: int) -> Tensor:
+        assert in_channels in (1, 3), f"Image channel should be 1 or 3, given {in_channels}."
+        return self.grey_weight if in_channels == 1 else self.rgb_weight
+
+    def __call__(self, images: Tensor) -> Tensor:
+        return F.conv2d(images, self.weight(images.shape[1]).to(images), padding=self.padding)
+
+    def to(self, device):
+        self.grey_weight = self.grey_weight.to(device)
+        self.rgb_weight = self.rgb_weight.to(device)
+        return self
+
+
+def attach_prefilter(torchnet: nn.Module, prefilter: GreySobelPrefilter = None) -> GreySobelPrefilter:
+    """
+    apply the prefilter before the trunk (or the whole network) with a forward pre-hook, so that the parameters and
+    the checkpoints of the network are unchanged.
+    :param torchnet: network with a `trunk`, such as `ClusterNet5gTwoHead` and `ClusterNet6cTwoHead`
+    :param prefilter: `GreySobelPrefilter` by default
+    :return: the attached prefilter
+    """
+    assert not hasattr(torchnet, "_prefilter_handle"), f"A prefilter is already attached to {torchnet}."
+    prefilter = prefilter or GreySobelPrefilter()
+    trunk = getattr(torchnet, "trunk", torchnet)
+    prefilter.to(next(trunk.parameters()).device)
+
+    def _hook(module, inputs):
+        return (prefilter(inputs[0]), *inputs[1:])
+
+    torchnet._prefilter = prefilter
+    torchnet._prefilter_handle = trunk.register_forward_pre_hook(_hook)
+    return prefilter
+